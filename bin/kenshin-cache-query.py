@@ -5,7 +5,6 @@ import argparse
 import struct
 import socket
 import cPickle as pickle
-import fnv1a
 
 RUROUNI_QUERY_PORTS = [7002, 7102, 7202]
 
@@ -16,15 +15,42 @@ def main():
                         help="server's host(or ip).")
     parser.add_argument('--num', type=int, default=3,
                         help='number of rurouni caches.')
-    parser.add_argument('metric', help="metric name.")
+    parser.add_argument('--pattern',
+                        help="glob pattern of metrics, e.g. 'servers.*.cpu'.")
+    parser.add_argument('metrics', nargs='*', help="metric names.")
     args = parser.parse_args()
 
-    server = args.server
-    metric = args.metric
     num = args.num
-    port_idx = fnv1a.get_hash_bugfree(metric) % num
-    port = RUROUNI_QUERY_PORTS[port_idx]
+    # metrics are queried in one request per cache, pattern is sent
+    # to all caches.
+    port_metrics = {}
+    for metric in args.metrics:
+        port_metrics.setdefault(get_port(metric, num), []).append(metric)
+    if args.pattern:
+        for port in RUROUNI_QUERY_PORTS[:num]:
+            port_metrics.setdefault(port, [])
 
+    rs = {}
+    for port, metrics in port_metrics.iteritems():
+        request = {
+            'type': 'cache-query-bulk',
+            'metrics': metrics,
+            'pattern': args.pattern,
+        }
+        rs.update(query(args.server, port, request)['datapoints'])
+    for metric in sorted(rs):
+        print metric, rs[metric]
+
+
+def get_port(metric, num):
+    if num == 1:
+        return RUROUNI_QUERY_PORTS[0]
+    # only needed to route metrics among caches
+    import fnv1a
+    return RUROUNI_QUERY_PORTS[fnv1a.get_hash_bugfree(metric) % num]
+
+
+def query(server, port, request):
     conn = socket.socket()
     try:
         conn.connect((server, port))
@@ -32,21 +58,15 @@ def main():
         raise SystemError("Couldn't connect to %s on port %s" %
                           (server, port))
 
-    request = {
-        'type': 'cache-query',
-        'metric': metric,
-    }
-
     serialized_request = pickle.dumps(request, protocol=-1)
     length = struct.pack('!L', len(serialized_request))
     request_packet = length + serialized_request
 
     try:
         conn.sendall(request_packet)
-        rs = recv_response(conn)
-        print rs
-    except Exception as e:
-        raise e
+        return recv_response(conn)
+    finally:
+        conn.close()
 
 
 def recv_response(conn):
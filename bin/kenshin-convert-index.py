@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import sys
+from rurouni.index import convertIndex
+
+
+def main():
+    if len(sys.argv) < 2:
+        print 'need bucket_index_file [binary_index_file]'
+        sys.exit(1)
+
+    convertIndex(*sys.argv[1:3])
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,9 @@ def run(filepath, archive_idx, point_idx, error):
     with open(filepath) as f:
         header = kenshin.header(f)
         archive = header['archive_list'][archive_idx]
+        if (archive['compressed'] or archive['implicit_ts'] or
+                archive['column_major']):
+            return 'archive %d has no raw points.' % archive_idx
         point_size = header['point_size']
         point_format = header['point_format']
 
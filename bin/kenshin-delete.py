@@ -6,7 +6,7 @@ import glob
 import shutil
 from subprocess import check_output
 
-from kenshin import header, pack_header
+from kenshin import header, pack_header, invalidate_header
 from kenshin.agg import Agg
 
 from rurouni.storage import getFilePathByInstanceDir, getMetricPathByInstanceDir
@@ -66,8 +66,10 @@ def delete_file(storage_dir, index, pos_metrics):
             packed_header, _ = pack_header(inter_tag_list,
                                            archive_list,
                                            header_info["x_files_factor"],
-                                           agg_name)
+                                           agg_name,
+                                           header_info["flags"])
             fh.write(packed_header)
+    invalidate_header(filepath)
 
 
 def delete(storage_dir, metric_file):
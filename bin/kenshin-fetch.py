@@ -36,12 +36,14 @@ def main():
     from_time = int(options._from)
     until_time = int(options.until)
 
-    header, timeinfo, points = kenshin.fetch(path, from_time, until_time, NOW)
+    # only decode the column of metric
+    columns = [metric] if metric else None
+    header, timeinfo, points = kenshin.fetch(path, from_time, until_time, NOW,
+                                             columns=columns)
     start, end, step = timeinfo
 
     if metric:
-        idx = header['tag_list'].index(metric)
-        points = (p[idx] if p else None for p in points)
+        points = (p[0] for p in points)
 
     t = start
     for p in points:
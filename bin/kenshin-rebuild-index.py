@@ -2,16 +2,25 @@
 # coding: utf-8
 
 import sys
+import argparse
 from rurouni.storage import rebuildIndex
 
 
+def print_progress(done, total):
+    sys.stderr.write('\r%d/%d files' % (done, total))
+    if done == total:
+        sys.stderr.write('\n')
+
+
 def main():
-    if len(sys.argv) < 3:
-        print 'need bucket_data_dir and bucket_index_file'
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="rebuild index file of a bucket")
+    parser.add_argument('data_dir', help="bucket data dir")
+    parser.add_argument('index_file', help="bucket index file")
+    parser.add_argument('-p', '--processes', type=int, help="number of processes (default: cpu count)")
+    args = parser.parse_args()
 
-    data_dir, index_file = sys.argv[1:]
-    rebuildIndex(data_dir, index_file)
+    rebuildIndex(args.data_dir, args.index_file, args.processes,
+                 print_progress)
 
 
 if __name__ == '__main__':
@@ -3,41 +3,30 @@
 
 import os
 import sys
-import glob
-import kenshin
-from os.path import basename, splitext
-from kenshin.utils import mkdir_p
+import argparse
+from rurouni.storage import rebuildLink
+
+
+def print_progress(done, total):
+    sys.stderr.write('\r%d/%d files' % (done, total))
+    if done == total:
+        sys.stderr.write('\n')
 
 
 def main():
-    if len(sys.argv) < 3:
-        print ('Need data_dir and link_dir.\n'
-               'e.g.: kenshin-rebuild-link.py /kenshin/data/a /kenshin/link/a')
-        sys.exit(1)
-
-    data_dir, link_dir = sys.argv[1:]
-    data_dir = os.path.abspath(data_dir)
-    link_dir = os.path.abspath(link_dir)
-
-    for schema_name in os.listdir(data_dir):
-        hs_file_pat = os.path.join(data_dir, schema_name, '*.hs')
-        for fp in glob.glob(hs_file_pat):
-            with open(fp) as f:
-                header = kenshin.header(f)
-                metric_list = header['tag_list']
-                for metric in metric_list:
-                    if metric != '':
-                        create_link(metric, link_dir, fp)
-
-
-def create_link(metric, link_dir, file_path):
-    link_path = metric.replace('.', os.path.sep)
-    link_path = os.path.join(link_dir, link_path + '.hs')
-    dirname = os.path.dirname(link_path)
-    mkdir_p(dirname)
-    if os.path.exists(link_path):
-        os.remove(link_path)
-    os.symlink(file_path, link_path)
+    parser = argparse.ArgumentParser(
+        description="rebuild links of a bucket",
+        epilog="e.g.: kenshin-rebuild-link.py /kenshin/data/a /kenshin/link/a")
+    parser.add_argument('data_dir', help="bucket data dir")
+    parser.add_argument('link_dir', help="bucket link dir")
+    parser.add_argument('-p', '--processes', type=int, help="number of processes (default: cpu count)")
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    link_dir = os.path.abspath(args.link_dir)
+
+    # resumed from the last finished schema dir if interrupted
+    rebuildLink(data_dir, link_dir, args.processes, print_progress)
 
 
 if __name__ == '__main__':
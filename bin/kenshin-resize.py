@@ -8,7 +8,7 @@ import kenshin
 from kenshin.consts import NULL_VALUE
 from kenshin.utils import get_metric as _get_metric
 from kenshin.agg import Agg
-from rurouni.storage import loadStorageSchemas
+from rurouni.storage import loadStorageSchemas, SchemaMatcher
 
 
 def parse_rurouni_config(conf):
@@ -57,10 +57,8 @@ def get_metric_path(metric, data_dirs):
     return os.path.realpath(rs[0])
 
 
-def get_schema(storage_schemas, metric):
-    for schema in storage_schemas:
-        if schema.match(metric):
-            return schema
+def get_schema(schema_matcher, metric):
+    return schema_matcher.match(metric)
 
 
 def resize_metric(metric, schema, data_dirs):
@@ -95,7 +93,8 @@ def resize_metric(metric, schema, data_dirs):
                        [''] * len(header['tag_list']),
                        schema.archives,
                        header['x_files_factor'],
-                       Agg.get_agg_name(header['agg_id']))
+                       Agg.get_agg_name(header['agg_id']),
+                       flags=header['flags'])
         for i, t in enumerate(header['tag_list']):
             kenshin.add_tag(t, tmpfile, i)
 
@@ -148,7 +147,7 @@ def main():
 
     metric = get_metric(args.metric)
     storage_conf_path = os.path.join(args.kenshin_conf_dir, 'storage-schemas.conf')
-    storage_schemas = loadStorageSchemas(storage_conf_path)
+    storage_schemas = SchemaMatcher(loadStorageSchemas(storage_conf_path))
     schema = get_schema(storage_schemas, metric)
 
     rurouni_conf_path = os.path.join(args.kenshin_conf_dir, 'rurouni.conf')
@@ -18,7 +18,7 @@ from kenshin.tools.whisper_tool import (read_header, metadataSize,
     remote_url)
 from kenshin.tools.hash import Hash
 from kenshin.utils import mkdir_p
-from rurouni.storage import loadStorageSchemas
+from rurouni.storage import loadStorageSchemas, SchemaMatcher, FLAG_OPTIONS
 
 
 ID, META, METRICS, INDEX_FH = range(4)
@@ -91,8 +91,8 @@ def fill_gap(archive_points, archive, metrics_max_num):
     return rs
 
 
-def packed_kenshin_points(points):
-    point_format = storage.POINT_FORMAT % len(points[0][1])
+def packed_kenshin_points(points, flags):
+    point_format = Storage.get_point_format(len(points[0][1]), flags)
     str_format = point_format[0] + point_format[1:] * len(points)
     return struct.pack(str_format, *flatten(points))
 
@@ -132,7 +132,7 @@ def merge_files(meta, metrics, data_dir, output_file):
         # header
         packed_kenshin_header = Storage.pack_header(
             inter_tag_list, archive_info, meta['xff'],
-            agg_name)[0]
+            agg_name, meta['flags'])[0]
         f.write(packed_kenshin_header)
 
         # archives
@@ -141,7 +141,7 @@ def merge_files(meta, metrics, data_dir, output_file):
                               for content in contents]
             archive_points = merge_points(whisper_points, needed_metrics)
             archive_points = fill_gap(archive_points, archive, meta['metrics_max_num'])
-            packed_str = packed_kenshin_points(archive_points)
+            packed_str = packed_kenshin_points(archive_points, meta['flags'])
             f.write(packed_str)
 
 
@@ -185,10 +185,8 @@ def write_to_index(val):
         fh.write("%s %s %s\n" % (m, id, i))
 
 
-def get_schema(storage_schemas, metric):
-    for schema in storage_schemas:
-        if schema.match(metric):
-            return schema
+def get_schema(schema_matcher, metric):
+    return schema_matcher.match(metric)
 
 
 def get_instance(metric, instances):
@@ -251,6 +249,14 @@ def skip_metric(metric, metric_data_path, kenshin_schema, whisper_schema):
     return flag
 
 
+def warn_unsupported_flags(schema):
+    options = sorted(option for option, flag in FLAG_OPTIONS.items()
+                     if schema.flags & flag)
+    print >>sys.stderr, ('[schema warning] %s: %s not supported, files are '
+                         'written without them' % (schema.name,
+                                                   ', '.join(options)))
+
+
 def gen_index_file_handlers(instances_info):
     rs = {}
     for instance in instances_info:
@@ -276,7 +282,7 @@ def main():
     index_file_handlers = gen_index_file_handlers(instances_info)
 
     kenshin_storage_conf = os.path.join(args.kenshin_conf_dir, 'storage-schemas.conf')
-    kenshin_storage_schemas = loadStorageSchemas(kenshin_storage_conf)
+    kenshin_storage_schemas = SchemaMatcher(loadStorageSchemas(kenshin_storage_conf))
     get_whisper_schema = gen_whisper_schema_func(args.whisper_conf_dir)
 
     new_metrics_schemas = {}  # {(instance, schema_name): [id, meta, [metric, ...], index_fh]}
@@ -289,6 +295,7 @@ def main():
         processes.append(p)
 
     link_dir = None
+    warned_schemas = set()
     with open(args.metrics_file) as f:
         for line in f:
             metric = line.strip()
@@ -314,7 +321,12 @@ def main():
                 meta["metrics_max_num"] = schema.metrics_max_num
                 meta["schema_name"] = schema.name
                 meta["xff"] = schema.xFilesFactor
+                # other layouts of kenshin files are not supported
+                meta["flags"] = schema.flags & storage.FLAG_FLOAT32
                 new_metrics_schemas[key][META] = meta
+                if schema.flags != meta["flags"] and schema.name not in warned_schemas:
+                    warned_schemas.add(schema.name)
+                    warn_unsupported_flags(schema)
 
             # set index file handler
             if not new_metrics_schemas[key][INDEX_FH]:
@@ -1,8 +1,10 @@
 # coding: utf-8
 
 from kenshin.storage import (
-    Storage, KenshinException, InvalidConfig, InvalidTime,
-    RetentionParser)
+    Storage, MmapStorage, KenshinException, InvalidConfig, InvalidTime,
+    RetentionParser, header_cache, FLAG_COMPRESSED, FLAG_IMPLICIT_TS,
+    FLAG_COLUMN_MAJOR, FLAG_FLOAT32, FLAG_PAGE_ALIGNED, VALUE_TYPE_FLAGS)
+from kenshin.consts import DEFAULT_FETCH_THREADS
 
 __version__ = "0.2.1"
 __commit__ = "03dda36"
@@ -14,10 +16,51 @@ __date__ = "Thu Sep 24 11:09:50 2015 +0800"
 _storage = Storage()
 validate_archive_list = _storage.validate_archive_list
 create = _storage.create
-update = _storage.update
-fetch = _storage.fetch
 header = _storage.header
+read_tags = _storage.read_tags
 pack_header = _storage.pack_header
 add_tag = _storage.add_tag
+invalidate_header = header_cache.invalidate
+
+# storage engines used by `update` and `fetch`,
+# 'file' uses plain file io, 'mmap' maps each file once.
+_storages = {
+    'file': _storage,
+    'mmap': MmapStorage(),
+}
+
+
+def get_storage(engine='file'):
+    try:
+        return _storages[engine]
+    except KeyError:
+        raise InvalidConfig("unknown storage engine: '%s'" % engine)
+
+
+def update(path, points, now=None, mtime=None, engine='file'):
+    return get_storage(engine).update(path, points, now, mtime)
+
+
+def update_many(batch, now=None, engine='file'):
+    return get_storage(engine).update_many(batch, now)
+
+
+def fetch(path, from_time, until_time=None, now=None, engine='file',
+          columns=None):
+    return get_storage(engine).fetch(path, from_time, until_time, now,
+                                     columns)
+
+
+def fetch_array(path, from_time, until_time=None, now=None, engine='file',
+                columns=None):
+    return get_storage(engine).fetch_array(path, from_time, until_time, now,
+                                           columns)
+
+
+def fetch_many(paths, from_time, until_time=None, now=None, engine='file',
+               link_dir=None, threads=DEFAULT_FETCH_THREADS):
+    return get_storage(engine).fetch_many(paths, from_time, until_time, now,
+                                          link_dir, threads)
+
 
 parse_retention_def = RetentionParser.parse_retention_def
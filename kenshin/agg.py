@@ -4,6 +4,40 @@
 #
 
 import operator
+import numpy as np
+
+from consts import NULL_VALUE
+
+
+### vectorized aggregation
+#
+# These functions aggregate `vals` of shape (m, n, k) along axis 1,
+# only values where `mask` is True are used, and return an array
+# of shape (m, k). Results of fully masked groups are undefined.
+
+def _masked_sum(vals, mask):
+    # cumsum adds values one by one, so the result is exactly the
+    # same as the builtin `sum`.
+    return np.cumsum(np.where(mask, vals, 0.), axis=1)[:, -1]
+
+
+def _masked_average(vals, mask):
+    cnt = mask.sum(axis=1)
+    return _masked_sum(vals, mask) / np.maximum(cnt, 1)
+
+
+def _masked_last(vals, mask):
+    m, n, k = vals.shape
+    last_idxs = n - 1 - np.argmax(mask[:, ::-1, :], axis=1)
+    return vals[np.arange(m)[:, np.newaxis], last_idxs, np.arange(k)]
+
+
+def _masked_max(vals, mask):
+    return np.where(mask, vals, -np.inf).max(axis=1)
+
+
+def _masked_min(vals, mask):
+    return np.where(mask, vals, np.inf).min(axis=1)
 
 
 class Agg(object):
@@ -18,6 +52,14 @@ class Agg(object):
     agg_type_list = [typ for typ, _ in agg_funcs]
     agg_func_dict = dict(agg_funcs)
 
+    agg_array_func_dict = {
+        'average': _masked_average,
+        'sum': _masked_sum,
+        'last': _masked_last,
+        'max': _masked_max,
+        'min': _masked_min,
+    }
+
     @classmethod
     def get_agg_id(cls, agg_name):
         return cls.agg_type_list.index(agg_name)
@@ -27,6 +69,17 @@ class Agg(object):
         agg_type = cls.agg_type_list[agg_id]
         return cls.agg_func_dict[agg_type]
 
+    @classmethod
+    def aggregate_array(cls, agg_id, vals, mask):
+        """
+        Aggregate `vals` of shape (m, n, k) along axis 1 ignoring values
+        where `mask` is False, groups without valid value are NULL_VALUE.
+        """
+        agg_type = cls.agg_type_list[agg_id]
+        rs = cls.agg_array_func_dict[agg_type](vals, mask)
+        rs[~mask.any(axis=1)] = NULL_VALUE
+        return rs
+
     @classmethod
     def get_agg_type_list(cls):
         return cls.agg_type_list
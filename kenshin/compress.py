@@ -0,0 +1,130 @@
+# coding: utf-8
+"""
+Compression of archive blocks.
+
+A block is a list of points sorted by timestamp, it's compressed column
+by column like Gorilla: timestamps are encoded as delta-of-delta and
+values are XORed with previous values of the same column. Both produce
+mostly small integers (or integers with many trailing zero bits), which
+are stored byte aligned, so that all columns of a block are encoded and
+decoded by a few numpy operations. Each column is a stream of
+
+    control bytes: one byte per integer, (trailing_zero_bytes << 4 | size)
+    payload:       `size` significant bytes of each integer, big endian
+
+Block layout (big endian):
+
+    header:  point_cnt, stream sizes of timestamps and each column
+    streams: timestamp stream, column streams
+"""
+import struct
+
+import numpy as np
+
+
+BLOCK_HEADER_FORMAT = "!H%dL"
+BYTE_COLS = np.arange(8)
+
+
+def get_max_block_size(point_cnt, tag_cnt):
+    """
+    Size of a block of `point_cnt` points in the worst case.
+    """
+    header_size = struct.calcsize(BLOCK_HEADER_FORMAT % (tag_cnt + 1))
+    return header_size + (tag_cnt + 1) * point_cnt * 9
+
+
+def _get_keep_mask(size, trail):
+    lead = 8 - size - trail
+    return ((BYTE_COLS >= lead[..., np.newaxis]) &
+            (BYTE_COLS < (8 - trail)[..., np.newaxis]))
+
+
+def encode_streams(ints):
+    """
+    Encode each row of uint64 array `ints` to a stream.
+    """
+    rows, cnt = ints.shape
+    bytes_ = ints.astype('>u8').view(np.uint8).reshape(rows, cnt, 8)
+    non_zero = bytes_ != 0
+    is_zero = ~non_zero.any(axis=2)
+    lead = np.where(is_zero, 8, np.argmax(non_zero, axis=2))
+    trail = np.where(is_zero, 0, np.argmax(non_zero[:, :, ::-1], axis=2))
+    size = 8 - lead - trail
+    control = (trail << 4 | size).astype(np.uint8)
+    payload = bytes_[_get_keep_mask(size, trail)].tostring()
+    ends = np.cumsum(size.sum(axis=1))
+    starts = ends - size.sum(axis=1)
+    return [control[i].tostring() + payload[starts[i]: ends[i]]
+            for i in xrange(rows)]
+
+
+def decode_streams(data, offsets, cnt):
+    """
+    Decode streams at `offsets` of `data`, return an uint64 array of
+    shape (len(offsets), cnt).
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    offsets = np.asarray(offsets)
+    control = buf[offsets[:, np.newaxis] + np.arange(cnt)].astype(np.int64)
+    size = control & 0xf
+    trail = control >> 4
+    payload_sizes = size.sum(axis=1)
+    payload = np.concatenate([buf[offset + cnt: offset + cnt + payload_size]
+                              for offset, payload_size
+                              in zip(offsets, payload_sizes)])
+    bytes_ = np.zeros((len(offsets), cnt, 8), dtype=np.uint8)
+    bytes_[_get_keep_mask(size, trail)] = payload
+    return bytes_.view('>u8').reshape(len(offsets), cnt).astype(np.uint64)
+
+
+def encode_block(timestamps, values):
+    """
+    Compress points, `values` has shape (point_cnt, tag_cnt).
+    """
+    cnt = len(timestamps)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64).reshape(cnt, -1)
+
+    # delta-of-delta of timestamps, the first delta is kept as is
+    deltas = np.diff(np.concatenate(([0], timestamps)))
+    dods = deltas.copy()
+    dods[2:] = deltas[2:] - deltas[1:-1]
+    # zigzag, small negative numbers become small positive numbers
+    zigzag = ((dods << 1) ^ (dods >> 63)).view(np.uint64)
+
+    # XOR with previous value of the same column
+    bits = np.ascontiguousarray(values.T).view(np.uint64)
+    xors = bits.copy()
+    xors[:, 1:] ^= bits[:, :-1]
+
+    streams = encode_streams(np.vstack([zigzag, xors]))
+    header = struct.pack(BLOCK_HEADER_FORMAT % len(streams), cnt,
+                         *map(len, streams))
+    return header + ''.join(streams)
+
+
+def decode_block(data, tag_cnt, columns=None):
+    """
+    Return (timestamps, values) of a compressed block, only `columns`
+    are decoded if it's not None.
+    """
+    header_format = BLOCK_HEADER_FORMAT % (tag_cnt + 1)
+    header = struct.unpack_from(header_format, data)
+    cnt, sizes = header[0], header[1:]
+    offsets = np.cumsum((struct.calcsize(header_format),) + sizes)
+
+    if columns is None:
+        columns = range(tag_cnt)
+    streams = [0] + [col + 1 for col in columns]
+    ints = decode_streams(data, offsets[streams], cnt)
+
+    zigzag = ints[0]
+    dods = ((zigzag >> np.uint64(1)).view(np.int64) ^
+            -(zigzag & np.uint64(1)).view(np.int64))
+    deltas = dods.copy()
+    deltas[1:] = np.cumsum(dods[1:])
+    timestamps = np.cumsum(deltas)
+
+    values = np.bitwise_xor.accumulate(ints[1:], axis=1).view(np.float64)
+    return timestamps, values.T
@@ -3,4 +3,7 @@
 
 NULL_VALUE = -4294967296.0
 DEFAULT_TAG_LENGTH = 96
-CHUNK_SIZE = 16384
\ No newline at end of file
+CHUNK_SIZE = 16384
+DEFAULT_HEADER_CACHE_SIZE = 10000
+DEFAULT_FETCH_THREADS = 8
+ALLOCATION_MODES = ('zero', 'sparse', 'fallocate')
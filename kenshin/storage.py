@@ -12,19 +12,65 @@
 #         Archive = Point+
 #             Point = timestamp, value
 #
+# The high 16 bits of agg_id are format flags. If FLAG_COMPRESSED is set,
+# archives except the first one are compressed:
+#
+#         Archive = BlockEntry+
+#             BlockEntry = start_timestamp, data_size, offset, capacity
+#         Data = Archive+, Block*
+#             Block = compressed points (see compress.py)
+#
+# Blocks are allocated after the last archive when they are written, so a
+# compressed file grows with its data. `offset` of a block is relative to
+# `blocks_offset`, the end of the last archive. A block is rewritten in place if it fits
+# its capacity, otherwise it's moved to the end of file with room to
+# grow. Space of moved blocks is reclaimed when the file is copied (e.g.
+# by add_tag).
+#
+# If FLAG_IMPLICIT_TS is set, uncompressed archives don't store timestamps,
+# the point of timestamp `ts` is in slot `ts / seconds_per_point % point_count`:
+#
+#         Archive = base_timestamp, ValidityBitmap, Row+
+#             Row = value
+#
+# base_timestamp is the newest timestamp written to the archive, a slot
+# is valid if its bit is set and it's in the retention of base_timestamp.
+#
+# If FLAG_COLUMN_MAJOR is set, uncompressed archives are stored column by
+# column, so reading a few metrics of a file only reads their columns:
+#
+#         Archive = Timestamp+, Value+ of tag 0, ..., Value+ of tag N
+#         Archive = base_timestamp, ValidityBitmap, Value+ of tag 0, ...
+#                   (with FLAG_IMPLICIT_TS)
+#
+# If FLAG_FLOAT32 is set, values are stored as 4 bytes floats.
+#
+# If FLAG_PAGE_ALIGNED is set, archives (and the first block of compressed
+# archives) start at PAGE_SIZE boundaries, blocks are not padded.
+# The padding after header is also used as reserved space when tags grow.
+#
 
 import os
 import re
 import time
+import mmap
 import numpy as np
 import math
 import struct
 import operator
 import inspect
+from threading import Lock
+from contextlib import contextmanager
+from itertools import groupby
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from agg import Agg
-from utils import mkdir_p, roundup
-from consts import DEFAULT_TAG_LENGTH, NULL_VALUE, CHUNK_SIZE
+from compress import encode_block, decode_block, get_max_block_size
+from utils import mkdir_p, roundup, fallocate, get_metric
+from consts import (DEFAULT_TAG_LENGTH, NULL_VALUE, CHUNK_SIZE,
+                    DEFAULT_HEADER_CACHE_SIZE, ALLOCATION_MODES,
+                    DEFAULT_FETCH_THREADS)
 
 
 LONG_FORMAT = "!L"
@@ -33,11 +79,36 @@ FLOAT_FORMAT = "!f"
 FLOAT_SIZE = struct.calcsize(FLOAT_FORMAT)
 VALUE_FORMAT = "!d"
 VALUE_SIZE = struct.calcsize(VALUE_FORMAT)
-POINT_FORMAT = "!L%dd"
+# timestamp and values, e.g. POINT_FORMAT % (tag_cnt, 'd')
+POINT_FORMAT = "!L%d%s"
 METADATA_FORMAT = "!2Lf3L"
 METADATA_SIZE = struct.calcsize(METADATA_FORMAT)
 ARCHIVEINFO_FORMAT = "!3L"
 ARCHIVEINFO_SIZE = struct.calcsize(ARCHIVEINFO_FORMAT)
+BLOCK_ENTRY_FORMAT = "!4L"
+BLOCK_ENTRY_SIZE = struct.calcsize(BLOCK_ENTRY_FORMAT)
+BLOCK_ENTRY_DTYPE = np.dtype([('ts', '>u4'), ('size', '>u4'),
+                              ('offset', '>u4'), ('capacity', '>u4')])
+# max number of points in a compressed block
+BLOCK_POINTS = 128
+
+# format flags, stored in the high bits of agg_id.
+FLAG_SHIFT = 16
+AGG_ID_MASK = (1 << FLAG_SHIFT) - 1
+FLAG_COMPRESSED = 1 << 0
+FLAG_IMPLICIT_TS = 1 << 1
+FLAG_COLUMN_MAJOR = 1 << 2
+FLAG_FLOAT32 = 1 << 3
+FLAG_PAGE_ALIGNED = 1 << 4
+
+# alignment of archives with FLAG_PAGE_ALIGNED
+PAGE_SIZE = 4096
+
+# flag of each value type
+VALUE_TYPE_FLAGS = {
+    'float64': 0,
+    'float32': FLAG_FLOAT32,
+}
 
 # reserved tag index for reserved space,
 # this is usefull when adding a tag to a file.
@@ -162,6 +233,156 @@ class RetentionParser(object):
         return precision, point_cnt
 
 
+### header cache
+
+class HeaderCache(object):
+    """
+    Process-wide LRU cache of parsed headers.
+
+    A cached header is keyed by file path and is only valid while the
+    (inode, size, mtime) of the file is unchanged. Functions that rewrite
+    the header (e.g. `Storage.add_tag`) should call `invalidate`
+    explicitly. Cached headers are shared, so callers must not modify them.
+    """
+
+    def __init__(self, max_size=DEFAULT_HEADER_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.headers = OrderedDict()
+
+    @staticmethod
+    def get_ident(st):
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def get(self, path, st):
+        with self.lock:
+            try:
+                ident, header = self.headers.pop(path)
+            except KeyError:
+                return None
+            if ident != self.get_ident(st):
+                return None
+            self.headers[path] = (ident, header)
+            return header
+
+    def put(self, path, st, header):
+        with self.lock:
+            self.headers.pop(path, None)
+            while self.headers and len(self.headers) >= self.max_size:
+                self.headers.popitem(last=False)
+            self.headers[path] = (self.get_ident(st), header)
+
+    def touch(self, path, st):
+        """
+        Revalidate the cached header of `path` after writing data points,
+        which changes the mtime of the file but not the header.
+        """
+        with self.lock:
+            if path in self.headers:
+                _, header = self.headers[path]
+                self.headers[path] = (self.get_ident(st), header)
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.headers.clear()
+            else:
+                self.headers.pop(path, None)
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            while len(self.headers) > max_size:
+                self.headers.popitem(last=False)
+
+
+header_cache = HeaderCache()
+
+
+### write buffer
+
+class WriteBuffer(object):
+    """
+    File-like wrapper that keeps writes in memory until `flush`,
+    reads see the pending writes.
+
+    `flush` merges adjacent and overlapping writes, so each merged
+    range is written with one seek and one write.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.pos = 0
+        self.pending = []
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 2:
+            self.fh.seek(0, 2)
+            offset += max([self.fh.tell()] +
+                          [o + len(d) for o, d in self.pending])
+        self.pos = offset
+
+    def write(self, data):
+        self.pending.append((self.pos, data))
+        self.pos += len(data)
+
+    def read(self, size):
+        self.fh.seek(self.pos)
+        data = self.fh.read(size)
+        begin, end = self.pos, self.pos + size
+        self.pos = begin + len(data)
+
+        overlapped = [(offset, d) for (offset, d) in self.pending
+                      if offset < end and offset + len(d) > begin]
+        if not overlapped:
+            return data
+        # pending writes may be beyond end of file
+        end = max([self.pos] + [min(end, offset + len(d))
+                                for offset, d in overlapped])
+        self.pos = end
+        buf = bytearray(data)
+        buf.extend('\x00' * (end - begin - len(data)))
+        for offset, d in overlapped:
+            lo, hi = max(begin, offset), min(end, offset + len(d))
+            buf[lo-begin: hi-begin] = d[lo-offset: hi-offset]
+        return str(buf)
+
+    def get_ranges(self):
+        """
+        Return merged (offset, data) ranges of pending writes,
+        later writes win when they overlap.
+        """
+        writes = sorted(enumerate(self.pending), key=lambda x: x[1][0])
+        groups = []
+        for seq, (offset, data) in writes:
+            end = offset + len(data)
+            if groups and offset <= groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], end)
+                groups[-1][2].append((seq, offset, data))
+            else:
+                groups.append([offset, end, [(seq, offset, data)]])
+
+        ranges = []
+        for begin, end, group in groups:
+            if len(group) == 1:
+                ranges.append((begin, group[0][2]))
+                continue
+            buf = bytearray(end - begin)
+            for _, offset, data in sorted(group):
+                buf[offset-begin: offset-begin+len(data)] = data
+            ranges.append((begin, str(buf)))
+        return ranges
+
+    def flush(self):
+        for offset, data in self.get_ranges():
+            self.fh.seek(offset)
+            self.fh.write(data)
+        self.pending = []
+
+
 ### Storage
 
 class Storage(object):
@@ -170,8 +391,22 @@ class Storage(object):
         self.data_dir = data_dir
 
     def create(self, metric_name, tag_list, archive_list, x_files_factor=None,
-               agg_name=None):
+               agg_name=None, allocation='zero', flags=0):
+        """
+        `allocation` decides how the data region is initialized:
+          'zero': write zeroes to the whole data region.
+          'sparse': only extend the file, leave it sparse.
+          'fallocate': preallocate disk space without writing data.
+        Unwritten regions are read as zeroes, so they are empty points
+        in all cases.
+
+        `flags` are format flags, e.g. FLAG_COMPRESSED. Blocks of
+        compressed archives are not allocated here, they are appended
+        to the file when written.
+        """
         Storage.validate_archive_list(archive_list, x_files_factor)
+        if allocation not in ALLOCATION_MODES:
+            raise InvalidConfig('unknown allocation mode: %s' % allocation)
 
         path = self.gen_path(self.data_dir, metric_name)
         if os.path.exists(path):
@@ -184,18 +419,31 @@ class Storage(object):
         empty_tag_cnt = sum(1 for t in tag_list if not t)
         inter_tag_list = tag_list + ['N' * DEFAULT_TAG_LENGTH * empty_tag_cnt]
 
-        with open(path, 'wb') as f:
-            packed_header, end_offset = self.pack_header(
-                inter_tag_list, archive_list, x_files_factor, agg_name)
-            f.write(packed_header)
-
-            # init data
-            remaining = end_offset - f.tell()
-            zeroes = '\x00' * CHUNK_SIZE
-            while remaining > CHUNK_SIZE:
-                f.write(zeroes)
-                remaining -= CHUNK_SIZE
-            f.write(zeroes[:remaining])
+        try:
+            with open(path, 'wb') as f:
+                packed_header, end_offset = self.pack_header(
+                    inter_tag_list, archive_list, x_files_factor, agg_name,
+                    flags)
+                f.write(packed_header)
+
+                # init data
+                if allocation == 'sparse':
+                    f.truncate(end_offset)
+                elif allocation == 'fallocate':
+                    f.flush()
+                    fallocate(f.fileno(), 0, end_offset)
+                else:
+                    remaining = end_offset - f.tell()
+                    zeroes = '\x00' * CHUNK_SIZE
+                    while remaining > CHUNK_SIZE:
+                        f.write(zeroes)
+                        remaining -= CHUNK_SIZE
+                    f.write(zeroes[:remaining])
+        except Exception:
+            # don't leave a partial file, it can't be created again
+            if os.path.exists(path):
+                os.remove(path)
+            raise
 
     @staticmethod
     def validate_archive_list(archive_list, xff):
@@ -266,17 +514,19 @@ class Storage(object):
         return os.path.join(data_dir, file_path)
 
     @staticmethod
-    def pack_header(inter_tag_list, archive_list, x_files_factor, agg_name):
+    def pack_header(inter_tag_list, archive_list, x_files_factor, agg_name,
+                    flags=0):
         # tag
         tag = str('\t'.join(inter_tag_list))
 
         # metadata
-        agg_id = Agg.get_agg_id(agg_name)
+        agg_id = Agg.get_agg_id(agg_name) | flags << FLAG_SHIFT
         max_retention = reduce(operator.mul, archive_list[-1], 1)
         xff = x_files_factor
         archive_cnt = len(archive_list)
         tag_size = len(tag)
-        point_size = struct.calcsize(POINT_FORMAT % (len(inter_tag_list) - 1))
+        tag_cnt = len(inter_tag_list) - 1
+        point_size = struct.calcsize(Storage.get_point_format(tag_cnt, flags))
         metadata = struct.pack(METADATA_FORMAT, agg_id, max_retention,
             xff, archive_cnt, tag_size, point_size)
 
@@ -284,12 +534,65 @@ class Storage(object):
         header = [metadata, tag]
         offset = METADATA_SIZE + len(tag) + ARCHIVEINFO_SIZE * len(archive_list)
 
-        for sec, cnt in archive_list:
+        for i, (sec, cnt) in enumerate(archive_list):
+            if flags & FLAG_PAGE_ALIGNED:
+                offset = roundup(offset, PAGE_SIZE)
             archive_info = struct.pack(ARCHIVEINFO_FORMAT, offset, sec, cnt)
             header.append(archive_info)
-            offset += point_size * cnt
+            layout = Storage.get_archive_layout(flags, i, cnt, tag_cnt,
+                                                point_size)
+            offset += layout['size']
+        if flags & FLAG_PAGE_ALIGNED:
+            offset = roundup(offset, PAGE_SIZE)
         return ''.join(header), offset
 
+    @staticmethod
+    def get_archive_layout(flags, archive_idx, cnt, tag_cnt, point_size):
+        """
+        Return layout fields of an archive in header info.
+        """
+        if flags & FLAG_COMPRESSED and archive_idx > 0:
+            block_points = min(cnt, BLOCK_POINTS)
+            # a retention period may start and end in the middle of blocks
+            block_cnt = (cnt + block_points - 1) / block_points + 1
+            return {
+                'compressed': True,
+                'implicit_ts': False,
+                'column_major': False,
+                'block_points': block_points,
+                'block_cnt': block_cnt,
+                'max_block_size': get_max_block_size(block_points, tag_cnt),
+                # only block index, blocks are after the last archive
+                'size': block_cnt * BLOCK_ENTRY_SIZE,
+            }
+        # `values_offset` is the offset of values relative to the archive
+        column_major = bool(flags & FLAG_COLUMN_MAJOR)
+        if flags & FLAG_IMPLICIT_TS:
+            bitmap_size = (cnt + 7) / 8
+            row_size = point_size - LONG_SIZE
+            return {
+                'compressed': False,
+                'implicit_ts': True,
+                'column_major': column_major,
+                'bitmap_size': bitmap_size,
+                'row_size': row_size,
+                'values_offset': LONG_SIZE + bitmap_size,
+                'size': LONG_SIZE + bitmap_size + row_size * cnt,
+            }
+        layout = {'compressed': False, 'implicit_ts': False,
+                  'column_major': column_major, 'size': point_size * cnt}
+        if column_major:
+            layout['values_offset'] = LONG_SIZE * cnt
+        return layout
+
+    @staticmethod
+    def get_value_format(flags):
+        return FLOAT_FORMAT if flags & FLAG_FLOAT32 else VALUE_FORMAT
+
+    @staticmethod
+    def get_point_format(tag_cnt, flags):
+        return POINT_FORMAT % (tag_cnt, Storage.get_value_format(flags)[1:])
+
     @staticmethod
     def header(fh):
         origin_offset = fh.tell()
@@ -299,6 +602,9 @@ class Storage(object):
         agg_id, max_retention, xff, archive_cnt, tag_size, point_size = struct.unpack(
             METADATA_FORMAT, packed_metadata)
         inter_tag_list = fh.read(tag_size).split('\t')
+        tag_list = inter_tag_list[:RESERVED_INDEX]
+        flags = agg_id >> FLAG_SHIFT
+        agg_id &= AGG_ID_MASK
 
         archives = []
         for i in xrange(archive_cnt):
@@ -309,25 +615,45 @@ class Storage(object):
                 'offset': offset,
                 'sec_per_point': sec,
                 'count': cnt,
-                'size': point_size * cnt,
                 'retention': sec * cnt,
             }
+            archive_info.update(Storage.get_archive_layout(
+                flags, i, cnt, len(tag_list), point_size))
             archives.append(archive_info)
+        # blocks of compressed archives start after the last archive
+        blocks_offset = archives[-1]['offset'] + archives[-1]['size']
+        if flags & FLAG_PAGE_ALIGNED:
+            blocks_offset = roundup(blocks_offset, PAGE_SIZE)
 
         fh.seek(origin_offset)
-        tag_list = inter_tag_list[:RESERVED_INDEX]
+        value_format = Storage.get_value_format(flags)
         info = {
             'agg_id': agg_id,
+            'flags': flags,
             'max_retention': max_retention,
             'x_files_factor': xff,
             'tag_list': tag_list,
             'reserved_size': len(inter_tag_list[RESERVED_INDEX]),
             'point_size': point_size,
-            'point_format': POINT_FORMAT % len(tag_list),
+            'point_format': Storage.get_point_format(len(tag_list), flags),
+            'value_size': struct.calcsize(value_format),
+            'value_dtype': np.dtype('>' + value_format[1:]),
             'archive_list': archives,
+            'blocks_offset': blocks_offset,
         }
         return info
 
+    @staticmethod
+    def read_tags(path):
+        """
+        Return tag list of `path`, only metadata and tag region are read.
+        """
+        with open(path, 'rb', 0) as fh:
+            packed_metadata = fh.read(METADATA_SIZE)
+            tag_size = struct.unpack(METADATA_FORMAT, packed_metadata)[4]
+            inter_tag_list = fh.read(tag_size).split('\t')
+        return inter_tag_list[:RESERVED_INDEX]
+
     @staticmethod
     def add_tag(tag, path, pos_idx):
         with open(path, 'r+b') as fh:
@@ -344,75 +670,222 @@ class Storage(object):
                 tag_list[pos_idx] = tag
                 inter_tag_list = tag_list + ['N' * diff]
                 packed_header, _ = Storage.pack_header(
-                    inter_tag_list, archive_list, header_info['x_files_factor'], agg_name)
+                    inter_tag_list, archive_list, header_info['x_files_factor'],
+                    agg_name, header_info['flags'])
                 fh.write(packed_header)
             else:
                 tag_list[pos_idx] = tag
                 inter_tag_list = tag_list + ['']
                 packed_header, _ = Storage.pack_header(
-                    inter_tag_list, archive_list, header_info['x_files_factor'], agg_name)
-                tmpfile = path + '.tmp'
-                with open(tmpfile, 'wb') as fh_tmp:
-                    fh_tmp.write(packed_header)
-                    fh.seek(header_info['archive_list'][0]['offset'])
-                    while True:
-                        bytes = fh.read(CHUNK_SIZE)
-                        if not bytes:
-                            break
-                        fh_tmp.write(bytes)
-                os.rename(tmpfile, path)
+                    inter_tag_list, archive_list, header_info['x_files_factor'],
+                    agg_name, header_info['flags'])
+                # offset of the first archive in new header
+                data_offset = struct.unpack_from(
+                    ARCHIVEINFO_FORMAT, packed_header,
+                    len(packed_header) - ARCHIVEINFO_SIZE * len(archive_list))[0]
+                if data_offset == header_info['archive_list'][0]['offset']:
+                    # new header fits in the padding of page aligned file
+                    fh.write(packed_header)
+                else:
+                    tmpfile = path + '.tmp'
+                    with open(tmpfile, 'wb') as fh_tmp:
+                        fh_tmp.write(packed_header)
+                        padding = data_offset - len(packed_header)
+                        fh_tmp.write('\x00' * padding)
+                        Storage._copy_data(fh, fh_tmp, header_info,
+                                           data_offset)
+                    os.rename(tmpfile, path)
+        header_cache.invalidate(path)
+
+    @staticmethod
+    def _copy_data(fh, fh_tmp, header, data_offset):
+        """
+        Copy archives of `fh` to `fh_tmp` at `data_offset`. Blocks of
+        compressed archives are packed one after another, so the space
+        of moved blocks and unused capacity is reclaimed.
+        """
+        archive_offset = header['archive_list'][0]['offset']
+        fh.seek(archive_offset)
+        remaining = header['blocks_offset'] - archive_offset
+        while remaining > 0:
+            bytes = fh.read(min(CHUNK_SIZE, remaining))
+            if not bytes:
+                break
+            fh_tmp.write(bytes)
+            remaining -= len(bytes)
+
+        shift = data_offset - archive_offset
+        blocks_size = 0
+        for archive in header['archive_list']:
+            if not archive['compressed']:
+                continue
+            entries = Storage._read_block_entries(fh, archive).copy()
+            for entry in entries:
+                if not entry['size']:
+                    continue
+                fh.seek(header['blocks_offset'] + entry['offset'])
+                data = fh.read(entry['size'])
+                fh_tmp.seek(header['blocks_offset'] + shift + blocks_size)
+                fh_tmp.write(data)
+                entry['offset'] = blocks_size
+                entry['capacity'] = entry['size']
+                blocks_size += entry['size']
+            fh_tmp.seek(archive['offset'] + shift)
+            fh_tmp.write(entries.tostring())
+
+    def _open(self, path, mode='rb'):
+        """
+        Open `path` for reading or updating data points, subclasses can
+        override this to provide a different file access engine.
+        """
+        return open(path, mode)
+
+    @staticmethod
+    def _read_range(fh, archive, begin_offset, end_offset):
+        """
+        Read bytes between `begin_offset` and `end_offset` of `archive`,
+        wrap around to the beginning of archive if needed.
+        """
+        fh.seek(begin_offset)
+        if begin_offset < end_offset:
+            return fh.read(end_offset - begin_offset)
+        else:
+            archive_end = archive['offset'] + archive['size']
+            series_str = fh.read(archive_end - begin_offset)
+            fh.seek(archive['offset'])
+            series_str += fh.read(end_offset - archive['offset'])
+            return series_str
+
+    def _get_header(self, path, fh, st=None):
+        """
+        Return the header of `path` from header cache, parse and
+        cache it if not cached.
+        """
+        if st is None:
+            st = os.stat(path)
+        header = header_cache.get(path, st)
+        if header is None:
+            header = self.header(fh)
+            header_cache.put(path, st, header)
+        return header
+
+    def _after_update(self, path):
+        header_cache.touch(path, os.stat(path))
 
     def update(self, path, points, now=None, mtime=None):
+        st = os.stat(path)
+        with self._open(path, 'r+b') as f:
+            self._update(f, path, st, points, now, mtime)
+        self._after_update(path)
+
+    def update_many(self, batch, now=None):
+        """
+        Update a batch of files, `batch` is a list of (path, points).
+
+        All writes to a file (including propagation to lower precision
+        archives) are buffered in memory and then flushed as a few
+        coalesced ranges. Return a list of (path, update_time, error)
+        in the order of `batch`, `error` is None on success.
+        """
+        rs = []
+        for path, points in batch:
+            t1 = time.time()
+            try:
+                st = os.stat(path)
+                with self._open(path, 'r+b') as f:
+                    buf = WriteBuffer(f)
+                    self._update(buf, path, st, points, now, None)
+                    buf.flush()
+                self._after_update(path)
+            except Exception as e:
+                rs.append((path, None, e))
+            else:
+                rs.append((path, time.time() - t1, None))
+        return rs
+
+    def _update(self, fh, path, st, points, now, mtime):
         # order points by timestamp, newest first
         points.sort(key=operator.itemgetter(0), reverse=True)
-        mtime = mtime or int(os.stat(path).st_mtime)
-        with open(path, 'r+b') as f:
-            header = self.header(f)
-            if now is None:
-                now = int(time.time())
-            archive_list = header['archive_list']
-            i = 0
-            curr_archive = archive_list[i]
-            curr_points = []
-
-            for point in points:
-                age = now - point[0]
-
-                while age > curr_archive['retention']:
-                    # we can't fit any more points in archive i
-                    if curr_points:
-                        timestamp_range = (min(mtime, curr_points[-1][0]),
-                                           curr_points[0][0])
-                        self._update_archive(f, header, curr_archive,
-                                             curr_points, i, timestamp_range)
-                        curr_points = []
-                    try:
-                        curr_archive = archive_list[i+1]
-                        i += 1
-                    except IndexError:
-                        curr_archive = None
-                        break
-
-                if not curr_archive:
-                    # drop remaining points that don't fit in the database
+        mtime = mtime or int(st.st_mtime)
+        header = self._get_header(path, fh, st)
+        if now is None:
+            now = int(time.time())
+        archive_list = header['archive_list']
+        i = 0
+        curr_archive = archive_list[i]
+        curr_points = []
+
+        for point in points:
+            age = now - point[0]
+
+            while age > curr_archive['retention']:
+                # we can't fit any more points in archive i
+                if curr_points:
+                    timestamp_range = (min(mtime, curr_points[-1][0]),
+                                       curr_points[0][0])
+                    self._update_archive(fh, header, curr_archive,
+                                         curr_points, i, timestamp_range, now)
+                    curr_points = []
+                try:
+                    curr_archive = archive_list[i+1]
+                    i += 1
+                except IndexError:
+                    curr_archive = None
                     break
 
-                curr_points.append(point)
+            if not curr_archive:
+                # drop remaining points that don't fit in the database
+                break
+
+            curr_points.append(point)
 
-            if curr_archive and curr_points:
-                timestamp_range = (min(mtime, curr_points[-1][0]),
-                                   curr_points[0][0])
-                self._update_archive(f, header, curr_archive, curr_points, i,
-                                     timestamp_range)
+        if curr_archive and curr_points:
+            timestamp_range = (min(mtime, curr_points[-1][0]),
+                               curr_points[0][0])
+            self._update_archive(fh, header, curr_archive, curr_points, i,
+                                 timestamp_range, now)
 
-    def _update_archive(self, fh, header, archive, points, archive_idx, timestamp_range):
+    def _update_archive(self, fh, header, archive, points, archive_idx,
+                        timestamp_range, now):
         step = archive['sec_per_point']
         aligned_points = sorted((p[0] - (p[0] % step), p[1])
                                 for p in points if p)
         if not aligned_points:
             return
 
+        if archive['compressed']:
+            self._write_blocks(fh, header, archive, aligned_points)
+        elif archive['implicit_ts']:
+            self._write_rows(fh, header, archive, aligned_points)
+        else:
+            self._write_points(fh, header, archive, aligned_points)
+
+        # now we propagate the updates to lower-precision archives
+        archive_list = header['archive_list']
+        next_archive_idx = archive_idx + 1
+        if next_archive_idx < len(archive_list):
+            # update timestamp_range
+            time_start, time_end = timestamp_range
+            time_end = max(time_end, aligned_points[-1][0])
+            time_start = min(time_start, aligned_points[0][0])
+            timestamp_range = (time_start, time_end)
+            self._propagate(fh, header, archive, archive_list[next_archive_idx],
+                            timestamp_range, next_archive_idx, now)
+
+    def _write_points(self, fh, header, archive, aligned_points):
+        if archive['column_major']:
+            # take last val of duplicates
+            points = dict(aligned_points)
+            timestamps = np.array(sorted(points), dtype=np.int64)
+            rows = np.array([points[ts] for ts in timestamps], dtype=np.float64)
+            base_ts = self._read_base_point(fh, archive, header)[0]
+            slots = self._timestamp2slot(timestamps, base_ts or timestamps[0],
+                                         archive)
+            self._write_slots(fh, header, archive, timestamps, slots, rows)
+            return
+
         # create a packed string for each contiguous sequence of points
+        step = archive['sec_per_point']
         point_format = header['point_format']
         packed_strings = []
         curr_strings = []
@@ -460,35 +933,293 @@ class Storage(object):
             else:
                 fh.write(packed_str)
 
-        # now we propagate the updates to lower-precision archives
-        archive_list = header['archive_list']
-        next_archive_idx = archive_idx + 1
-        if next_archive_idx < len(archive_list):
-            # update timestamp_range
-            time_start, time_end = timestamp_range
-            time_end = max(time_end, aligned_points[-1][0])
-            time_start = min(time_start, aligned_points[0][0])
-            timestamp_range = (time_start, time_end)
-            self._propagate(fh, header, archive, archive_list[next_archive_idx],
-                            timestamp_range, next_archive_idx)
+    def _write_rows(self, fh, header, archive, aligned_points):
+        """
+        Write points to an archive without timestamps, slots skipped by
+        moving base timestamp forward are invalidated, points out of the
+        retention of base timestamp are dropped.
+        """
+        step = archive['sec_per_point']
+        cnt = archive['count']
+        base_ts, bitmap = self._read_validity(fh, archive)
+        old_packed = np.packbits(bitmap)
+
+        # take last val of duplicates
+        points = dict(aligned_points)
+        new_base_ts = max(base_ts, aligned_points[-1][0])
+        if base_ts and new_base_ts > base_ts:
+            skipped = min(cnt, (new_base_ts - base_ts) / step)
+            bitmap[(base_ts / step + 1 + np.arange(skipped)) % cnt] = False
+        oldest_ts = new_base_ts - (cnt - 1) * step
+        timestamps = np.array([ts for ts in sorted(points) if ts >= oldest_ts],
+                              dtype=np.int64)
+        rows = np.array([points[ts] for ts in timestamps], dtype=np.float64)
+        slots = self._timestamp2slot(timestamps, new_base_ts, archive)
+        bitmap[slots] = True
+        self._write_slots(fh, header, archive, timestamps, slots, rows)
+
+        if new_base_ts != base_ts:
+            fh.seek(archive['offset'])
+            fh.write(struct.pack(LONG_FORMAT, new_base_ts))
+        # only write changed bytes of bitmap
+        changed = np.nonzero(np.packbits(bitmap) != old_packed)[0]
+        if len(changed):
+            begin, end = changed[0], changed[-1] + 1
+            fh.seek(archive['offset'] + LONG_SIZE + begin)
+            fh.write(np.packbits(bitmap)[begin: end].tostring())
+
+    def _write_slots(self, fh, header, archive, timestamps, slots, rows):
+        """
+        Write points to slots of an archive without timestamps or a
+        column-major archive, each contiguous sequence of slots is
+        written at once (once per column for a column-major archive).
+        """
+        step = archive['sec_per_point']
+        value_dtype = header['value_dtype']
+        if archive['column_major']:
+            columns = np.array(rows, dtype=value_dtype).T
+        breaks = np.nonzero((np.diff(timestamps) != step) | (slots[1:] == 0))[0]
+        for run in np.split(np.arange(len(timestamps)), breaks + 1):
+            if not len(run):
+                continue
+            slot = slots[run[0]]
+            if not archive['column_major']:
+                fh.seek(archive['offset'] + archive['values_offset'] +
+                        slot * archive['row_size'])
+                fh.write(rows[run].astype(value_dtype).tostring())
+                continue
+            if not archive['implicit_ts']:
+                fh.seek(archive['offset'] + slot * LONG_SIZE)
+                fh.write(timestamps[run].astype('>u4').tostring())
+            begin, end = run[0], run[-1] + 1
+            for col, values in enumerate(columns):
+                fh.seek(self._column_offset(header, archive, col) +
+                        slot * header['value_size'])
+                fh.write(values[begin: end].tostring())
+
+    @staticmethod
+    def _column_offset(header, archive, col):
+        return (archive['offset'] + archive['values_offset'] +
+                col * archive['count'] * header['value_size'])
+
+    @staticmethod
+    def _read_column(fh, archive, offset, dtype, slot, n):
+        """
+        Read `n` (at most one round) items of the column at `offset` from
+        `slot`, wrap around to the beginning of the column if needed.
+        """
+        cnt = archive['count']
+        size = np.dtype(dtype).itemsize
+        assert n <= cnt
+        fh.seek(offset + slot * size)
+        if slot + n <= cnt:
+            data = fh.read(n * size)
+        else:
+            data = fh.read((cnt - slot) * size)
+            fh.seek(offset)
+            data += fh.read((slot + n - cnt) * size)
+        return np.frombuffer(data, dtype=dtype)
+
+    def _read_columns(self, fh, header, archive, slot, n, columns):
+        """
+        Return values of `columns` in `n` slots from `slot` of a
+        column-major archive, only these columns are read.
+        """
+        values = np.empty((n, len(columns)))
+        for i, col in enumerate(columns):
+            offset = self._column_offset(header, archive, col)
+            values[:, i] = self._read_column(fh, archive, offset,
+                                             header['value_dtype'], slot, n)
+        return values
+
+    @staticmethod
+    def _read_validity(fh, archive):
+        """
+        Return (base_ts, validity bitmap) of an archive without timestamps.
+        """
+        fh.seek(archive['offset'])
+        data = fh.read(LONG_SIZE + archive['bitmap_size'])
+        base_ts = struct.unpack(LONG_FORMAT, data[:LONG_SIZE])[0]
+        bitmap = np.unpackbits(np.frombuffer(data[LONG_SIZE:], dtype=np.uint8))
+        return base_ts, bitmap[:archive['count']].astype(bool)
+
+    def _read_rows(self, fh, header, archive, from_time, until_time,
+                   columns=None):
+        """
+        Return (timestamps, valid, rows) of slots in [from_time, until_time)
+        of an archive without timestamps, rows only contain `columns` if
+        it's not None.
+        """
+        step = archive['sec_per_point']
+        cnt = archive['count']
+        tag_cnt = len(header['tag_list'])
+        timestamps = np.arange(from_time, until_time, step, dtype=np.int64)
+        if not len(timestamps):
+            # equal begin and end offsets mean a full round when reading
+            col_cnt = tag_cnt if columns is None else len(columns)
+            return (timestamps, np.zeros(0, dtype=bool),
+                    np.empty((0, col_cnt), dtype=header['value_dtype']))
+        base_ts, bitmap = self._read_validity(fh, archive)
+        slots = self._timestamp2slot(timestamps, base_ts, archive)
+        in_round = ((timestamps <= base_ts) &
+                    (timestamps > base_ts - cnt * step))
+        valid = in_round & bitmap[slots]
+
+        if archive['column_major']:
+            if columns is None:
+                columns = range(tag_cnt)
+            # only slots of the last round are read
+            rows = np.empty((len(timestamps), len(columns)))
+            rows.fill(NULL_VALUE)
+            idxs = np.nonzero(in_round)[0]
+            if len(idxs):
+                begin, end = idxs[0], idxs[-1] + 1
+                rows[begin: end] = self._read_columns(
+                    fh, header, archive, slots[begin], end - begin, columns)
+            return timestamps, valid, rows
+
+        rows_region = {
+            'offset': archive['offset'] + archive['values_offset'],
+            'size': archive['row_size'] * cnt,
+        }
+        if len(timestamps) >= cnt:
+            fh.seek(rows_region['offset'])
+            series_str = fh.read(rows_region['size'])
+            rows = np.frombuffer(series_str, dtype=header['value_dtype'])
+            rows = rows.reshape(-1, tag_cnt)
+            rows = rows[slots]
+        else:
+            begin_offset = self._timestamp2offset(from_time, base_ts, header,
+                                                  archive)
+            end_offset = self._timestamp2offset(until_time, base_ts, header,
+                                                archive)
+            series_str = self._read_range(fh, rows_region, begin_offset,
+                                          end_offset)
+            rows = np.frombuffer(series_str, dtype=header['value_dtype'])
+            rows = rows.reshape(-1, tag_cnt)
+        if columns is not None and columns != range(tag_cnt):
+            rows = rows[:, columns]
+        return timestamps, valid, rows
+
+    def _write_blocks(self, fh, header, archive, aligned_points):
+        """
+        Merge points into the compressed blocks they belong to, a block
+        of last round of the archive is overwritten.
+        """
+        span = archive['sec_per_point'] * archive['block_points']
+        entries = self._read_block_entries(fh, archive)
+        for start_ts, block_points in groupby(aligned_points,
+                                              lambda p: p[0] - p[0] % span):
+            block_points = list(block_points)
+            timestamps = np.array([p[0] for p in block_points], dtype=np.int64)
+            # values are rounded to value type of the file
+            values = np.array([p[1] for p in block_points],
+                              dtype=header['value_dtype']).astype(np.float64)
+
+            block_idx = (start_ts / span) % archive['block_cnt']
+            entry = entries[block_idx]
+            if entry['ts'] == start_ts:
+                data = self._read_block(fh, header, entry)
+                old_timestamps, old_values = decode_block(
+                    data, len(header['tag_list']))
+                timestamps = np.concatenate([old_timestamps, timestamps])
+                values = np.concatenate([old_values, values])
+
+            # take last val of duplicates
+            timestamps, idxs = np.unique(timestamps[::-1], return_index=True)
+            data = encode_block(timestamps, values[::-1][idxs])
+            offset, capacity = int(entry['offset']), int(entry['capacity'])
+            if len(data) > capacity:
+                # move the block to end of file, with room to grow
+                capacity = max(len(data), min(2 * len(data),
+                                              archive['max_block_size']))
+                fh.seek(0, 2)
+                offset = fh.tell() - header['blocks_offset']
+                self._extend(fh, fh.tell() + capacity)
+            fh.seek(header['blocks_offset'] + offset)
+            fh.write(data)
+            fh.seek(archive['offset'] + block_idx * BLOCK_ENTRY_SIZE)
+            fh.write(struct.pack(BLOCK_ENTRY_FORMAT, start_ts, len(data),
+                                 offset, capacity))
+
+    @staticmethod
+    def _read_block_entries(fh, archive):
+        fh.seek(archive['offset'])
+        data = fh.read(archive['block_cnt'] * BLOCK_ENTRY_SIZE)
+        return np.frombuffer(data, dtype=BLOCK_ENTRY_DTYPE)
+
+    @staticmethod
+    def _read_block(fh, header, entry):
+        fh.seek(header['blocks_offset'] + int(entry['offset']))
+        return fh.read(int(entry['size']))
+
+    @staticmethod
+    def _extend(fh, size):
+        """
+        Extend the file to at least `size` bytes.
+        """
+        fh.seek(0, 2)
+        if fh.tell() < size:
+            fh.seek(size - 1)
+            fh.write('\x00')
+
+    def _read_blocks(self, fh, header, archive, from_time, until_time,
+                     columns=None):
+        """
+        Return (timestamps, values) of points in [from_time, until_time)
+        of a compressed archive, only blocks in the time range are read.
+        """
+        span = archive['sec_per_point'] * archive['block_points']
+        tag_cnt = len(header['tag_list'])
+        entries = self._read_block_entries(fh, archive)
+        ts_list = [np.empty(0, dtype=np.int64)]
+        val_list = [np.empty((0, tag_cnt if columns is None else len(columns)))]
+        for start_ts in xrange(from_time - from_time % span, until_time, span):
+            block_idx = (start_ts / span) % archive['block_cnt']
+            entry = entries[block_idx]
+            if entry['ts'] != start_ts:
+                continue
+            data = self._read_block(fh, header, entry)
+            timestamps, values = decode_block(data, tag_cnt, columns)
+            mask = (from_time <= timestamps) & (timestamps < until_time)
+            ts_list.append(timestamps[mask])
+            val_list.append(values[mask])
+        return np.concatenate(ts_list), np.concatenate(val_list)
 
     def _read_base_point(self, fh, archive, header):
         fh.seek(archive['offset'])
+        if archive['column_major']:
+            return struct.unpack(LONG_FORMAT, fh.read(LONG_SIZE))
         base_point = fh.read(header['point_size'])
         return struct.unpack(header['point_format'], base_point)
 
     def _timestamp2offset(self, ts, base_ts, header, archive):
+        if archive['implicit_ts']:
+            slot = self._timestamp2slot(ts, base_ts, archive)
+            return (archive['offset'] + archive['values_offset'] +
+                    slot * archive['row_size'])
         time_distance = ts - base_ts
         point_distince = time_distance / archive['sec_per_point']
         byte_distince =  point_distince * header['point_size']
         return archive['offset'] + (byte_distince % archive['size'])
 
+    @staticmethod
+    def _timestamp2slot(ts, base_ts, archive):
+        """
+        Slot index of `ts` in an uncompressed archive, `ts` can be an array.
+        """
+        step = archive['sec_per_point']
+        if archive['implicit_ts']:
+            return ts // step % archive['count']
+        return (ts - base_ts) // step % archive['count']
+
     @staticmethod
     def get_propagate_timeunit(low_sec_per_point, high_sec_per_point, xff):
         num_point = low_sec_per_point / high_sec_per_point
         return int(math.ceil(num_point * xff)) * high_sec_per_point
 
-    def _propagate(self, fh, header, higher, lower, timestamp_range, lower_idx):
+    def _propagate(self, fh, header, higher, lower, timestamp_range, lower_idx,
+                   now):
         """
         propagte update to low precision archives.
         """
@@ -507,178 +1238,491 @@ class Storage(object):
         else:
             lower_interval_end = roundup(until_time, lower['sec_per_point'])
             lower_interval_start = from_time - from_time % lower['sec_per_point']
+        # points older than retention of the higher archive (as of `now`)
+        # may be overwritten and none of them is updated, keep lower
+        # points aggregated only from them
+        oldest = max(now, lower_interval_end) - higher['retention']
+        lower_interval_start = max(lower_interval_start,
+                                   oldest - oldest % lower['sec_per_point'])
+        if lower_interval_start >= lower_interval_end:
+            return False
 
-        fh.seek(higher['offset'])
-        packed_base_interval = fh.read(LONG_SIZE)
-        higher_base_interval = struct.unpack(LONG_FORMAT, packed_base_interval)[0]
-
-        if higher_base_interval == 0:
-            higher_first_offset = higher['offset']
-        else:
-            higher_first_offset = self._timestamp2offset(lower_interval_start,
-                                                         higher_base_interval,
-                                                         header,
-                                                         higher)
-
-        higher_point_num = (lower_interval_end - lower_interval_start) / higher['sec_per_point']
-        higher_size = higher_point_num * header['point_size']
-        relative_first_offset = higher_first_offset - higher['offset']
-        relative_last_offset = (relative_first_offset + higher_size) % higher['size']
-        higher_last_offset = relative_last_offset + higher['offset']
-
-        # get unpacked series str
-        # TODO: abstract this to a function
-        fh.seek(higher_first_offset)
-        if higher_first_offset < higher_last_offset:
-            series_str = fh.read(higher_last_offset - higher_first_offset)
-        else:
-            higher_end = higher['offset'] + higher['size']
-            series_str = fh.read(higher_end - higher_first_offset)
-            fh.seek(higher['offset'])
-            series_str += fh.read(higher_last_offset - higher['offset'])
-
-        # now we unpack the series data we just read
-        point_format = header['point_format']
-        byte_order, point_type = point_format[0], point_format[1:]
-        point_num = len(series_str) / header['point_size']
+        tag_cnt = len(header['tag_list'])
+        points = self._read_slots(fh, header, higher, lower_interval_start,
+                                  lower_interval_end)
+        point_num = len(points)
         # assert point_num == higher_point_num
-        series_format = byte_order + (point_type * point_num)
-        unpacked_series = struct.unpack(series_format, series_str)
 
-        # and finally we construct a list of values
-        point_cnt = (lower_interval_end - lower_interval_start) / lower['sec_per_point']
-        tag_cnt = len(header['tag_list'])
-        step = tag_cnt + 1
+        # and finally we construct a list of values, every `agg_cnt` higher
+        # points (counted from the newest one) are aggregated to a lower
+        # point, so the oldest group is padded with empty points if needed.
         agg_cnt = lower['sec_per_point'] / higher['sec_per_point']
-        step = (tag_cnt + 1) * agg_cnt
-        lower_points = [None] * point_cnt
-
-        unpacked_series = unpacked_series[::-1]
-        ts = lower_interval_end
-        for i in xrange(0, len(unpacked_series), step):
-            higher_points = unpacked_series[i: i+step]
-            ts -= higher['sec_per_point'] * agg_cnt
-            agg_value = self._get_agg_value(higher_points, tag_cnt, header['agg_id'],
-                                            lower_interval_start, lower_interval_end)
-            lower_points[i/step] = (ts, agg_value)
-
-        lower_points = [x for x in lower_points if x and x[0]]  # filter zero item
+        point_cnt = (point_num + agg_cnt - 1) / agg_cnt
+        padding = point_cnt * agg_cnt - point_num
+
+        timestamps = np.zeros(point_cnt * agg_cnt, dtype=np.int64)
+        timestamps[padding:] = points['ts']
+        values = np.empty((point_cnt * agg_cnt, tag_cnt))
+        values[padding:] = points['val']
+
+        agg_values = self._get_agg_value(
+            timestamps.reshape(point_cnt, agg_cnt),
+            values.reshape(point_cnt, agg_cnt, tag_cnt),
+            header['agg_id'], lower_interval_start, lower_interval_end)
+
+        first_ts = lower_interval_end - point_cnt * lower['sec_per_point']
+        lower_points = [(first_ts + i * lower['sec_per_point'], val)
+                        for i, val in enumerate(agg_values.tolist())]
         timestamp_range = (lower_interval_start, max(lower_interval_end, until_time))
         self._update_archive(fh, header, lower, lower_points, lower_idx,
-                             timestamp_range)
-
-    def _get_agg_value(self, higher_points, tag_cnt, agg_id, ts_start, ts_end):
-        higher_points = higher_points[::-1]
-        agg_func = Agg.get_agg_func(agg_id)
-        step = tag_cnt + 1
+                             timestamp_range, now)
 
+    def _read_slots(self, fh, header, archive, from_time, until_time):
         """
-        points format:
-        t1 v11 v12
-        t2 v21 v22
-        t3 v31 v32
+        Return points in slots of [from_time, until_time) as an array of
+        point dtype, timestamp of a slot without a point in the range
+        is 0.
         """
-        points = [higher_points[i: i+step]
-                  for i in xrange(0, len(higher_points), step)]
-        valid_points = self.filter_points_by_time(points, ts_start, ts_end)
-        if not valid_points:
-            val = [NULL_VALUE] * tag_cnt
+        tag_cnt = len(header['tag_list'])
+        point_dtype = self.get_point_dtype(tag_cnt, header['value_dtype'])
+        sec_per_point = archive['sec_per_point']
+        point_num = (until_time - from_time) / sec_per_point
+        if point_num <= 0:
+            return np.zeros(0, dtype=point_dtype)
+
+        if archive['compressed']:
+            points = np.zeros(point_num, dtype=point_dtype)
+            point_ts, values = self._read_blocks(fh, header, archive,
+                                                 from_time, until_time)
+            idxs = (point_ts - from_time) // sec_per_point
+            points['ts'][idxs] = point_ts
+            points['val'][idxs] = values
+            return points
+
+        if archive['implicit_ts']:
+            points = np.zeros(point_num, dtype=point_dtype)
+            timestamps, valid, rows = self._read_rows(fh, header, archive,
+                                                      from_time, until_time)
+            points['ts'][valid] = timestamps[valid]
+            points['val'] = rows
+            return points
+
+        # only the last round of the range is read, and slots holding
+        # points of other rounds are dropped
+        n = min(point_num, archive['count'])
+        start_time = from_time + (point_num - n) * sec_per_point
+        points = np.zeros(point_num, dtype=point_dtype)
+        last_round = points[point_num - n:]
+        base_ts = self._read_base_point(fh, archive, header)[0]
+        if archive['column_major']:
+            slot = self._timestamp2slot(start_time, base_ts, archive) if base_ts else 0
+            last_round['ts'] = self._read_column(fh, archive, archive['offset'],
+                                                 '>u4', slot, n)
+            last_round['val'] = self._read_columns(fh, header, archive, slot,
+                                                   n, range(tag_cnt))
         else:
-            points = np.array(valid_points)
-            points = points.transpose()
-            val = [agg_func(self.filter_values(x)) for x in points[1:]]
-        return val
+            if base_ts == 0:
+                first_offset = archive['offset']
+            else:
+                first_offset = self._timestamp2offset(start_time, base_ts,
+                                                      header, archive)
+            size = n * header['point_size']
+            relative_first_offset = first_offset - archive['offset']
+            relative_last_offset = (relative_first_offset + size) % archive['size']
+            last_offset = relative_last_offset + archive['offset']
+
+            # get unpacked series str
+            series_str = self._read_range(fh, archive, first_offset, last_offset)
+            last_round[:] = np.frombuffer(series_str, dtype=point_dtype)
+        expected_ts = start_time + np.arange(n) * sec_per_point
+        last_round['ts'][last_round['ts'] != expected_ts] = 0
+        return points
+
+    def _get_agg_value(self, timestamps, values, agg_id, ts_start, ts_end):
+        """
+        Aggregate a block of higher points to lower points.
 
-    @staticmethod
-    def filter_points_by_time(points, ts_start, ts_end):
-        return [p for p in points if ts_start <= p[0] < ts_end]
+        `timestamps` has shape (lower_point_cnt, agg_cnt) and `values` has
+        shape (lower_point_cnt, agg_cnt, tag_cnt), points out of
+        [ts_start, ts_end) and null values are ignored.
+        """
+        valid_points = (ts_start <= timestamps) & (timestamps < ts_end)
+        mask = valid_points[:, :, np.newaxis] & (values != NULL_VALUE)
+        return Agg.aggregate_array(agg_id, values, mask)
 
-    @staticmethod
-    def filter_values(points):
-        rs = [p for p in points if p != NULL_VALUE]
-        return rs if rs else [NULL_VALUE]
-
-    def fetch(self, path, from_time, until_time=None, now=None):
-        with open(path, 'rb') as f:
-            header = self.header(f)
-
-            # validate timestamp
-            if now is None:
-                now = int(time.time())
-            if until_time is None:
-                until_time = now
-            if from_time >= until_time:
-                raise InvalidTime("from_time '%s' is after unitl_time '%s'" %
-                                  (from_time, until_time))
-
-            oldest_time = now - header['max_retention']
-            if from_time > now:
-                return None
-            if until_time < oldest_time:
-                return None
+    def fetch(self, path, from_time, until_time=None, now=None, columns=None):
+        """
+        `columns` is a list of tags or tag positions, only values of
+        these columns are returned if it's not None.
+        """
+        return self._fetch(path, from_time, until_time, now,
+                           self._archive_fetch, columns)
 
-            until_time = min(now, until_time)
-            from_time = max(oldest_time, from_time)
+    def fetch_array(self, path, from_time, until_time=None, now=None,
+                    columns=None):
+        """
+        Same as `fetch`, but values are returned as a numpy array of
+        shape (point_cnt, column_cnt), null values are NaN.
+        """
+        return self._fetch(path, from_time, until_time, now,
+                           self._archive_fetch_array, columns)
 
-            diff = now - from_time
-            for archive in header['archive_list']:
-                if archive['retention'] >= diff:
-                    break
+    def fetch_many(self, paths, from_time, until_time=None, now=None,
+                   link_dir=None, threads=DEFAULT_FETCH_THREADS):
+        """
+        Fetch many metrics, return {path: (time_info, values)}, `values`
+        is a list of the metric's values, null values are None.
+
+        `paths` are metric links (or metric names in `link_dir`), they
+        are grouped by real file, each file is read once and files are
+        fetched by a thread pool. If a path is a data file (or a link
+        outside a link dir), `values` is a list of tuples of all its
+        tags like `fetch`. Result is None if the time range is out of
+        retention or the metric is not found.
+        """
+        if now is None:
+            now = int(time.time())
+        groups = OrderedDict()
+        for path in paths:
+            if link_dir is not None:
+                metric = path
+                link = os.path.join(link_dir, path.replace('.', os.sep) + '.hs')
+            else:
+                metric = get_metric(path)
+                link = path
+            groups.setdefault(os.path.realpath(link), []).append((path, metric))
+
+        def fetch_group(item):
+            real_path, path_metrics = item
+            return self._fetch_group(real_path, path_metrics, from_time,
+                                     until_time, now)
+
+        threads = min(threads, len(groups))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                group_rs = pool.map(fetch_group, groups.items())
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            group_rs = map(fetch_group, groups.items())
+
+        rs = {}
+        for r in group_rs:
+            rs.update(r)
+        return rs
+
+    def _fetch_group(self, real_path, path_metrics, from_time, until_time, now):
+        """
+        Fetch metrics in the same file `real_path`.
+        """
+        rs = dict((path, None) for path, _ in path_metrics)
+        if not os.path.exists(real_path):
+            return rs
+        with self._open(real_path, 'rb') as f:
+            header = self._get_header(real_path, f)
+            fetched = self._fetch_columns(f, header, path_metrics, from_time,
+                                          until_time, now)
+        if fetched is None:
+            return rs
+        time_info, val_array, path_columns, col_idxs = fetched
+        for path, col in path_columns:
+            if col is None:
+                rs[path] = (time_info, self._conver_null_value(val_array))
+            else:
+                vals = val_array[:, col_idxs[col]]
+                values = vals.astype(object)
+                values[np.isnan(vals)] = None
+                rs[path] = (time_info, values.tolist())
+        return rs
+
+    def _fetch_columns(self, f, header, path_metrics, from_time, until_time,
+                       now):
+        """
+        Fetch columns of `path_metrics` in an opened file, return
+        (time_info, val_array, path_columns, col_idxs) or None.
+        """
+        tag_list = header['tag_list']
+
+        # column position of each path, None for all columns
+        path_columns = []
+        for path, metric in path_metrics:
+            if metric is None:
+                path_columns.append((path, None))
+            elif metric in tag_list:
+                path_columns.append((path, tag_list.index(metric)))
+        if not path_columns:
+            return None
+
+        # only decode needed columns unless a whole file is fetched
+        if any(col is None for _, col in path_columns):
+            columns = None
+            col_idxs = dict((i, i) for i in range(len(tag_list)))
+        else:
+            columns = sorted(set(col for _, col in path_columns))
+            col_idxs = dict((col, i) for i, col in enumerate(columns))
+        fetched = self._fetch_file(f, header, from_time, until_time, now,
+                                   self._archive_fetch_array, columns)
+        if fetched is None:
+            return None
+        _, time_info, val_array = fetched
+        return time_info, val_array, path_columns, col_idxs
+
+    def _fetch(self, path, from_time, until_time, now, archive_fetch,
+               columns=None):
+        with self._open(path, 'rb') as f:
+            header = self._get_header(path, f)
+            return self._fetch_file(f, header, from_time, until_time, now,
+                                    archive_fetch, columns)
+
+    def _fetch_file(self, f, header, from_time, until_time, now,
+                    archive_fetch, columns=None):
+        # validate timestamp
+        if now is None:
+            now = int(time.time())
+        if until_time is None:
+            until_time = now
+        if from_time >= until_time:
+            raise InvalidTime("from_time '%s' is after unitl_time '%s'" %
+                              (from_time, until_time))
+
+        oldest_time = now - header['max_retention']
+        if from_time > now:
+            return None
+        if until_time < oldest_time:
+            return None
+
+        until_time = min(now, until_time)
+        from_time = max(oldest_time, from_time)
+
+        diff = now - from_time
+        for archive in header['archive_list']:
+            if archive['retention'] >= diff:
+                break
 
-            return self._archive_fetch(f, header, archive, from_time, until_time)
+        columns = self._get_columns(header, columns)
+        return archive_fetch(f, header, archive, from_time, until_time,
+                             columns)
 
-    def _archive_fetch(self, fh, header, archive, from_time, until_time):
+    @staticmethod
+    def _get_columns(header, columns):
+        """
+        Convert tags in `columns` to tag positions.
+        """
+        tag_list = header['tag_list']
+        if columns is None:
+            return range(len(tag_list))
+        rs = []
+        for col in columns:
+            if isinstance(col, basestring):
+                try:
+                    col = tag_list.index(col)
+                except ValueError:
+                    raise KenshinException("tag '%s' not found" % col)
+            elif not 0 <= col < len(tag_list):
+                raise KenshinException("tag position %s out of range" % col)
+            rs.append(col)
+        return rs
+
+    def _archive_fetch(self, fh, header, archive, from_time, until_time,
+                       columns):
+        header, time_info, val_array = self._archive_fetch_array(
+            fh, header, archive, from_time, until_time, columns)
+        return header, time_info, self._conver_null_value(val_array)
+
+    def _archive_fetch_array(self, fh, header, archive, from_time, until_time,
+                             columns):
         from_time = roundup(from_time, archive['sec_per_point'])
         until_time = roundup(until_time, archive['sec_per_point'])
+        sec_per_point = archive['sec_per_point']
         tag_cnt = len(header['tag_list'])
-        null_point = (None,) * tag_cnt
+        time_info = (from_time, until_time, sec_per_point)
+
+        if archive['compressed']:
+            cnt = (until_time - from_time) / sec_per_point
+            val_array = np.full((cnt, len(columns)), np.nan)
+            point_ts, values = self._read_blocks(fh, header, archive, from_time,
+                                                 until_time, columns)
+            val_array[(point_ts - from_time) // sec_per_point] = values
+            val_array[val_array == NULL_VALUE] = np.nan
+            return header, time_info, val_array
+
+        if archive['implicit_ts']:
+            _, valid, rows = self._read_rows(fh, header, archive, from_time,
+                                             until_time, columns)
+            val_array = np.where(valid[:, np.newaxis], rows, np.nan)
+            val_array[val_array == NULL_VALUE] = np.nan
+            return header, time_info, val_array
 
         base_point = self._read_base_point(fh, archive, header)
         base_ts = base_point[0]
 
         if base_ts == 0:
-            step = archive['sec_per_point']
-            cnt = (until_time - from_time) / step
-            time_info = (from_time, until_time, step)
-            val_list = [null_point] * cnt
-            return (header, time_info, val_list)
-
-        from_offset = self._timestamp2offset(from_time, base_ts, header, archive)
-        until_offset = self._timestamp2offset(until_time, base_ts, header, archive)
-
-        fh.seek(from_offset)
-        if from_offset < until_offset:
-            series_str = fh.read(until_offset - from_offset)
+            cnt = (until_time - from_time) / sec_per_point
+            return header, time_info, np.full((cnt, len(columns)), np.nan)
+
+        if archive['column_major']:
+            # only timestamps and the selected columns are read
+            slot = self._timestamp2slot(from_time, base_ts, archive)
+            until_slot = self._timestamp2slot(until_time, base_ts, archive)
+            cnt = (until_slot - slot) % archive['count'] or archive['count']
+            point_ts = self._read_column(fh, archive, archive['offset'], '>u4',
+                                         slot, cnt).astype(np.int64)
+            values = self._read_columns(fh, header, archive, slot, cnt,
+                                        columns)
         else:
-            archive_end = archive['offset'] + archive['size']
-            series_str = fh.read(archive_end - from_offset)
-            fh.seek(archive['offset'])
-            series_str += fh.read(until_offset - archive['offset'])
+            from_offset = self._timestamp2offset(from_time, base_ts, header, archive)
+            until_offset = self._timestamp2offset(until_time, base_ts, header, archive)
+            series_str = self._read_range(fh, archive, from_offset, until_offset)
+
+            ## unpack series string
+            # 'val' is a strided view, only the selected columns are decoded
+            points = np.frombuffer(series_str, dtype=self.get_point_dtype(
+                tag_cnt, header['value_dtype']))
+            cnt = len(points)
+            point_ts = points['ts'].astype(np.int64)
+            if columns == range(tag_cnt):
+                values = points['val']
+            else:
+                values = points['val'][:, columns]
 
-        ## unpack series string
-        point_format = header['point_format']
-        byte_order, point_type = point_format[0], point_format[1:]
-        cnt = len(series_str) / header['point_size']
-        series_format = byte_order + point_type * cnt
-        unpacked_series = struct.unpack(series_format, series_str)
-
-        ## construct value list
-        # pre-allocate entire list or speed
-        val_list = [null_point] * cnt
-        step = tag_cnt + 1
-        sec_per_point = archive['sec_per_point']
-        for i in xrange(0, len(unpacked_series), step):
-            point_ts = unpacked_series[i]
-            if from_time <= point_ts < until_time:
-                val = unpacked_series[i+1: i+step]
-                idx = (point_ts - from_time) / sec_per_point
-                val_list[idx] = self._conver_null_value(val)
+        ## construct value array
+        # put every point in its slot by timestamp, points out of
+        # the time range are from last round of the archive.
+        val_array = np.full((cnt, len(columns)), np.nan)
+        mask = (from_time <= point_ts) & (point_ts < until_time)
+        idxs = (point_ts[mask] - from_time) // sec_per_point
+        val_array[idxs] = values[mask]
+        val_array[val_array == NULL_VALUE] = np.nan
 
-        time_info = (from_time, until_time, sec_per_point)
-        return header, time_info, val_list
+        return header, time_info, val_array
+
+    @staticmethod
+    def get_point_dtype(tag_cnt, value_dtype='>f8'):
+        """
+        Numpy dtype of a packed point, same layout as POINT_FORMAT.
+        """
+        return np.dtype([('ts', '>u4'), ('val', value_dtype, (tag_cnt,))])
+
+    @staticmethod
+    def _conver_null_value(val_array):
+        """
+        Convert value array to a list of tuples, NaN is converted to None.
+        """
+        vals = val_array.astype(object)
+        vals[np.isnan(val_array)] = None
+        return map(tuple, vals.tolist())
+
+### Memory-mapped storage
+
+class MappedFile(object):
+    """
+    A memory-mapped kenshin file, `ident` is used to detect that the
+    file has been replaced (e.g. `Storage.add_tag` rename a new file
+    to the path) or resized since it was mapped.
+    """
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.closed = False
+        access = mmap.ACCESS_WRITE if os.access(path, os.W_OK) else mmap.ACCESS_READ
+        mode = 'r+b' if access == mmap.ACCESS_WRITE else 'rb'
+        with open(path, mode) as f:
+            self.ident = self.get_ident(os.fstat(f.fileno()))
+            self.mm = mmap.mmap(f.fileno(), 0, access=access)
 
     @staticmethod
-    def _conver_null_value(point_val):
-        val = [None if x == NULL_VALUE else x
-               for x in point_val]
-        return tuple(val)
+    def get_ident(st):
+        return st.st_dev, st.st_ino, st.st_size
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.mm.close()
+                self.closed = True
+
+
+class MmapStorage(Storage):
+    """
+    Storage engine that maps each file once and reads or writes archive
+    ranges through the mapping, so an update or fetch doesn't need any
+    seek/read/write syscalls.
+
+    At most `max_files` files are kept mapped, the least recently used one
+    is unmapped when the limit is reached.
+    """
+
+    def __init__(self, data_dir='', max_files=1024):
+        Storage.__init__(self, data_dir)
+        self.max_files = max_files
+        self.lock = Lock()
+        self.mapped_files = OrderedDict()
+
+    def _get_mapped_file(self, path):
+        ident = MappedFile.get_ident(os.stat(path))
+        with self.lock:
+            mapped = self.mapped_files.pop(path, None)
+            if mapped is not None and mapped.ident != ident:
+                mapped.close()
+                mapped = None
+            if mapped is None:
+                mapped = MappedFile(path)
+                while len(self.mapped_files) >= self.max_files:
+                    _, oldest = self.mapped_files.popitem(last=False)
+                    oldest.close()
+            self.mapped_files[path] = mapped
+            return mapped
+
+    @contextmanager
+    def _open(self, path, mode='rb'):
+        while True:
+            mapped = self._get_mapped_file(path)
+            with mapped.lock:
+                # the file may be unmapped by another thread
+                # before we get the lock.
+                if mapped.closed:
+                    continue
+                mapped.mm.seek(0)
+                yield mapped.mm
+                return
+
+    @staticmethod
+    def _read_range(fh, archive, begin_offset, end_offset):
+        if not isinstance(fh, mmap.mmap):
+            return Storage._read_range(fh, archive, begin_offset, end_offset)
+        if begin_offset < end_offset:
+            # no copy, the buffer is only valid before the file is unmapped.
+            return buffer(fh, begin_offset, end_offset - begin_offset)
+        else:
+            archive_end = archive['offset'] + archive['size']
+            return fh[begin_offset: archive_end] + fh[archive['offset']: end_offset]
+
+    @staticmethod
+    def _extend(fh, size):
+        mm = fh.fh if isinstance(fh, WriteBuffer) else fh
+        if not isinstance(mm, mmap.mmap):
+            return Storage._extend(fh, size)
+        # a mapping can't be written beyond its length
+        if len(mm) < size:
+            mm.resize(size)
+
+    def _after_update(self, path):
+        # writing through the mapping doesn't reliably update mtime,
+        # which is used as the start of the propagation range.
+        os.utime(path, None)
+        Storage._after_update(self, path)
+
+    def close(self, path=None):
+        """
+        Unmap `path`, or all mapped files if `path` is None.
+        """
+        with self.lock:
+            if path is None:
+                mapped_files = self.mapped_files.values()
+                self.mapped_files.clear()
+            else:
+                mapped = self.mapped_files.pop(path, None)
+                mapped_files = [mapped] if mapped else []
+        for mapped in mapped_files:
+            mapped.close()
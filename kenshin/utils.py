@@ -5,11 +5,16 @@ import errno
 
 
 def get_metric(path):
+    """
+    Return metric name of a link in rurouni's link dir, None if `path`
+    is a data file or a link elsewhere.
+    """
     import re
     abspath = os.path.abspath(path)
     realpath = os.path.realpath(path)
-    if abspath != realpath:
-        metric = re.split('/link/[a-z]/', abspath)[1]
+    parts = re.split('/link/[a-z]/', abspath)
+    if abspath != realpath and len(parts) > 1:
+        metric = parts[1]
         metric = metric[:-3]  # remove .hs
         metric = metric.replace('/', '.')
     else:
@@ -27,6 +32,40 @@ def mkdir_p(path):
             raise
 
 
+def fallocate(fd, offset, length):
+    """
+    Preallocate disk space of [offset, offset+length) for `fd`.
+
+    os.posix_fallocate is only available in python 3.3+, so libc's
+    posix_fallocate is called through ctypes. If neither is available,
+    the file is only extended, and left sparse.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, offset, length)
+        return
+
+    global _libc_fallocate
+    if _libc_fallocate is None:
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _libc_fallocate = libc.posix_fallocate
+            _libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                        ctypes.c_int64]
+        except (OSError, AttributeError):
+            _libc_fallocate = False
+
+    if _libc_fallocate:
+        err = _libc_fallocate(fd, offset, length)
+        if err:
+            raise OSError(err, os.strerror(err))
+    elif os.fstat(fd).st_size < offset + length:
+        os.ftruncate(fd, offset + length)
+
+_libc_fallocate = None
+
+
 def roundup(x, base):
     """
     Roundup to nearest multiple of `base`.
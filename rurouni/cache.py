@@ -1,14 +1,26 @@
 # coding: utf-8
 import os
+import glob
 import time
+import zlib
 from threading import Lock
+from collections import deque
+
+import numpy as np
 
 import kenshin
+from kenshin.agg import Agg
 from kenshin.consts import NULL_VALUE
+from kenshin.utils import roundup
 from rurouni import log
 from rurouni.conf import settings
+from rurouni.index import (
+    MetricIndex, loadBinaryIndex, iterTextIndex, writeBinaryIndex,
+    getBinaryIndexPath, getTextIndexState
+)
 from rurouni.storage import (
-    getFilePath, createLink, StorageSchemas, rebuildIndex, rebuildLink
+    getFilePath, getMetricPath, createLink, StorageSchemas, rebuildIndex,
+    rebuildLink
 )
 
 
@@ -18,7 +30,14 @@ class MetricCache(object):
     """
     def __init__(self):
         self.lock = Lock()
-        self.metric_idxs = {}
+        # only creating new metrics needs this lock, looking up
+        # existing metrics is lock free.
+        self.create_lock = Lock()
+        # metrics waiting for their files to be created by creator thread
+        self.pending_creates = deque()
+        self.metric_idxs = MetricIndex()
+        self.index_file = None
+        self.wal = None
         self.schema_caches = {}
         self.metrics_fh = None
         self.storage_schemas = None
@@ -36,43 +55,76 @@ class MetricCache(object):
                 settings.LOCAL_LINK_DIR, settings.instance)
 
             if os.path.exists(instance_data_dir):
+                # don't fork a process pool inside the daemon
                 if not os.path.exists(index_file):
-                    rebuildIndex(instance_data_dir, index_file)
+                    rebuildIndex(instance_data_dir, index_file, processes=1)
                 if not os.path.exists(instance_link_dir):
-                    rebuildLink(instance_data_dir, instance_link_dir)
+                    rebuildLink(instance_data_dir, instance_link_dir,
+                                processes=1)
 
             self._initCache(index_file)
 
+        if settings.ENABLE_WAL and self.wal is None:
+            self._replayWal()
+
+    def _replayWal(self):
+        from rurouni.wal import WriteAheadLog
+        self.wal = WriteAheadLog(settings.WAL_DIR, settings.WAL_SEGMENT_SIZE)
+        cnt = 0
+        for names, records in self.wal.replay():
+            self.put_array(names, records['id'], records['ts'], records['val'])
+            cnt += len(records)
+        log.msg('replayed %d datapoints from WAL %s' % (cnt, settings.WAL_DIR))
+        self.wal.open()
+
     def _initCache(self, index_file):
         # avoid repeated call
         if self.metrics_fh is not None:
             return
 
         self._initStorageSchemas()
+        text_offset = 0
+        binary_index = loadBinaryIndex(index_file)
+        if binary_index is not None:
+            # only positions of each file are loaded, metrics are
+            # looked up in the mapped binary index.
+            for schema_name, file_idx, bitmap in binary_index.iterFiles():
+                schema = self.storage_schemas.getSchemaByName(schema_name)
+                schema_cache = self.getSchemaCache(schema)
+                schema_cache.addBitmap(schema, file_idx, bitmap)
+            self.metric_idxs = MetricIndex(binary_index)
+            text_offset = binary_index.text_size
+
         if os.path.exists(index_file):
-            MAX_ALLOW_ERR_LINE = 1
-            err_line_cnt = 0
-            with open(index_file) as f:
-                for line in f:
-                    line = line.strip('\n')
-                    try:
-                        metric, schema_name, file_idx, file_pos = line.split(" ")
-                        file_idx = int(file_idx)
-                        file_pos = int(file_pos)
-                    except Exception as e:
-                        if err_line_cnt < MAX_ALLOW_ERR_LINE:
-                            err_line_cnt += 1
-                            continue
-                        else:
-                            raise Exception('Index file has many error: %s' % e)
-
-                    schema = self.storage_schemas.getSchemaByName(schema_name)
-                    schema_cache = self.getSchemaCache(schema)
-                    schema_cache.add(schema, file_idx, file_pos)
-                    self.metric_idxs[metric] = (schema.name, file_idx, file_pos)
+            # replay metrics not in binary index
+            for metric, schema_name, file_idx, file_pos in \
+                    iterTextIndex(index_file, text_offset):
+                schema = self.storage_schemas.getSchemaByName(schema_name)
+                schema_cache = self.getSchemaCache(schema)
+                schema_cache.add(schema, file_idx, file_pos)
+                self.metric_idxs[metric] = (schema.name, file_idx, file_pos)
 
+        self.index_file = index_file
         self.metrics_fh = open(index_file, 'a')
 
+    def compactIndex(self):
+        """
+        Compact metrics to binary index, so that the text index needn't
+        to be parsed in next startup.
+        """
+        with self.create_lock:
+            if self.metrics_fh is None:
+                return
+            self.metrics_fh.flush()
+            text_state = getTextIndexState(self.index_file)
+            pending = set(m for m, _, _, _ in self.pending_creates)
+            entries = ((metric, schema_name, file_idx, pos_idx)
+                       for metric, (schema_name, file_idx, pos_idx)
+                       in self.metric_idxs.iteritems()
+                       if metric not in pending)
+            writeBinaryIndex(getBinaryIndexPath(self.index_file), entries,
+                             text_state)
+
     def _initStorageSchemas(self):
         if self.storage_schemas is None:
             conf_file = os.path.join(settings.CONF_DIR, 'storage-schemas.conf')
@@ -80,35 +132,175 @@ class MetricCache(object):
 
     def put(self, metric, datapoint):
         log.debug("MetricCache received (%s, %s)" % (metric, datapoint))
-        (schema_name, file_idx, pos_idx) = self.getMetricIdx(metric)
+        metric_idx = self.getMetricIdx(metric)
+        if metric_idx is None:
+            return
+        (schema_name, file_idx, pos_idx) = metric_idx
         file_cache = self.schema_caches[schema_name][file_idx]
         file_cache.put(pos_idx, datapoint)
 
+    def put_many(self, datapoints):
+        """
+        Put a batch of (metric, datapoint), indexes are resolved at once
+        and datapoints are put to each file cache in one go.
+        """
+        metric_idxs = self.getMetricIdxs(set(m for m, _ in datapoints))
+        file_cache_points = {}
+        for metric, datapoint in datapoints:
+            if metric_idxs[metric] is None:
+                continue
+            (schema_name, file_idx, pos_idx) = metric_idxs[metric]
+            points = file_cache_points.setdefault((schema_name, file_idx), [])
+            points.append((pos_idx, datapoint))
+
+        for (schema_name, file_idx), points in file_cache_points.iteritems():
+            file_cache = self.schema_caches[schema_name][file_idx]
+            file_cache.put_many(points)
+
+    def put_array(self, metrics, metric_ids, timestamps, values):
+        """
+        Put datapoints in arrays, the i-th datapoint is
+        (metrics[metric_ids[i]], (timestamps[i], values[i])).
+        """
+        metric_idxs = self.getMetricIdxs(set(metrics))
+        file_caches = []
+        file_cache_ids = {}
+        # file cache id and pos_idx of each metric, -1 if dropped
+        metric_files = np.empty(len(metrics), dtype=np.int64)
+        metric_pos = np.zeros(len(metrics), dtype=np.int64)
+        for i, metric in enumerate(metrics):
+            if metric_idxs[metric] is None:
+                metric_files[i] = -1
+                continue
+            (schema_name, file_idx, pos_idx) = metric_idxs[metric]
+            key = (schema_name, file_idx)
+            if key not in file_cache_ids:
+                file_cache_ids[key] = len(file_caches)
+                file_caches.append(self.schema_caches[schema_name][file_idx])
+            metric_files[i] = file_cache_ids[key]
+            metric_pos[i] = pos_idx
+
+        point_files = metric_files[metric_ids]
+        # stable sort keeps the order of datapoints in each file cache
+        order = np.argsort(point_files, kind='mergesort')
+        sorted_files = point_files[order]
+        file_ids = np.arange(len(file_caches))
+        starts = np.searchsorted(sorted_files, file_ids, side='left')
+        ends = np.searchsorted(sorted_files, file_ids, side='right')
+        for file_cache, start, end in zip(file_caches, starts, ends):
+            sel = order[start: end]
+            file_cache.put_array(metric_pos[metric_ids[sel]],
+                                 timestamps[sel], values[sel])
+
     def getMetricIdx(self, metric):
-        with self.lock:
+        try:
+            return self.metric_idxs[metric]
+        except KeyError:
+            pass
+        with self.create_lock:
+            # double check, the metric may be created by another thread
+            # when we are waiting for the lock.
             if metric in self.metric_idxs:
                 return self.metric_idxs[metric]
             else:
-                schema = self.storage_schemas.getSchemaByMetric(metric)
-                schema_cache = self.getSchemaCache(schema)
-                file_idx = schema_cache.getFileCacheIdx(schema)
-                pos_idx = schema_cache[file_idx].getPosIdx()
-
-                # create file
-                file_path = getFilePath(schema.name, file_idx)
-                if not os.path.exists(file_path):
-                    tags = [''] * schema.metrics_max_num
-                    kenshin.create(file_path, tags, schema.archives, schema.xFilesFactor,
-                                   schema.aggregationMethod)
-                # update file metadata
-                kenshin.add_tag(metric, file_path, pos_idx)
-                # create link
-                createLink(metric, file_path)
-                # create index
-                self.metrics_fh.write("%s %s %s %s\n" % (metric, schema.name, file_idx, pos_idx))
-
-                self.metric_idxs[metric] = (schema.name, file_idx, pos_idx)
-                return self.metric_idxs[metric]
+                return self._createMetric(metric)
+
+    def getMetricIdxs(self, metrics):
+        """
+        Return {metric: (schema_name, file_idx, pos_idx)} of `metrics`,
+        the value is None if the metric is dropped.
+        """
+        rs = {}
+        new_metrics = []
+        for metric in metrics:
+            idx = self.metric_idxs.get(metric)
+            if idx is None:
+                new_metrics.append(metric)
+            else:
+                rs[metric] = idx
+
+        if new_metrics:
+            with self.create_lock:
+                for metric in new_metrics:
+                    if metric in self.metric_idxs:
+                        rs[metric] = self.metric_idxs[metric]
+                    else:
+                        rs[metric] = self._createMetric(metric)
+        return rs
+
+    def _createMetric(self, metric):
+        """
+        Allocate position for a new metric, must be called with
+        `create_lock` held.
+
+        The file is created asynchronously by `createPendingMetrics`,
+        points are buffered in the file cache until then. Return None
+        if there are too many metrics waiting for creation.
+        """
+        if len(self.pending_creates) >= settings.MAX_CREATES_QUEUE_SIZE:
+            from rurouni.state import instrumentation
+            instrumentation.incr('droppedCreates')
+            return None
+        schema = self.storage_schemas.getSchemaByMetric(metric)
+        # writer may be scanning schema caches
+        with self.lock:
+            schema_cache = self.getSchemaCache(schema)
+            file_idx = schema_cache.getFileCacheIdx(schema)
+        file_cache = schema_cache[file_idx]
+        pos_idx = file_cache.getPosIdx()
+        file_cache.addPendingCreate()
+        self.pending_creates.append((metric, schema, file_idx, pos_idx))
+
+        self.metric_idxs[metric] = (schema.name, file_idx, pos_idx)
+        return self.metric_idxs[metric]
+
+    def createPendingMetrics(self, max_cnt=float('inf')):
+        """
+        Create at most `max_cnt` pending metrics, return the number
+        of metrics created.
+        """
+        from rurouni.state import instrumentation
+        cnt = 0
+        while cnt < max_cnt:
+            try:
+                metric, schema, file_idx, pos_idx = self.pending_creates.popleft()
+            except IndexError:
+                break
+            file_cache = self.schema_caches[schema.name][file_idx]
+            file_cache.beginCreate()
+            created = False
+            try:
+                self._createMetricFile(metric, schema, file_idx, pos_idx)
+                created = True
+                instrumentation.incr('creates')
+            except Exception as e:
+                log.err('Error creating metric %s: %s' % (metric, e))
+                instrumentation.incr('errors')
+                # forget the metric, it's created again by its next
+                # datapoint.
+                with self.create_lock:
+                    del self.metric_idxs[metric]
+                file_cache.clearPos(pos_idx)
+            finally:
+                file_cache.donePendingCreate(created)
+            cnt += 1
+        return cnt
+
+    def _createMetricFile(self, metric, schema, file_idx, pos_idx):
+        # create file
+        file_path = getFilePath(schema.name, file_idx)
+        if not os.path.exists(file_path):
+            tags = [''] * schema.metrics_max_num
+            kenshin.create(file_path, tags, schema.archives, schema.xFilesFactor,
+                           schema.aggregationMethod,
+                           allocation=settings.FILE_ALLOCATION,
+                           flags=schema.flags)
+        # update file metadata
+        kenshin.add_tag(metric, file_path, pos_idx)
+        # create link
+        createLink(metric, file_path)
+        # create index
+        self.metrics_fh.write("%s %s %s %s\n" % (metric, schema.name, file_idx, pos_idx))
 
     def getSchemaCache(self, schema):
         try:
@@ -119,27 +311,141 @@ class MetricCache(object):
             return schema_cache
 
     def get(self, metric):
-        if metric not in self.metric_idxs:
-            return []
-        (schema_name, file_idx, pos_idx) = self.getMetricIdx(metric)
-        file_cache = self.schema_caches[schema_name][file_idx]
+        return self.getMany([metric]).get(metric, [])
+
+    def getMany(self, metrics):
+        """
+        Return {metric: datapoints} of `metrics`, columns of each file
+        cache are copied at once under its lock.
+        """
+        file_cache_metrics = {}
+        for metric in metrics:
+            metric_idx = self.metric_idxs.get(metric)
+            if metric_idx is None:
+                continue
+            (schema_name, file_idx, pos_idx) = metric_idx
+            file_cache_metrics.setdefault((schema_name, file_idx), []).append(
+                (metric, pos_idx))
+
+        rs = {}
         now = int(time.time())
-        data = file_cache.get(end_ts=now)
-        return [(ts, val[pos_idx]) for ts, val in data
-                                   if val[pos_idx] != NULL_VALUE]
-
-    def pop(self, schema_name, file_idx, end_ts=None, clear=True):
-        file_cache = self.schema_caches[schema_name][file_idx]
-        datapoints = file_cache.get(end_ts=end_ts, clear=clear)
-        return datapoints
-
-    def writableFileCaches(self):
+        for (schema_name, file_idx), pos_metrics in file_cache_metrics.iteritems():
+            file_cache = self.schema_caches[schema_name][file_idx]
+            pos_idxs = [pos_idx for _, pos_idx in pos_metrics]
+            timestamps, block = file_cache.getBlock(now, pos_idxs)
+            for i, (metric, _) in enumerate(pos_metrics):
+                vals = block[:, i]
+                mask = vals != NULL_VALUE
+                rs[metric] = zip(timestamps[mask].tolist(), vals[mask].tolist())
+        return rs
+
+    def fetch(self, metrics, from_time, until_time=None, now=None):
+        """
+        Return {metric: (time_info, values)} of `metrics`, datapoints on
+        disk are merged with datapoints in cache. `values` is a numpy
+        array, null values are NaN. Metrics out of retention are None.
+        """
+        if now is None:
+            now = int(time.time())
+        file_cache_metrics = {}
+        for metric in metrics:
+            metric_idx = self.metric_idxs.get(metric)
+            if metric_idx is None:
+                continue
+            (schema_name, file_idx, pos_idx) = metric_idx
+            file_cache_metrics.setdefault((schema_name, file_idx), []).append(
+                (metric, pos_idx))
+
+        rs = {}
+        for (schema_name, file_idx), pos_metrics in file_cache_metrics.iteritems():
+            file_cache = self.schema_caches[schema_name][file_idx]
+            pos_idxs = [pos_idx for _, pos_idx in pos_metrics]
+            # copied before reading the file, datapoints flushed in
+            # between are still in the copy
+            timestamps, block = file_cache.getBlock(now, pos_idxs)
+
+            file_path = getFilePath(schema_name, file_idx)
+            if os.path.exists(file_path):
+                fetched = kenshin.fetch_array(file_path, from_time, until_time,
+                                              now, engine=settings.STORAGE_ENGINE,
+                                              columns=pos_idxs)
+                if fetched is None:
+                    for metric, _ in pos_metrics:
+                        rs[metric] = None
+                    continue
+                header, time_info, values = fetched
+                agg_id = header['agg_id']
+            else:
+                # file is not created yet, only datapoints in cache
+                step = file_cache.resolution
+                time_info = (roundup(from_time, step),
+                             roundup(until_time or now, step), step)
+                values = np.full(((time_info[1] - time_info[0]) / step,
+                                  len(pos_idxs)), np.nan)
+                agg_id = None
+
+            mergeCachedPoints(time_info, values, timestamps, block,
+                              file_cache.resolution, agg_id)
+            for i, (metric, _) in enumerate(pos_metrics):
+                rs[metric] = (time_info, values[:, i])
+        return rs
+
+    def globMetrics(self, pattern):
+        """
+        Return metrics that match glob `pattern`, e.g. 'servers.*.cpu'.
+        """
+        link_dir = os.path.join(settings.LOCAL_LINK_DIR, settings['instance'])
+        metrics = []
+        for link_path in glob.glob(getMetricPath(pattern)):
+            metric = os.path.relpath(link_path, link_dir)[:-len('.hs')]
+            metrics.append(metric.replace(os.sep, '.'))
+        return metrics
+
+    def pop(self, schema_name, file_idx, end_ts=None):
+        """
+        Return (batch, datapoints) to write of a file cache, `batch`
+        must be released by `release` after writing, see FileCache.pop.
+        """
+        return self.schema_caches[schema_name][file_idx].pop(end_ts)
+
+    def release(self, schema_name, file_idx, batch, written=True):
+        """
+        Release a batch returned by `pop`, return number of datapoints
+        dropped after too many failed writes.
+        """
+        return self.schema_caches[schema_name][file_idx].release(batch,
+                                                                 written)
+
+    def writableFileCaches(self, worker_idx=0, worker_cnt=1):
+        """
+        Return writable file caches that belong to writer `worker_idx`.
+
+        File caches are partitioned among writers by
+        (schemaHash(schema_name) + file_idx) % worker_cnt, so each file is
+        written by only one writer.
+        """
         now = int(time.time())
+        rs = []
         with self.lock:
-            return[(schema_name, file_idx)
-                   for (schema_name, schema_cache) in self.schema_caches.items()
-                   for file_idx in range(schema_cache.size())
-                   if schema_cache[file_idx].canWrite(now)]
+            for schema_name, schema_cache in self.schema_caches.items():
+                first_idx = (worker_idx - schemaHash(schema_name)) % worker_cnt
+                for file_idx in xrange(first_idx, schema_cache.size(), worker_cnt):
+                    if schema_cache[file_idx].canWrite(now):
+                        rs.append((schema_name, file_idx))
+        return rs
+
+    def oldestUnflushedTs(self):
+        """
+        Return timestamp of the oldest datapoint not written to disk yet,
+        including popped ones being written, None if there is none.
+        """
+        rs = None
+        for schema_cache in self.schema_caches.values():
+            for file_idx in xrange(schema_cache.size()):
+                ts = schema_cache[file_idx].oldestTs()
+                if ts is not None and (rs is None or ts < rs):
+                    rs = ts
+        return rs
 
     def getAllFileCaches(self):
         return [(schema_name, file_idx)
@@ -147,6 +453,49 @@ class MetricCache(object):
                 for file_idx in range(schema_cache.size())]
 
 
+def mergeCachedPoints(time_info, values, timestamps, block, resolution,
+                      agg_id):
+    """
+    Merge cached points (`timestamps`, `block`) into `values` fetched
+    from disk in place.
+
+    If the archive step equals the cache resolution, cached values
+    override values on disk. Otherwise cached values are aggregated to
+    the archive step and only fill the null slots.
+    """
+    from_time, until_time, step = time_info
+    mask = (timestamps >= from_time) & (timestamps < until_time)
+    if not mask.any():
+        return
+    # cached timestamps are continuous, so are the selected ones
+    timestamps = timestamps[mask]
+    block = block[mask]
+    first_slot = (timestamps[0] - from_time) // step
+
+    if step == resolution:
+        slots = values[first_slot: first_slot + len(timestamps)]
+        known = block != NULL_VALUE
+        slots[known] = block[known]
+        return
+
+    agg_cnt = step / resolution
+    padding = (timestamps[0] - from_time) % step / resolution
+    point_cnt = padding + len(timestamps)
+    group_cnt = (point_cnt + agg_cnt - 1) / agg_cnt
+    padded = np.empty((group_cnt * agg_cnt, block.shape[1]))
+    padded.fill(NULL_VALUE)
+    padded[padding: point_cnt] = block
+    padded = padded.reshape(group_cnt, agg_cnt, block.shape[1])
+    agg_values = Agg.aggregate_array(agg_id, padded, padded != NULL_VALUE)
+    slots = values[first_slot: first_slot + group_cnt]
+    fill = np.isnan(slots) & (agg_values != NULL_VALUE)
+    slots[fill] = agg_values[fill]
+
+
+def schemaHash(schema_name):
+    return zlib.crc32(schema_name) & 0xffffffff
+
+
 class SchemaCache(object):
     def __init__(self):
         self.file_caches = []
@@ -170,10 +519,17 @@ class SchemaCache(object):
         return self.curr_idx
 
     def add(self, schema, file_idx, file_pos):
+        self._extend(schema, file_idx)
+        self.file_caches[file_idx].add(file_pos)
+
+    def addBitmap(self, schema, file_idx, bitmap):
+        self._extend(schema, file_idx)
+        self.file_caches[file_idx].addBitmap(bitmap)
+
+    def _extend(self, schema, file_idx):
         if len(self.file_caches) <= file_idx:
             for _ in range(len(self.file_caches), file_idx + 1):
                 self.file_caches.append(FileCache(schema))
-        self.file_caches[file_idx].add(file_pos)
 
 
 class FileCache(object):
@@ -188,16 +544,31 @@ class FileCache(object):
         # +1 to avoid self.points_num == 0
         self.points_num = self.retention / self.resolution + 1
         self.cache_size = int(self.points_num * schema.cache_ratio)
-        self.points = [NULL_VALUE] * self.metrics_max_num * self.cache_size
-        self.base_idxs = [i * self.cache_size for i in xrange(self.metrics_max_num)]
+        # a ring buffer of cache_size points for each metric
+        self.points = np.empty((self.metrics_max_num, self.cache_size))
+        self.points.fill(NULL_VALUE)
 
         self.start_ts = None
         self.max_ts = 0
         self.start_offset = 0
+        # number of metrics in this file waiting for creation
+        self.pending_creates = 0
+        # the file exists, and no metric is being created in it
+        self.created = False
+        self.creating = False
+        # [timestamps, block, attempts, retry_ts] of batches popped by
+        # writer but not written yet, retry_ts is None while writing
+        self.inflight = []
 
     def add(self, file_pos):
         with self.lock:
             self.bitmap |= (1 << file_pos)
+            self.created = True
+
+    def addBitmap(self, bitmap):
+        with self.lock:
+            self.bitmap |= bitmap
+            self.created = True
 
     def getPosIdx(self):
         with self.lock:
@@ -209,6 +580,14 @@ class FileCache(object):
                     self.avaiable_pos_idx += 1
                     return self.avaiable_pos_idx - 1
 
+    def clearPos(self, pos_idx):
+        """
+        Drop cached datapoints of `pos_idx`. The position is not
+        released, datapoints being put may still reach it.
+        """
+        with self.lock:
+            self.points[pos_idx] = NULL_VALUE
+
     def metricFull(self):
         with self.lock:
             return self.bitmap + 1 == (1 << self.metrics_max_num)
@@ -216,8 +595,40 @@ class FileCache(object):
     def metricEmpty(self):
         return not self.start_ts
 
+    def addPendingCreate(self):
+        with self.lock:
+            self.pending_creates += 1
+
+    def beginCreate(self):
+        """
+        Stop writes of this file while a metric is created in it, since
+        add_tag may rewrite the whole file. Wait for batches being
+        written, they are released soon.
+        """
+        while True:
+            with self.lock:
+                if all(b[3] is not None for b in self.inflight):
+                    self.creating = True
+                    return
+            time.sleep(0.01)
+
+    def donePendingCreate(self, created=True):
+        with self.lock:
+            self.pending_creates -= 1
+            self.creating = False
+            if created:
+                self.created = True
+
     def canWrite(self, now):
+        """
+        Metrics waiting for creation don't block writes once the file
+        exists, their datapoints are written to positions without tags.
+        """
         with self.lock:
+            if self.creating or not self.created:
+                return False
+            if any(b[3] is not None and b[3] <= now for b in self.inflight):
+                return True
             return self.start_ts and ((now - self.start_ts - self.retention) >=
                                       settings.DEFAULT_WAIT_TIME)
 
@@ -226,83 +637,201 @@ class FileCache(object):
                   (self.retention, self.cache_size, self.points_num))
         with self.lock:
             try:
-                base_idx = self.base_idxs[pos_idx]
-                ts, val = datapoint
-
-                self.max_ts = max(self.max_ts, ts)
-                if self.start_ts is None:
-                    self.start_ts = ts - ts % self.resolution
-                    idx = base_idx
-                else:
-                    offset = (ts - self.start_ts) / self.resolution
-                    idx = base_idx + (self.start_offset + offset) % self.cache_size
-
+                idx = self._put(pos_idx, datapoint)
                 log.debug("put idx: %s, ts: %s, start_ts: %s, start_offset: %s, retention: %s" %
-                          (idx, ts, self.start_ts, self.start_offset, self.retention))
-                self.points[idx] = val
+                          (idx, datapoint[0], self.start_ts, self.start_offset, self.retention))
             except Exception as e:
                 log.err('put error in FileCache: %s' % e)
 
+    def put_many(self, points):
+        """
+        Put a list of (pos_idx, datapoint) under one lock acquisition.
+        """
+        with self.lock:
+            for pos_idx, datapoint in points:
+                try:
+                    self._put(pos_idx, datapoint)
+                except Exception as e:
+                    log.err('put error in FileCache: %s' % e)
+
+    def put_array(self, pos_idxs, timestamps, values):
+        """
+        Put datapoints in arrays, later datapoints win.
+        """
+        with self.lock:
+            if self.start_ts is None:
+                self._put(pos_idxs[0], (int(timestamps[0]), values[0]))
+            timestamps = timestamps.astype(np.int64)
+            self.max_ts = max(self.max_ts, int(timestamps.max()))
+            offsets = (timestamps - self.start_ts) // self.resolution
+            idxs = (self.start_offset + offsets) % self.cache_size
+            self.points[pos_idxs, idxs] = values
+
+    def _put(self, pos_idx, datapoint):
+        ts, val = datapoint
+
+        self.max_ts = max(self.max_ts, ts)
+        if self.start_ts is None:
+            self.start_ts = ts - ts % self.resolution
+            idx = 0
+        else:
+            offset = (ts - self.start_ts) / self.resolution
+            idx = (self.start_offset + offset) % self.cache_size
+
+        self.points[pos_idx, idx] = val
+        return idx
+
     def get_offset(self, ts):
         interval = (ts - self.start_ts) / self.resolution
         if interval >= self.cache_size:
             interval = self.cache_size - 1
         return (self.start_offset + interval) % self.cache_size
 
-    def get(self, end_ts=None, clear=False):
-        with self.lock:
-            if self.metricEmpty():
-                return []
-            begin_offset = self.start_offset
-            if end_ts:
-                end_offset = self.get_offset(end_ts)
-            else:
-                end_offset = (begin_offset + self.points_num) % self.cache_size
-
-            log.debug("begin_offset: %s, end_offset: %s end_ts: %s, clear: %s" %
-                      (begin_offset, end_offset, end_ts, clear,))
-
-            rs = [None] * self.metrics_max_num
-            if begin_offset < end_offset:
-                length = end_offset - begin_offset
-                for i, base_idx in enumerate(self.base_idxs):
-                    begin_idx = base_idx + begin_offset
-                    end_idx = base_idx + end_offset
-                    val = self.points[begin_idx: end_idx]
-                    rs[i] = val
-                    if clear:
-                        self.clearPoint(begin_idx, end_idx)
-            else:
-                # wrap around
-                length = self.cache_size - begin_offset + end_offset
-                for i, base_idx in enumerate(self.base_idxs):
-                    begin_idx = base_idx + begin_offset
-                    end_idx = base_idx + end_offset
-                    val = self.points[begin_idx: base_idx+self.cache_size]
-                    val += self.points[base_idx: begin_idx]
-                    rs[i] = val
-                    if clear:
-                        self.clearPoint(begin_idx, base_idx+self.cache_size)
-                        self.clearPoint(base_idx, end_idx)
-
-            # timestamps
-            timestamps = [self.start_ts + i * self.resolution
-                          for i in range(length)]
+    def get(self, end_ts=None):
+        timestamps, block = self.getBlock(end_ts)
+        return zip(timestamps.tolist(), block.tolist())
+
+    def getBlock(self, end_ts=None, columns=None):
+        """
+        Return (timestamps, block), `block` is an array of shape
+        (len(timestamps), metrics_max_num), or (len(timestamps),
+        len(columns)) if a list of position indexes `columns` is given.
 
+        The block is copied under the lock, so it's not changed by
+        concurrent puts and pops. Popped batches not written yet are
+        merged into it.
+        """
+        with self.lock:
+            timestamps, block = self._getBlock(end_ts, False)
+            if self.inflight:
+                timestamps, block = self._mergeBlocks(
+                    self.inflight + [[timestamps, block]])
+            if columns is not None:
+                # fancy indexing copies only the requested columns
+                return timestamps, block[:, columns]
+            return timestamps, block.copy()
+
+    def pop(self, end_ts=None):
+        """
+        Clear datapoints until `end_ts` and return (batch, datapoints),
+        failed batches due to retry are written again with them.
+
+        Popped datapoints are kept in `inflight`, which are visible to
+        readers and `oldestTs`, until `batch` is released. Nothing is
+        popped while a metric is being created in the file.
+        """
+        with self.lock:
+            if self.creating:
+                return [], []
+            now = time.time()
+            batch = []
+            for b in self.inflight:
+                if b[3] is not None and b[3] <= now:
+                    b[3] = None
+                    batch.append(b)
+            timestamps, block = self._getBlock(end_ts, True)
+            if len(timestamps):
+                b = [timestamps, block, 0, None]
+                self.inflight.append(b)
+                batch.append(b)
+            if not batch:
+                return batch, []
+            timestamps, block = self._mergeBlocks(batch)
+            return batch, zip(timestamps.tolist(), block.tolist())
+
+    def release(self, batch, written=True):
+        """
+        Release `batch` returned by `pop`. A batch failed to write is
+        retried after DEFAULT_WAIT_TIME seconds, and dropped after
+        MAX_WRITE_RETRIES retries. Return number of dropped datapoints.
+        """
+        with self.lock:
+            ids = set(id(b) for b in batch)
+            retry_ts = time.time() + settings.DEFAULT_WAIT_TIME
+            dropped = 0
+            inflight = []
+            for b in self.inflight:
+                if id(b) not in ids:
+                    inflight.append(b)
+                elif not written:
+                    b[2] += 1
+                    if b[2] <= settings.MAX_WRITE_RETRIES:
+                        b[3] = retry_ts
+                        inflight.append(b)
+                    else:
+                        dropped += int((b[1] != NULL_VALUE).sum())
+            self.inflight = inflight
+            return dropped
+
+    def oldestTs(self):
+        """
+        Return timestamp of the oldest datapoint not written yet, None
+        if there is none.
+        """
+        with self.lock:
+            rs = [int(b[0][0]) for b in self.inflight]
+            if self.start_ts is not None:
+                rs.append(self.start_ts)
+            return min(rs) if rs else None
+
+    def _mergeBlocks(self, blocks):
+        """
+        Merge [timestamps, block, ...] of `blocks`, non-null values in
+        later blocks win.
+        """
+        timestamps = np.unique(np.concatenate([b[0] for b in blocks]))
+        rs = np.empty((len(timestamps), self.metrics_max_num))
+        rs.fill(NULL_VALUE)
+        for b in blocks:
+            ts, block = b[0], b[1]
+            idxs = np.searchsorted(timestamps, ts)
+            rows = rs[idxs]
+            known = block != NULL_VALUE
+            rows[known] = block[known]
+            rs[idxs] = rows
+        return timestamps, rs
+
+    def _getBlock(self, end_ts, clear):
+        if self.metricEmpty():
+            return (np.empty(0, dtype=np.int64),
+                    np.empty((0, self.metrics_max_num)))
+        begin_offset = self.start_offset
+        if end_ts:
+            end_offset = self.get_offset(end_ts)
+        else:
+            end_offset = (begin_offset + self.points_num) % self.cache_size
+
+        log.debug("begin_offset: %s, end_offset: %s end_ts: %s, clear: %s" %
+                  (begin_offset, end_offset, end_ts, clear,))
+
+        if begin_offset < end_offset:
+            length = end_offset - begin_offset
+            block = self.points[:, begin_offset: end_offset]
             if clear:
-                next_ts = timestamps[-1] + self.resolution
-                if self.max_ts < next_ts:
-                    self.start_ts = None
-                    self.start_offset = 0
-                else:
-                    self.start_ts = next_ts
-                    self.start_offset = end_offset
+                block = block.copy()
+                self.points[:, begin_offset: end_offset] = NULL_VALUE
+        else:
+            # wrap around
+            length = self.cache_size - begin_offset + end_offset
+            block = np.concatenate((self.points[:, begin_offset:],
+                                    self.points[:, :end_offset]), axis=1)
+            if clear:
+                self.points[:, begin_offset:] = NULL_VALUE
+                self.points[:, :end_offset] = NULL_VALUE
+
+        # timestamps
+        timestamps = self.start_ts + np.arange(length) * self.resolution
 
-            return zip(timestamps, zip(*rs))
+        if clear:
+            next_ts = self.start_ts + length * self.resolution
+            if self.max_ts < next_ts:
+                self.start_ts = None
+                self.start_offset = 0
+            else:
+                self.start_ts = next_ts
+                self.start_offset = end_offset
 
-    def clearPoint(self, begin_idx, end_idx):
-        for i in range(begin_idx, end_idx):
-            self.points[i] = NULL_VALUE
+        return timestamps, block.T
 
 
 MetricCache = MetricCache()
@@ -0,0 +1,75 @@
+# coding: utf-8
+"""
+Binary frame of datapoints used by `MetricBinaryReceiver`.
+
+A frame is sent as a length-prefixed string (like pickle receiver),
+its layout is (big endian):
+
+    header:  names_size, record_cnt
+    names:   metric names joined by '\n'
+    records: (name_id, timestamp, value) of `!LLd`
+
+`name_id` is the index of metric in names.
+"""
+import struct
+
+import numpy as np
+
+
+HEADER_FORMAT = '!LL'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_DTYPE = np.dtype([('id', '>u4'), ('ts', '>u4'), ('val', '>f8')])
+
+
+class InvalidFrame(Exception):
+    pass
+
+
+def packFrame(datapoints):
+    """
+    Pack a list of (metric, (timestamp, value)) into a frame.
+    """
+    name_ids = {}
+    records = np.empty(len(datapoints), dtype=RECORD_DTYPE)
+    for i, (metric, (timestamp, value)) in enumerate(datapoints):
+        records[i] = (name_ids.setdefault(metric, len(name_ids)),
+                      timestamp, value)
+    names = sorted(name_ids, key=name_ids.get)
+    return _pack(names, records)
+
+
+def packArrays(metrics, metric_ids, timestamps, values):
+    """
+    Pack datapoints in arrays into a frame, the i-th datapoint is
+    (metrics[metric_ids[i]], (timestamps[i], values[i])).
+    """
+    records = np.empty(len(metric_ids), dtype=RECORD_DTYPE)
+    records['id'] = metric_ids
+    records['ts'] = timestamps
+    records['val'] = values
+    return _pack(metrics, records)
+
+
+def _pack(names, records):
+    names = '\n'.join(names)
+    header = struct.pack(HEADER_FORMAT, len(names), len(records))
+    return header + names + records.tostring()
+
+
+def unpackFrame(data):
+    """
+    Return (names, records), `records` is an array of RECORD_DTYPE
+    which shares memory with `data`.
+    """
+    if len(data) < HEADER_SIZE:
+        raise InvalidFrame('frame too short')
+    names_size, record_cnt = struct.unpack_from(HEADER_FORMAT, data)
+    records_offset = HEADER_SIZE + names_size
+    if len(data) != records_offset + record_cnt * RECORD_DTYPE.itemsize:
+        raise InvalidFrame('frame size mismatch')
+    names = data[HEADER_SIZE: records_offset].split('\n')
+    records = np.frombuffer(data, dtype=RECORD_DTYPE, count=record_cnt,
+                            offset=records_offset)
+    if record_cnt and records['id'].max() >= len(names):
+        raise InvalidFrame('invalid name id')
+    return names, records
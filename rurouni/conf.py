@@ -21,7 +21,34 @@ defaults = dict(
     PICKLE_RECEIVER_PORT = '2004',
     PICKLE_RECEIVER_INTERFACE = '0.0.0.0',
 
+    # binary receiver is disabled if port is empty.
+    BINARY_RECEIVER_PORT = '',
+    BINARY_RECEIVER_INTERFACE = '0.0.0.0',
+
     DEFAULT_WAIT_TIME = 10,
+    # datapoints failed to write are retried every DEFAULT_WAIT_TIME
+    # seconds, and dropped after MAX_WRITE_RETRIES retries.
+    MAX_WRITE_RETRIES = 3,
+    # kenshin storage engine used by writer, 'file' or 'mmap'.
+    STORAGE_ENGINE = 'file',
+    # max number of parsed kenshin file headers cached by writer.
+    HEADER_CACHE_SIZE = 10000,
+    # number of writer threads, each file is written by only one writer.
+    WRITER_THREADS = 1,
+    # new metric files are created in background, at most
+    # MAX_CREATES_PER_SECOND files per second, metrics beyond
+    # MAX_CREATES_QUEUE_SIZE pending ones are dropped.
+    MAX_CREATES_PER_SECOND = float('inf'),
+    MAX_CREATES_QUEUE_SIZE = 100000,
+    # how data region of new files is allocated,
+    # 'zero', 'sparse' or 'fallocate'.
+    FILE_ALLOCATION = 'zero',
+    # write-ahead log of received datapoints, replayed at startup.
+    # WAL_DIR defaults to LOCAL_DATA_DIR/<instance>.wal.
+    ENABLE_WAL = False,
+    WAL_DIR = '',
+    WAL_SEGMENT_SIZE = 64 << 20,
+    WAL_FLUSH_INTERVAL = 1,
     RUROUNI_METRIC_INTERVAL = 60,
     RUROUNI_METRIC = 'rurouni',
 
@@ -285,6 +312,9 @@ def read_config(program, options):
 
     settings['INDEX_FILE'] = join(settings['LOCAL_DATA_DIR'],
                                     '%s.idx' % instance)
+    if not settings['WAL_DIR']:
+        settings['WAL_DIR'] = join(settings['LOCAL_DATA_DIR'],
+                                   '%s.wal' % instance)
     return settings
 
 
@@ -0,0 +1,307 @@
+# coding: utf-8
+"""
+Metric index of a rurouni instance.
+
+The text index file `<instance>.idx` is an append-only log of
+"metric schema_name file_idx pos_idx" lines, it's used to record new
+metrics. Parsing it at startup is slow with millions of metrics, so it
+can be compacted to a binary index file `<instance>.idx.bin`, which is
+mapped into memory and looked up directly.
+
+Binary index layout (big endian):
+
+    header:  magic, version, schema_cnt, metric_cnt, schemas_size,
+             names_size, text_size, text_ino, text_mtime, text_crc
+    schemas: schema names joined by '\n'
+    records: (name_offset, name_len, schema_id, file_idx, pos_idx),
+             sorted by metric name
+    names:   metric names
+
+`text_size` is the size of text index covered by the binary index,
+lines after it are replayed at startup. The binary index is stale if
+the text index is replaced (`text_ino` differs) or rewritten. A rewrite
+is detected by `text_mtime` and `text_crc`, the crc32 of the last
+TEXT_CRC_SIZE bytes before `text_size`, appending lines keeps the crc.
+"""
+import os
+import mmap
+import zlib
+import struct
+from binascii import hexlify
+
+import numpy as np
+
+from rurouni import log
+
+
+INDEX_MAGIC = 'KIDX'
+INDEX_VERSION = 2
+HEADER_FORMAT = '!4s5LQQdL'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = '!LHHLL'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_DTYPE = np.dtype([('name_offset', '>u4'), ('name_len', '>u2'),
+                         ('schema_id', '>u2'), ('file_idx', '>u4'),
+                         ('pos_idx', '>u4')])
+
+TEXT_CRC_SIZE = 4096
+
+MAX_ALLOW_ERR_LINE = 1
+
+
+def getBinaryIndexPath(index_file):
+    return index_file + '.bin'
+
+
+def getTextIndexState(index_file, text_size=None):
+    """
+    Return (text_size, text_ino, text_mtime, text_crc) of text index
+    file, `text_size` defaults to the file size.
+    """
+    st = os.stat(index_file)
+    if text_size is None:
+        text_size = st.st_size
+    with open(index_file, 'rb') as f:
+        offset = max(0, text_size - TEXT_CRC_SIZE)
+        f.seek(offset)
+        crc = zlib.crc32(f.read(text_size - offset)) & 0xffffffff
+    return text_size, st.st_ino, st.st_mtime, crc
+
+
+def iterTextIndex(index_file, offset=0):
+    """
+    Yield (metric, schema_name, file_idx, pos_idx) in text index file
+    from `offset`.
+    """
+    err_line_cnt = 0
+    with open(index_file) as f:
+        f.seek(offset)
+        for line in f:
+            line = line.strip('\n')
+            try:
+                metric, schema_name, file_idx, file_pos = line.split(" ")
+                file_idx = int(file_idx)
+                file_pos = int(file_pos)
+            except Exception as e:
+                if err_line_cnt < MAX_ALLOW_ERR_LINE:
+                    err_line_cnt += 1
+                    continue
+                else:
+                    raise Exception('Index file has many error: %s' % e)
+            yield metric, schema_name, file_idx, file_pos
+
+
+def writeBinaryIndex(path, entries, text_state):
+    """
+    Write `entries` of (metric, schema_name, file_idx, pos_idx) to binary
+    index file `path`, later entries of the same metric win. `text_state`
+    is returned by `getTextIndexState`.
+    """
+    metrics = {}
+    for metric, schema_name, file_idx, pos_idx in entries:
+        metrics[metric] = (schema_name, file_idx, pos_idx)
+
+    schema_ids = {}
+    for schema_name, _, _ in metrics.itervalues():
+        schema_ids.setdefault(schema_name, len(schema_ids))
+    schema_names = sorted(schema_ids, key=schema_ids.get)
+    schemas = '\n'.join(schema_names)
+
+    records = []
+    names = []
+    name_offset = 0
+    for metric in sorted(metrics):
+        schema_name, file_idx, pos_idx = metrics[metric]
+        records.append(struct.pack(RECORD_FORMAT, name_offset, len(metric),
+                                   schema_ids[schema_name], file_idx, pos_idx))
+        names.append(metric)
+        name_offset += len(metric)
+
+    header = struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION,
+                         len(schema_names), len(records), len(schemas),
+                         name_offset, *text_state)
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(header)
+        f.write(schemas)
+        f.write(''.join(records))
+        f.write(''.join(names))
+    os.rename(tmpfile, path)
+
+
+def convertIndex(index_file, binary_index_file=None):
+    """
+    Convert text index file to binary index file.
+    """
+    if binary_index_file is None:
+        binary_index_file = getBinaryIndexPath(index_file)
+    text_state = getTextIndexState(index_file)
+    writeBinaryIndex(binary_index_file, iterTextIndex(index_file), text_state)
+
+
+class BinaryIndex(object):
+    """
+    A read only binary index file mapped into memory.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, schema_cnt, self.metric_cnt, schemas_size,
+             names_size, self.text_size, self.text_ino, self.text_mtime,
+             self.text_crc) = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise ValueError('invalid binary index file: %s' % path)
+            offset = HEADER_SIZE
+            schemas = self.mm[offset: offset + schemas_size]
+            self.schema_names = schemas.split('\n') if schema_cnt else []
+            self.records_offset = offset + schemas_size
+            self.names_offset = (self.records_offset +
+                                 self.metric_cnt * RECORD_SIZE)
+            if self.names_offset + names_size != len(self.mm):
+                raise ValueError('truncated binary index file: %s' % path)
+        except Exception:
+            self.mm.close()
+            raise
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.metric_cnt
+
+    def _record(self, i):
+        return struct.unpack_from(RECORD_FORMAT, self.mm,
+                                  self.records_offset + i * RECORD_SIZE)
+
+    def _name(self, name_offset, name_len):
+        offset = self.names_offset + name_offset
+        return self.mm[offset: offset + name_len]
+
+    def get(self, metric, default=None):
+        """
+        Binary search `metric`, return (schema_name, file_idx, pos_idx).
+        """
+        lo, hi = 0, self.metric_cnt
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record(mid)
+            name = self._name(record[0], record[1])
+            if name < metric:
+                lo = mid + 1
+            elif name > metric:
+                hi = mid
+            else:
+                return (self.schema_names[record[2]], record[3], record[4])
+        return default
+
+    def iteritems(self):
+        for i in xrange(self.metric_cnt):
+            record = self._record(i)
+            yield (self._name(record[0], record[1]),
+                   (self.schema_names[record[2]], record[3], record[4]))
+
+    def iterFiles(self):
+        """
+        Yield (schema_name, file_idx, bitmap) of each file, bits of used
+        positions are set in bitmap.
+        """
+        if not self.metric_cnt:
+            return
+        records = np.frombuffer(buffer(self.mm, self.records_offset,
+                                       self.metric_cnt * RECORD_SIZE),
+                                dtype=RECORD_DTYPE)
+        keys = ((records['schema_id'].astype(np.uint64) << np.uint64(32)) |
+                records['file_idx'])
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        pos_idxs = records['pos_idx'][order]
+        uniq_keys, starts = np.unique(keys, return_index=True)
+        ends = np.append(starts[1:], len(keys))
+        for key, start, end in zip(uniq_keys, starts, ends):
+            pos = pos_idxs[start: end]
+            # pad to multiple of 8 bits, highest position first
+            bits = np.zeros((int(pos.max()) / 8 + 1) * 8, dtype=np.uint8)
+            bits[pos] = 1
+            bitmap = int(hexlify(np.packbits(bits[::-1]).tostring()), 16)
+            yield (self.schema_names[int(key >> np.uint64(32))],
+                   int(key & np.uint64(0xffffffff)), bitmap)
+
+
+class MetricIndex(object):
+    """
+    {metric: (schema_name, file_idx, pos_idx)}, backed by a binary index
+    and a dict of new or recently looked up metrics.
+
+    Lookups and insertions don't need any lock.
+    """
+    def __init__(self, binary_index=None):
+        self.binary_index = binary_index
+        self.metrics = {}
+
+    def get(self, metric, default=None):
+        try:
+            return self.metrics[metric]
+        except KeyError:
+            pass
+        if self.binary_index is None:
+            return default
+        rs = self.binary_index.get(metric)
+        if rs is None:
+            return default
+        # later lookups of this metric only hit the dict
+        self.metrics[metric] = rs
+        return rs
+
+    def __getitem__(self, metric):
+        rs = self.get(metric)
+        if rs is None:
+            raise KeyError(metric)
+        return rs
+
+    def __setitem__(self, metric, value):
+        self.metrics[metric] = value
+
+    def __delitem__(self, metric):
+        del self.metrics[metric]
+
+    def __contains__(self, metric):
+        return self.get(metric) is not None
+
+    def iteritems(self):
+        if self.binary_index is not None:
+            for metric, value in self.binary_index.iteritems():
+                if metric not in self.metrics:
+                    yield metric, value
+        for item in self.metrics.items():
+            yield item
+
+    def close(self):
+        if self.binary_index is not None:
+            self.binary_index.close()
+            self.binary_index = None
+
+
+def loadBinaryIndex(index_file):
+    """
+    Return the binary index of `index_file` if it's valid, otherwise None.
+    """
+    path = getBinaryIndexPath(index_file)
+    if not os.path.exists(path) or not os.path.exists(index_file):
+        return None
+    try:
+        binary_index = BinaryIndex(path)
+    except Exception as e:
+        log.err('Failed to load binary index %s: %s' % (path, e))
+        return None
+    st = os.stat(index_file)
+    if (st.st_ino != binary_index.text_ino or
+            st.st_size < binary_index.text_size or
+            (st.st_mtime != binary_index.text_mtime and
+             getTextIndexState(index_file, binary_index.text_size)[3] !=
+             binary_index.text_crc)):
+        # text index is replaced, rebuilt or truncated after conversion
+        log.msg('Ignore stale binary index %s' % path)
+        binary_index.close()
+        return None
+    return binary_index
@@ -1,13 +1,18 @@
 # coding: utf-8
 import cPickle as pickle
 
+import numpy as np
+
 from twisted.internet.protocol import Protocol, ServerFactory
 from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
 from twisted.internet.error import ConnectionDone
+from twisted.internet.defer import succeed, maybeDeferred
+from twisted.internet.threads import deferToThread
 
 from rurouni.state import events
 from rurouni import log
 from rurouni.cache import MetricCache
+from rurouni.codec import unpackFrame, InvalidFrame
 
 
 ### metric receiver
@@ -28,6 +33,12 @@ class MetricReceiver:
     def metricReceived(self, metric, datapoint):
         events.metricReceived(metric, datapoint)
 
+    def metricsReceived(self, datapoints):
+        events.metricsReceived(datapoints)
+
+    def metricArrayReceived(self, metrics, metric_ids, timestamps, values):
+        events.metricArrayReceived(metrics, metric_ids, timestamps, values)
+
 
 class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
     delimiter = '\n'
@@ -56,13 +67,39 @@ class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
         except:
             log.listener("invalid pickle received from %s, ignoring"
                          % self.peerName)
+            return
+        batch = []
         for metric, (timestamp, value) in datapoints:
             try:
                 datapoint = int(timestamp), float(value)
             except Exception as e:
                 log.debug("error in pickle receiver for: %s, error: %s" % (metric, e))
                 continue
-            self.metricReceived(metric, datapoint)
+            batch.append((metric, datapoint))
+        if batch:
+            self.metricsReceived(batch)
+
+
+class MetricBinaryReceiver(MetricReceiver, Int32StringReceiver):
+    """
+    Receive frames packed by `rurouni.codec.packFrame`, datapoints are
+    decoded as arrays and put to cache in bulk.
+    """
+    MAX_LENGTH = 16<<20  # 16M
+
+    def connectionMade(self):
+        MetricReceiver.connectionMade(self)
+
+    def stringReceived(self, data):
+        try:
+            names, records = unpackFrame(data)
+        except InvalidFrame as e:
+            log.listener("invalid frame received from %s: %s, ignoring"
+                         % (self.peerName, e))
+            return
+        if len(records):
+            self.metricArrayReceived(names, records['id'], records['ts'],
+                                     records['val'])
 
 
 class CacheManagementHandler(Int32StringReceiver):
@@ -71,6 +108,7 @@ class CacheManagementHandler(Int32StringReceiver):
     def connectionMade(self):
         peer = self.transport.getPeer()
         self.peerAddr = "%s:%s" % (peer.host, peer.port)
+        self.responses = succeed(None)
         log.query("%s connected" % self.peerAddr)
 
     def connectionLost(self, reason):
@@ -82,7 +120,53 @@ class CacheManagementHandler(Int32StringReceiver):
     def stringReceived(self, rawRequest):
         request = pickle.loads(rawRequest)
         log.query("%s" %  request)
-        datapoints = MetricCache.get(request['metric'])
-        rs = dict(datapoints=datapoints)
-        response = pickle.dumps(rs, protocol=-1)
+        if request['type'] == 'fetch':
+            # reading files would block the reactor
+            d = deferToThread(self.fetch, request)
+        else:
+            d = maybeDeferred(self.query, request)
+        # responses are sent in the order of requests
+        self.responses.addCallback(lambda _: d)
+        self.responses.addCallback(self.sendResponse)
+        self.responses.addErrback(self.queryFailed, request)
+
+    def sendResponse(self, rs):
+        response = pickle.dumps(rs, protocol=2)
         self.sendString(response)
+
+    def queryFailed(self, failure, request):
+        log.err('query %s failed: %s' % (request, failure.getErrorMessage()))
+        self.transport.loseConnection()
+
+    def query(self, request):
+        if request['type'] == 'cache-query-bulk':
+            # {'metrics': [metric, ...], 'pattern': glob pattern},
+            # both are optional.
+            return dict(datapoints=MetricCache.getMany(self.getMetrics(request)))
+        else:
+            datapoints = MetricCache.get(request['metric'])
+            return dict(datapoints=datapoints)
+
+    def fetch(self, request):
+        # same as 'cache-query-bulk', with 'from' and 'until', return
+        # {metric: (time_info, values)} merged from disk and cache.
+        series = MetricCache.fetch(self.getMetrics(request),
+                                   request['from'], request.get('until'))
+        return dict(series=dict((metric, self.toList(r))
+                                for metric, r in series.iteritems()))
+
+    @staticmethod
+    def getMetrics(request):
+        metrics = list(request.get('metrics', []))
+        if request.get('pattern'):
+            metrics.extend(MetricCache.globMetrics(request['pattern']))
+        return metrics
+
+    @staticmethod
+    def toList(fetched):
+        if fetched is None:
+            return None
+        time_info, values = fetched
+        rs = values.astype(object)
+        rs[np.isnan(values)] = None
+        return time_info, rs.tolist()
@@ -37,6 +37,10 @@ def createBaseService(options):
          settings.PICKLE_RECEIVER_PORT,
          protocols.MetricPickleReceiver
         ),
+        (settings.BINARY_RECEIVER_INTERFACE,
+         settings.BINARY_RECEIVER_PORT,
+         protocols.MetricBinaryReceiver
+        ),
     )
     for interface, port, protocol in receive_services:
         if port:
@@ -58,6 +62,8 @@ def createCacheService(options):
 
     MetricCache.init()
     state.events.metricReceived.addHandler(MetricCache.put)
+    state.events.metricsReceived.addHandler(MetricCache.put_many)
+    state.events.metricArrayReceived.addHandler(MetricCache.put_array)
     root_service = createBaseService(options)
 
     factory = ServerFactory()
@@ -66,6 +72,15 @@ def createCacheService(options):
                         interface=settings.CACHE_QUERY_INTERFACE)
     service.setServiceParent(root_service)
 
+    if settings.ENABLE_WAL:
+        from rurouni.wal import WALService
+        wal = MetricCache.wal
+        state.events.metricReceived.addHandler(wal.append)
+        state.events.metricsReceived.addHandler(wal.appendMany)
+        state.events.metricArrayReceived.addHandler(wal.appendArray)
+        service = WALService(wal, MetricCache, settings.WAL_FLUSH_INTERVAL)
+        service.setServiceParent(root_service)
+
     from rurouni.writer import WriterService
     service = WriterService()
     service.setServiceParent(root_service)
@@ -32,6 +32,17 @@ class Event(object):
 metricReceived = Event('metricReceived',
                        lambda *a, **ka: instrumentation.incr('metricReceived'))
 
+# a batch of (metric, datapoint) received
+metricsReceived = Event('metricsReceived',
+                        lambda datapoints, *a, **ka:
+                            instrumentation.incr('metricReceived', len(datapoints)))
+
+# datapoints received as arrays, i-th datapoint is
+# (metrics[metric_ids[i]], (timestamps[i], values[i]))
+metricArrayReceived = Event('metricArrayReceived',
+                            lambda metrics, metric_ids, *a, **ka:
+                                instrumentation.incr('metricReceived', len(metric_ids)))
+
 cacheFull = Event('cacheFull')
 cacheFull.addHandler(lambda *a, **ka: instrumentation.incr('cacheOverflow'))
 cacheFull.addHandler(lambda *a, **ka: setattr(state, 'cacheTooFull', True))
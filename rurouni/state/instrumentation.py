@@ -74,6 +74,7 @@ def record_metrics():
     creates = _stats.get('creates', 0)
     dropped_creates = _stats.get('droppedCreates', 0)
     errors = _stats.get('errors', 0)
+    dropped_points = _stats.get('droppedPoints', 0)
     cache_queries = _stats.get('cacheQueries', 0)
     cache_overflow = _stats.get('cacheOverflow', 0)
 
@@ -90,10 +91,14 @@ def record_metrics():
     record('creates', creates)
     record('droppedCreates', dropped_creates)
     record('errors', errors)
+    record('droppedPoints', dropped_points)
     record('cacheQueries', cache_queries)
     record('cacheOverflow', cache_overflow)
 
     record('metricReceived', _stats.get('metricReceived', 0))
+    for stat, val in _stats.items():
+        if stat.startswith('writerQueueDepth.'):
+            record(stat, val)
     record('cpuUsage', get_cpu_usage())
     # this only workds on linux
     try:
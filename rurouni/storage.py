@@ -3,12 +3,16 @@
 import os
 import re
 import glob
+import multiprocessing
+from itertools import imap
+from collections import OrderedDict
 from os.path import join, sep, splitext, basename, dirname
 
 import kenshin
 from kenshin.utils import mkdir_p
 from rurouni import log
 from rurouni.conf import settings, OrderedConfigParser
+from rurouni.index import convertIndex
 
 
 def getFilePath(schema_name, file_idx):
@@ -46,41 +50,144 @@ def getMetricPathByInstanceDir(instance_link_dir, metric):
     return join(instance_link_dir, path + ".hs")
 
 
-def rebuildIndex(instance_data_dir, instance_index_file):
+def _scanDataFile(file_path):
+    return file_path, kenshin.read_tags(file_path)
+
+
+def _fileIdx(file_path):
+    try:
+        return int(splitext(basename(file_path))[0])
+    except ValueError:
+        return file_path
+
+
+class Checkpoint(object):
     """
-    Rebuild index file from data file, if a data file has no valid metric,
-    we will remove it.
+    Record of finished schema dirs in a rebuild, each line is
+    "schema_name output_size".
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = OrderedDict()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        schema_name, size = line.split()
+                        self.done[schema_name] = int(size)
+                    except ValueError:
+                        # partial line of an interrupted write
+                        break
+
+    def outputSize(self):
+        return self.done.values()[-1] if self.done else 0
+
+    def add(self, schema_name, size=0):
+        self.done[schema_name] = size
+        with open(self.path, 'a') as f:
+            f.write('%s %d\n' % (schema_name, size))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def scanDataDir(instance_data_dir, processes=None, skip_schemas=(),
+                progress=None):
+    """
+    Yield (schema_name, [(file_path, tag_list)]) of each schema dir, tags
+    of files in a schema dir are read by a process pool, results are
+    in the order of file index.
+
+    `progress(done_file_cnt, total_file_cnt)` is called after each file.
     """
-    out = open(instance_index_file, 'w')
-    for schema_name in os.listdir(instance_data_dir):
+    schema_files = []
+    for schema_name in sorted(os.listdir(instance_data_dir)):
+        if schema_name in skip_schemas:
+            continue
         hs_file_pat = os.path.join(instance_data_dir, schema_name, '*.hs')
-        for fp in glob.glob(hs_file_pat):
-            with open(fp) as f:
+        schema_files.append((schema_name,
+                             sorted(glob.glob(hs_file_pat), key=_fileIdx)))
+    total = sum(len(files) for _, files in schema_files)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        done = 0
+        for schema_name, files in schema_files:
+            if pool is None:
+                results = imap(_scanDataFile, files)
+            else:
+                results = pool.imap(_scanDataFile, files, chunksize=16)
+            rs = []
+            for result in results:
+                rs.append(result)
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+            yield schema_name, rs
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def rebuildIndex(instance_data_dir, instance_index_file, processes=None,
+                 progress=None):
+    """
+    Rebuild index file from data file, if a data file has no valid metric,
+    we will remove it. The binary index is rebuilt too.
+
+    Schema dirs are scanned in parallel, an interrupted rebuild is
+    resumed from the checkpoint file.
+    """
+    checkpoint = Checkpoint(instance_index_file + '.ckpt')
+    if checkpoint.done and os.path.exists(instance_index_file):
+        out = open(instance_index_file, 'r+')
+        # drop the output of the unfinished schema dir
+        out.truncate(checkpoint.outputSize())
+        out.seek(0, os.SEEK_END)
+    else:
+        checkpoint.done.clear()
+        out = open(instance_index_file, 'w')
+
+    with out:
+        for schema_name, rs in scanDataDir(instance_data_dir, processes,
+                                           checkpoint.done, progress):
+            for fp, metric_list in rs:
                 empty_flag = True
-                header = kenshin.header(f)
-                metric_list = header['tag_list']
                 file_id = splitext(basename(fp))[0]
                 for i, metric in enumerate(metric_list):
                     if metric != '':
                         empty_flag = False
                         out.write('%s %s %s %s\n' %
                                   (metric, schema_name, file_id, i))
-            if empty_flag:
-                os.remove(fp)
-    out.close()
-
-
-def rebuildLink(instance_data_dir, instance_link_dir):
-    for schema_name in os.listdir(instance_data_dir):
-        hs_file_pat = os.path.join(instance_data_dir, schema_name, '*.hs')
-        for fp in glob.glob(hs_file_pat):
-            with open(fp) as f:
-                header = kenshin.header(f)
-                metric_list = header['tag_list']
-                for metric in metric_list:
-                    if metric != '':
-                        link_path = getMetricPathByInstanceDir(instance_link_dir, metric)
-                        _createLinkHelper(link_path, fp)
+                if empty_flag:
+                    os.remove(fp)
+            out.flush()
+            checkpoint.add(schema_name, out.tell())
+    convertIndex(instance_index_file)
+    checkpoint.remove()
+
+
+def rebuildLink(instance_data_dir, instance_link_dir, processes=None,
+                progress=None):
+    checkpoint = Checkpoint(instance_link_dir.rstrip(sep) + '.ckpt')
+    for schema_name, rs in scanDataDir(instance_data_dir, processes,
+                                       checkpoint.done, progress):
+        for fp, metric_list in rs:
+            for metric in metric_list:
+                if metric != '':
+                    link_path = getMetricPathByInstanceDir(instance_link_dir, metric)
+                    # already linked before interrupted
+                    if os.path.islink(link_path) and os.readlink(link_path) == fp:
+                        continue
+                    _createLinkHelper(link_path, fp)
+        checkpoint.add(schema_name)
+    checkpoint.remove()
 
 
 class Archive:
@@ -107,7 +214,7 @@ class Schema(object):
 
 class DefaultSchema(Schema):
     def __init__(self, name, xFilesFactor, aggregationMethod, archives,
-                 cache_retention, metrics_max_num, cache_ratio):
+                 cache_retention, metrics_max_num, cache_ratio, flags=0):
         self.name = name
         self.xFilesFactor = xFilesFactor
         self.aggregationMethod = aggregationMethod
@@ -115,6 +222,7 @@ class DefaultSchema(Schema):
         self.cache_retention = cache_retention
         self.metrics_max_num = metrics_max_num
         self.cache_ratio = cache_ratio
+        self.flags = flags
 
     def match(self, metric):
         return True
@@ -122,7 +230,7 @@ class DefaultSchema(Schema):
 
 class PatternSchema(Schema):
     def __init__(self, name, pattern, xFilesFactor, aggregationMethod, archives,
-                 cache_retention, metrics_max_num, cache_ratio):
+                 cache_retention, metrics_max_num, cache_ratio, flags=0):
         self.name = name
         self.pattern = re.compile(pattern)
         self.xFilesFactor = xFilesFactor
@@ -131,11 +239,108 @@ class PatternSchema(Schema):
         self.cache_retention = cache_retention
         self.metrics_max_num = metrics_max_num
         self.cache_ratio = cache_ratio
+        self.flags = flags
 
     def match(self, metric):
         return self.pattern.match(metric)
 
 
+class SchemaMatcher(object):
+    """
+    Match metric against a list of schemas, return the first matched one.
+
+    Patterns are combined into a few alternation regexes with a named
+    group for each schema, so a metric is matched in one pass instead of
+    trying each pattern in order. Patterns which can't be combined
+    (backreferences, conditional groups, inline flags) are matched alone. Results are
+    memoized in a bounded LRU cache.
+    """
+    # python's re supports at most 100 groups in a pattern
+    MAX_GROUPS = 99
+    # patterns change meaning when combined with others: numbered or
+    # named backreferences, conditional groups and inline flags.
+    _STANDALONE_PAT = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)')
+
+    def __init__(self, schemas, cache_size=100000):
+        self.schemas = list(schemas)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.matchers = self._compile(self.schemas)
+
+    def _compile(self, schemas):
+        """
+        Return a list of (regex, schema), schema is None if regex is
+        a combined one.
+        """
+        matchers = []
+        chunk = []
+        chunk_groups = 0
+        for i, schema in enumerate(schemas):
+            if not isinstance(schema, PatternSchema):
+                # default schema matches all
+                matchers.extend(self._combine(chunk))
+                matchers.append((None, schema))
+                return matchers
+            regex = schema.pattern
+            if self._STANDALONE_PAT.search(regex.pattern):
+                matchers.extend(self._combine(chunk))
+                matchers.append((regex, schema))
+                chunk, chunk_groups = [], 0
+                continue
+            groups = regex.groups + 1
+            if chunk_groups + groups > self.MAX_GROUPS:
+                matchers.extend(self._combine(chunk))
+                chunk, chunk_groups = [], 0
+            chunk.append((i, schema))
+            chunk_groups += groups
+        matchers.extend(self._combine(chunk))
+        return matchers
+
+    def _combine(self, chunk):
+        if not chunk:
+            return []
+        combined = '|'.join('(?P<_s%d>%s)' % (i, schema.pattern.pattern)
+                            for i, schema in chunk)
+        try:
+            return [(re.compile(combined), None)]
+        except (re.error, AssertionError, OverflowError):
+            # e.g. duplicated group names in patterns, split and retry
+            if len(chunk) == 1:
+                return [(chunk[0][1].pattern, chunk[0][1])]
+            half = len(chunk) / 2
+            return self._combine(chunk[:half]) + self._combine(chunk[half:])
+
+    def match(self, metric):
+        try:
+            schema = self.cache.pop(metric)
+        except KeyError:
+            schema = self._match(metric)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[metric] = schema
+        return schema
+
+    def _match(self, metric):
+        for regex, schema in self.matchers:
+            if regex is None:
+                return schema
+            m = regex.match(metric)
+            if m:
+                if schema is not None:
+                    return schema
+                return self.schemas[int(m.lastgroup[2:])]
+        return None
+
+
+# boolean schema options of kenshin format flags
+FLAG_OPTIONS = {
+    'compressarchives': kenshin.FLAG_COMPRESSED,
+    'implicittimestamps': kenshin.FLAG_IMPLICIT_TS,
+    'columnmajor': kenshin.FLAG_COLUMN_MAJOR,
+    'pagealigned': kenshin.FLAG_PAGE_ALIGNED,
+}
+
+
 def loadStorageSchemas(conf_file):
     schema_list = []
     config = OrderedConfigParser()
@@ -153,6 +358,15 @@ def loadStorageSchemas(conf_file):
             options.get('cacheretention'))
         metrics_max_num = options.get('metricsperfile')
         cache_ratio = 1.2
+        flags = 0
+        for option, flag in FLAG_OPTIONS.items():
+            if options.get(option, 'false').lower() == 'true':
+                flags |= flag
+        value_type = options.get('valuetype', 'float64')
+        try:
+            flags |= kenshin.VALUE_TYPE_FLAGS[value_type]
+        except KeyError:
+            log.err("Invalid value type '%s' found in %s." % (value_type, section))
 
         try:
             kenshin.validate_archive_list(archives, xff)
@@ -161,7 +375,7 @@ def loadStorageSchemas(conf_file):
 
         schema = PatternSchema(section, pattern, float(xff), agg, archives,
                                int(cache_retention), int(metrics_max_num),
-                               float(cache_ratio))
+                               float(cache_ratio), flags)
         schema_list.append(schema)
     schema_list.append(defaultSchema)
     return schema_list
@@ -183,12 +397,10 @@ defaultSchema = DefaultSchema(
 class StorageSchemas(object):
     def __init__(self, conf_file):
         self.schemas = loadStorageSchemas(conf_file)
+        self.matcher = SchemaMatcher(self.schemas)
 
     def getSchemaByMetric(self, metric):
-        for schema in self.schemas:
-            if schema.match(metric):
-                return schema
-        return defaultSchema
+        return self.matcher.match(metric) or defaultSchema
 
     def getSchemaByName(self, schema_name):
         for schema in self.schemas:
@@ -0,0 +1,231 @@
+# coding: utf-8
+"""
+Write-ahead log of received datapoints.
+
+Datapoints are buffered in memory and appended to the current segment
+by a group commit every WAL_FLUSH_INTERVAL seconds. A segment is
+rotated when it's larger than WAL_SEGMENT_SIZE. Each record is
+
+    length, crc32, frame
+
+where frame is packed by `rurouni.codec`.
+
+Datapoints older than the oldest datapoint in cache or being written
+(the watermark) are on disk. The checkpoint is the position (segment
+seq, offset) of the first record with datapoints not older than the
+watermark, or the end of log if the cache is empty. It's saved in
+checkpoint file, closed segments before it are removed and records
+before it are skipped when replaying. A position rather than a
+timestamp is saved, so late datapoints appended after it are replayed.
+"""
+import os
+import glob
+import struct
+import zlib
+
+from twisted.application.service import Service
+from twisted.internet.task import LoopingCall
+
+from kenshin.utils import mkdir_p
+from rurouni import log
+from rurouni.codec import packFrame, packArrays, unpackFrame, InvalidFrame
+
+
+RECORD_HEADER_FORMAT = '!LL'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+SEGMENT_SUFFIX = '.wal'
+CHECKPOINT_FILE = 'checkpoint'
+
+
+class WriteAheadLog(object):
+    def __init__(self, wal_dir, segment_size):
+        self.wal_dir = wal_dir
+        self.segment_size = segment_size
+        mkdir_p(wal_dir)
+        # [(seq, path)] of closed segments
+        self.segments = sorted(
+            (int(os.path.basename(p)[:-len(SEGMENT_SUFFIX)]), p)
+            for p in glob.glob(os.path.join(wal_dir, '*' + SEGMENT_SUFFIX)))
+        self.checkpoint = self._readCheckpoint()
+        # records of segments not replayed are unknown
+        self.unreplayed = set(seq for seq, _ in self.segments)
+        # [(seq, offset, max_ts)] of records after checkpoint
+        self.records = []
+
+        self.fh = None
+        self.seq = max([seq for seq, _ in self.segments] +
+                       [self.checkpoint[0]])
+        self.offset = 0
+        self.datapoints = []
+        self.frames = []
+
+    def _readCheckpoint(self):
+        # a timestamp saved by old versions is ignored, so all
+        # segments are replayed
+        try:
+            with open(os.path.join(self.wal_dir, CHECKPOINT_FILE)) as f:
+                seq, offset = map(int, f.read().split())
+                return seq, offset
+        except (IOError, ValueError):
+            return 0, 0
+
+    def _writeCheckpoint(self, position):
+        path = os.path.join(self.wal_dir, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d' % position)
+        os.rename(path + '.tmp', path)
+        self.checkpoint = position
+
+    def replay(self):
+        """
+        Yield (names, records) of datapoints after checkpoint in closed
+        segments, a torn record at the end of segment is ignored.
+        """
+        checkpoint_seq, checkpoint_offset = self.checkpoint
+        for seq, path in self.segments:
+            if seq < checkpoint_seq:
+                self.unreplayed.discard(seq)
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            offset = checkpoint_offset if seq == checkpoint_seq else 0
+            while offset + RECORD_HEADER_SIZE <= len(data):
+                start = offset
+                length, crc = struct.unpack_from(RECORD_HEADER_FORMAT, data, offset)
+                frame = data[offset + RECORD_HEADER_SIZE:
+                             offset + RECORD_HEADER_SIZE + length]
+                if len(frame) < length or zlib.crc32(frame) & 0xffffffff != crc:
+                    log.msg('WAL segment %s is truncated at %d' % (path, offset))
+                    break
+                offset += RECORD_HEADER_SIZE + length
+                try:
+                    names, records = unpackFrame(frame)
+                except InvalidFrame as e:
+                    log.err('invalid frame in WAL segment %s: %s' % (path, e))
+                    continue
+                if not len(records):
+                    continue
+                self.records.append((seq, start, int(records['ts'].max())))
+                yield names, records
+            self.unreplayed.discard(seq)
+
+    def open(self):
+        """
+        Open a new segment for appending.
+        """
+        self.seq += 1
+        path = os.path.join(self.wal_dir, '%020d%s' % (self.seq, SEGMENT_SUFFIX))
+        self.fh = open(path, 'ab')
+        self.offset = 0
+
+    def append(self, metric, datapoint):
+        self.datapoints.append((metric, datapoint))
+
+    def appendMany(self, datapoints):
+        self.datapoints.extend(datapoints)
+
+    def appendArray(self, metrics, metric_ids, timestamps, values):
+        self.frames.append((packArrays(metrics, metric_ids, timestamps, values),
+                            int(timestamps.max())))
+
+    def commit(self):
+        """
+        Write buffered datapoints to current segment.
+        """
+        frames, self.frames = self.frames, []
+        if self.datapoints:
+            datapoints, self.datapoints = self.datapoints, []
+            max_ts = max(ts for _, (ts, _) in datapoints)
+            frames.append((packFrame(datapoints), max_ts))
+        if not frames:
+            return
+
+        buf = []
+        for frame, _ in frames:
+            buf.append(struct.pack(RECORD_HEADER_FORMAT, len(frame),
+                                   zlib.crc32(frame) & 0xffffffff))
+            buf.append(frame)
+        data = ''.join(buf)
+        self.fh.write(data)
+        self.fh.flush()
+        # records of a commit are flushed to kenshin files together
+        self.records.append((self.seq, self.offset,
+                             max(max_ts for _, max_ts in frames)))
+        self.offset += len(data)
+
+        if self.offset >= self.segment_size:
+            self._rotate()
+
+    def _rotate(self):
+        self._closeSegment()
+        self.open()
+
+    def _closeSegment(self):
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        self.segments.append((self.seq, self.fh.name))
+        self.fh = None
+
+    def truncate(self, watermark):
+        """
+        Move checkpoint to the first record with datapoints not older
+        than `watermark`, None means all datapoints are flushed. Closed
+        segments before checkpoint are removed.
+        """
+        if self.fh is not None:
+            position = (self.seq, self.offset)
+        else:
+            position = (self.seq + 1, 0)
+        if watermark is not None:
+            for seq, offset, max_ts in self.records:
+                if max_ts >= watermark:
+                    position = (seq, offset)
+                    break
+        if self.unreplayed:
+            position = min(position, (min(self.unreplayed), 0))
+        if position <= self.checkpoint:
+            return
+        self._writeCheckpoint(position)
+        self.records = [r for r in self.records if r[:2] >= position]
+        while self.segments and self.segments[0][0] < position[0]:
+            os.remove(self.segments[0][1])
+            del self.segments[0]
+
+    def close(self):
+        """
+        Commit buffered datapoints and close current segment, it can be
+        removed by `truncate` then.
+        """
+        if self.fh is not None:
+            self.commit()
+            self._closeSegment()
+
+
+class WALService(Service):
+    def __init__(self, wal, cache, flush_interval):
+        self.wal = wal
+        self.cache = cache
+        self.commit_task = LoopingCall(self.commit)
+        self.flush_interval = flush_interval
+
+    def commit(self):
+        try:
+            self.wal.commit()
+            self.wal.truncate(self.cache.oldestUnflushedTs())
+        except Exception as e:
+            log.err('WAL commit error: %s' % e)
+
+    def startService(self):
+        self.commit_task.start(self.flush_interval, False)
+        Service.startService(self)
+
+    def stopService(self):
+        self.commit_task.stop()
+        # writer service is stopped before this service, so datapoints
+        # flushed when stopping are not replayed.
+        try:
+            self.wal.close()
+            self.wal.truncate(self.cache.oldestUnflushedTs())
+        except Exception as e:
+            log.err('WAL close error: %s' % e)
+        Service.stopService(self)
@@ -18,23 +18,57 @@ class WriterService(Service):
         pass
 
     def startService(self):
-        reactor.callInThread(writeForever)
+        kenshin.header_cache.resize(settings.HEADER_CACHE_SIZE)
+        worker_cnt = settings.WRITER_THREADS
+        # writers and creator run forever in reactor's thread pool,
+        # make sure there are still threads left for others.
+        reactor.suggestThreadPoolSize(worker_cnt + 11)
+        reactor.callInThread(createForever)
+        for worker_idx in range(worker_cnt):
+            reactor.callInThread(writeForever, worker_idx, worker_cnt)
         Service.startService(self)
 
     def stopService(self):
+        try:
+            MetricCache.createPendingMetrics()
+        except Exception as e:
+            log.err('create error when stopping service: %s' % e)
         try:
             file_cache_idxs = MetricCache.getAllFileCaches()
             writeCachedDataPointsWhenStop(file_cache_idxs)
         except Exception as e:
             log.err('write error when stopping service: %s' % e)
+        try:
+            MetricCache.compactIndex()
+        except Exception as e:
+            log.err('compact index error when stopping service: %s' % e)
         Service.stopService(self)
 
 
-def writeForever():
+def createForever():
+    max_creates = settings.MAX_CREATES_PER_SECOND
+    while reactor.running:
+        start = time.time()
+        cnt = 0
+        try:
+            cnt = MetricCache.createPendingMetrics(max_creates)
+        except Exception as e:
+            log.err('create error: %s' % e)
+        if cnt >= max_creates:
+            # rate limited, wait for the rest of this second
+            time.sleep(max(0, start + 1 - time.time()))
+        elif not cnt:
+            time.sleep(0.1)
+
+
+def writeForever(worker_idx=0, worker_cnt=1):
+    queue_depth_stat = 'writerQueueDepth.%d' % worker_idx
     while reactor.running:
         write = False
         try:
-            file_cache_idxs = MetricCache.writableFileCaches()
+            file_cache_idxs = MetricCache.writableFileCaches(worker_idx,
+                                                             worker_cnt)
+            instrumentation.max(queue_depth_stat, len(file_cache_idxs))
             if file_cache_idxs:
                 write = writeCachedDataPoints(file_cache_idxs)
         except Exception as e:
@@ -47,37 +81,72 @@ def writeForever():
 
 def writeCachedDataPoints(file_cache_idxs):
     pop_func = MetricCache.pop
+    popped = []
+    batch = []
     for schema_name, file_idx in file_cache_idxs:
-        datapoints = pop_func(schema_name, file_idx)
+        file_batch, datapoints = pop_func(schema_name, file_idx)
+        if not datapoints:
+            continue
         file_path = getFilePath(schema_name, file_idx)
-
-        try:
-            t1 = time.time()
-            log.debug('filepath: %s, datapoints: %s' % (file_path, datapoints))
-            kenshin.update(file_path, datapoints)
-            update_time = time.time() - t1
-        except Exception as e:
-            log.err('Error writing to %s: %s' % (file_path, e))
+        log.debug('filepath: %s, datapoints: %s' % (file_path, datapoints))
+        popped.append((schema_name, file_idx, file_batch))
+        batch.append((file_path, datapoints))
+    if not batch:
+        return False
+
+    # all files are updated in one batch, writes of each file
+    # are coalesced before flushing to disk. Popped datapoints are
+    # visible to readers until they are released, and those failed
+    # to write are retried later.
+    try:
+        rs = kenshin.update_many(batch, engine=settings.STORAGE_ENGINE)
+    except Exception:
+        for schema_name, file_idx, file_batch in popped:
+            releaseBatch(schema_name, file_idx, file_batch, False)
+        raise
+
+    written = False
+    for i, (file_path, update_time, error) in enumerate(rs):
+        schema_name, file_idx, file_batch = popped[i]
+        if error is not None:
+            log.err('Error writing to %s: %s' % (file_path, error))
             instrumentation.incr('errors')
         else:
-            point_cnt = len(datapoints)
+            written = True
+            point_cnt = len(batch[i][1])
             instrumentation.incr('committedPoints', point_cnt)
             instrumentation.append('updateTimes', update_time)
 
             if settings.LOG_UPDATES:
                 log.updates("wrote %d datapoints for %s in %.5f secs" %
                             (point_cnt, schema_name, update_time))
+        releaseBatch(schema_name, file_idx, file_batch, error is None)
 
-    return True
+    return written
 
 
 def writeCachedDataPointsWhenStop(file_cache_idxs):
     pop_func = MetricCache.pop
     for schema_name, file_idx in file_cache_idxs:
-        datapoints = pop_func(schema_name, file_idx, int(time.time()), False)
+        file_batch, datapoints = pop_func(schema_name, file_idx,
+                                          int(time.time()))
         if datapoints:
             file_path = getFilePath(schema_name, file_idx)
             try:
-                kenshin.update(file_path, datapoints)
+                kenshin.update(file_path, datapoints,
+                               engine=settings.STORAGE_ENGINE)
             except Exception as e:
+                # not released, so it's kept in WAL and replayed
+                # at next start
                 log.err('Error writing to %s: %s' % (file_path, e))
+            else:
+                releaseBatch(schema_name, file_idx, file_batch)
+
+
+def releaseBatch(schema_name, file_idx, file_batch, written=True):
+    dropped = MetricCache.release(schema_name, file_idx, file_batch, written)
+    if dropped:
+        log.err('dropped %d datapoints of %s after %d retries' %
+                (dropped, getFilePath(schema_name, file_idx),
+                 settings.MAX_WRITE_RETRIES))
+        instrumentation.incr('droppedPoints', dropped)
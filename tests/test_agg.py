@@ -1,8 +1,10 @@
 # coding: utf-8
 
 import unittest
+import numpy as np
 
 from kenshin.agg import Agg
+from kenshin.consts import NULL_VALUE
 
 
 class TestAgg(unittest.TestCase):
@@ -37,3 +39,20 @@ class TestAgg(unittest.TestCase):
     def test_agg_min(self):
         func = self._get_agg_func_by_name('min')
         self.assertEqual(func(self.vals), 0.0)
+
+    def test_aggregate_array(self):
+        vals = np.array(self.vals).reshape(2, 5, 1)
+        mask = np.ones(vals.shape, dtype=bool)
+        mask[0, 4, 0] = False
+        mask[1, :, 0] = False
+        expected = {
+            'average': 1.5,
+            'sum': 6.0,
+            'last': 3.0,
+            'max': 3.0,
+            'min': 0.0,
+        }
+        for agg_name, val in expected.items():
+            agg_id = Agg.get_agg_id(agg_name)
+            rs = Agg.aggregate_array(agg_id, vals, mask)
+            self.assertEqual(rs.tolist(), [[val], [NULL_VALUE]])
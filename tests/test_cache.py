@@ -0,0 +1,421 @@
+# coding: utf-8
+import os
+import shutil
+import time
+import random
+import struct
+import unittest
+import cPickle as pickle
+
+import numpy as np
+
+import kenshin
+from kenshin.agg import Agg
+from kenshin.consts import NULL_VALUE
+from rurouni.conf import settings
+from rurouni.cache import MetricCache, mergeCachedPoints
+from rurouni.codec import packFrame, unpackFrame
+from rurouni import protocols
+from twisted.test.proto_helpers import StringTransport
+
+
+SCHEMAS_CONF = """\
+[test]
+pattern = ^test\\.
+xFilesFactor = 1.0
+aggregationMethod = average
+retentions = 1s:60s,3s:3m
+cacheRetention = 10s
+metricsPerFile = 4
+"""
+
+
+class TestMetricCacheBase(unittest.TestCase):
+    root_dir = '/tmp/rurouni'
+
+    def setUp(self):
+        if os.path.exists(self.root_dir):
+            shutil.rmtree(self.root_dir)
+        conf_dir = os.path.join(self.root_dir, 'conf')
+        os.makedirs(conf_dir)
+        with open(os.path.join(conf_dir, 'storage-schemas.conf'), 'w') as f:
+            f.write(SCHEMAS_CONF)
+
+        self.old_settings = settings.copy()
+        settings.update(
+            instance='a',
+            CONF_DIR=conf_dir,
+            LOCAL_DATA_DIR=os.path.join(self.root_dir, 'data'),
+            LOCAL_LINK_DIR=os.path.join(self.root_dir, 'link'),
+            INDEX_FILE=os.path.join(self.root_dir, 'data', 'a.idx'),
+            ENABLE_WAL=False,
+        )
+        os.makedirs(settings.LOCAL_DATA_DIR)
+        self.cache = self._newCache()
+
+    def tearDown(self):
+        self._closeCache(self.cache)
+        settings.clear()
+        settings.update(self.old_settings)
+        kenshin.header_cache.invalidate()
+        shutil.rmtree(self.root_dir)
+
+    @staticmethod
+    def _newCache():
+        cache = type(MetricCache)()
+        cache.init()
+        return cache
+
+    @staticmethod
+    def _closeCache(cache):
+        cache.metrics_fh.close()
+        cache.metrics_fh = None
+        cache.metric_idxs.close()
+
+
+class TestMetricCache(TestMetricCacheBase):
+
+    def test_create_metric(self):
+        self.cache.put('test.a', (1411628779, 1.0))
+        schema_name, file_idx, pos_idx = self.cache.metric_idxs['test.a']
+        self.assertEqual(self.cache.createPendingMetrics(), 1)
+
+        file_path = os.path.join(settings.LOCAL_DATA_DIR, 'a', schema_name,
+                                 '%d.hs' % file_idx)
+        self.assertEqual(kenshin.read_tags(file_path)[pos_idx], 'test.a')
+        link_path = os.path.join(settings.LOCAL_LINK_DIR, 'a', 'test', 'a.hs')
+        self.assertEqual(os.readlink(link_path), file_path)
+
+    def test_create_metric_error(self):
+        self.cache.put('test.a', (1411628779, 1.0))
+        schema_name, file_idx, pos_idx = self.cache.metric_idxs['test.a']
+        # a file is in the way of schema dir
+        with open(os.path.join(settings.LOCAL_DATA_DIR, 'a'), 'w'):
+            pass
+        self.cache.createPendingMetrics()
+
+        self.assertNotIn('test.a', self.cache.metric_idxs)
+        file_cache = self.cache.schema_caches[schema_name][file_idx]
+        self.assertFalse(file_cache.pending_creates)
+        self.assertEqual(self.cache.get('test.a'), [])
+
+        # created again by the next datapoint
+        os.remove(os.path.join(settings.LOCAL_DATA_DIR, 'a'))
+        self.cache.put('test.a', (1411628780, 2.0))
+        self.assertEqual(self.cache.createPendingMetrics(), 1)
+        self.assertIn('test.a', self.cache.metric_idxs)
+
+    def test_compact_index(self):
+        for i in range(6):
+            self.cache.put('test.%d' % i, (1411628779, float(i)))
+        self.cache.createPendingMetrics()
+        # pending metrics are not compacted
+        self.cache.put('test.pending', (1411628779, 1.0))
+        self.cache.compactIndex()
+        self.cache.createPendingMetrics()
+        idxs = dict((m, self.cache.metric_idxs[m])
+                    for m in ['test.%d' % i for i in range(6)] + ['test.pending'])
+        self._closeCache(self.cache)
+
+        self.cache = self._newCache()
+        binary_index = self.cache.metric_idxs.binary_index
+        self.assertIsNotNone(binary_index)
+        self.assertIsNone(binary_index.get('test.pending'))
+        for metric, idx in idxs.iteritems():
+            self.assertEqual(self.cache.metric_idxs[metric], idx)
+        # positions in binary index are not allocated again
+        self.cache.put('test.new', (1411628779, 1.0))
+        self.assertNotIn(self.cache.metric_idxs['test.new'], idxs.values())
+
+    def test_put_array_same_as_put_many(self):
+        metrics = ['test.%d' % i for i in range(6)]
+        now_ts = 1411628779
+        rand = random.Random(0)
+        # out of order and duplicated datapoints in two files
+        datapoints = [(rand.choice(metrics),
+                       (now_ts + rand.randint(0, 20), rand.random()))
+                      for _ in range(200)]
+
+        other = self._newCache()
+        self.addCleanup(self._closeCache, other)
+        for metric in metrics:
+            self.cache.getMetricIdx(metric)
+            other.getMetricIdx(metric)
+
+        for i in range(0, len(datapoints), 50):
+            batch = datapoints[i: i + 50]
+            self.cache.put_many(batch)
+            names, records = unpackFrame(packFrame(batch))
+            other.put_array(names, records['id'], records['ts'],
+                            records['val'])
+
+        file_caches = self.cache.schema_caches['test'].file_caches
+        other_file_caches = other.schema_caches['test'].file_caches
+        self.assertEqual(len(file_caches), 2)
+        for file_cache, other_file_cache in zip(file_caches, other_file_caches):
+            self.assertEqual(file_cache.start_ts, other_file_cache.start_ts)
+            self.assertEqual(file_cache.start_offset,
+                             other_file_cache.start_offset)
+            self.assertEqual(file_cache.max_ts, other_file_cache.max_ts)
+            self.assertTrue(np.array_equal(file_cache.points,
+                                           other_file_cache.points))
+        self.assertEqual(self.cache.getMany(metrics), other.getMany(metrics))
+
+    def test_glob_metrics(self):
+        metrics = ['test.a.x', 'test.b.x', 'test.b.y', 'test.c']
+        for metric in metrics:
+            self.cache.put(metric, (1411628779, 1.0))
+        self.cache.createPendingMetrics()
+
+        self.assertEqual(sorted(self.cache.globMetrics('test.*.x')),
+                         ['test.a.x', 'test.b.x'])
+        self.assertEqual(sorted(self.cache.globMetrics('test.*')), ['test.c'])
+        self.assertEqual(self.cache.globMetrics('other.*'), [])
+
+    def _popTestA(self, now_ts):
+        self.cache.put('test.a', (now_ts - 10, 1.0))
+        self.cache.createPendingMetrics()
+        schema_name, file_idx, pos_idx = self.cache.metric_idxs['test.a']
+        file_path = os.path.join(settings.LOCAL_DATA_DIR, 'a', schema_name,
+                                 '%d.hs' % file_idx)
+        batch, datapoints = self.cache.pop(schema_name, file_idx)
+        kenshin.update(file_path, datapoints, now_ts)
+        self.cache.release(schema_name, file_idx, batch)
+        return schema_name, file_idx
+
+    @staticmethod
+    def _known(datapoints, pos_idx=0):
+        return [(ts, vals[pos_idx]) for ts, vals in datapoints
+                if vals[pos_idx] != NULL_VALUE]
+
+    def test_read_popped_points(self):
+        now_ts = int(time.time()) - 30
+        schema_name, file_idx = self._popTestA(now_ts)
+
+        for i in range(3):
+            self.cache.put('test.a', (now_ts + i, float(i)))
+        # popped by writer, but not written yet
+        batch, _ = self.cache.pop(schema_name, file_idx)
+        self.cache.put('test.a', (now_ts + 3, 3.0))
+        self.assertEqual(self.cache.get('test.a'),
+                         [(now_ts + i, float(i)) for i in range(4)])
+        time_info, values = self.cache.fetch(['test.a'], now_ts - 10,
+                                             now_ts + 4)['test.a']
+        self.assertEqual(time_info, (now_ts - 10, now_ts + 4, 1))
+        self.assertEqual(values[0], 1.0)
+        self.assertEqual(values[-4:].tolist(), [0.0, 1.0, 2.0, 3.0])
+
+        # released without writing, kept until retried
+        self.cache.release(schema_name, file_idx, batch, False)
+        self.assertEqual(self.cache.get('test.a'),
+                         [(now_ts + i, float(i)) for i in range(4)])
+
+    def test_block_is_copied(self):
+        now_ts = int(time.time()) - 30
+        schema_name, file_idx = self._popTestA(now_ts)
+        pos_idx = self.cache.metric_idxs['test.a'][2]
+        for i in range(3):
+            self.cache.put('test.a', (now_ts + i, float(i)))
+        file_cache = self.cache.schema_caches[schema_name][file_idx]
+        timestamps, block = file_cache.getBlock(now_ts + 3)
+        _, column = file_cache.getBlock(now_ts + 3, [pos_idx])
+        self.assertEqual(column.shape, (3, 1))
+
+        # popped and overwritten after the block is returned
+        batch, _ = self.cache.pop(schema_name, file_idx, now_ts + 3)
+        self.cache.release(schema_name, file_idx, batch)
+        self.cache.put('test.a', (now_ts + 3 + file_cache.cache_size, 9.0))
+        self.assertEqual(timestamps.tolist(), [now_ts + i for i in range(3)])
+        self.assertEqual(block[:, pos_idx].tolist(), [0.0, 1.0, 2.0])
+        self.assertEqual(column[:, 0].tolist(), [0.0, 1.0, 2.0])
+
+    def test_fetch_while_flushing(self):
+        now_ts = int(time.time()) - 30
+        schema_name, file_idx = self._popTestA(now_ts)
+        for i in range(3):
+            self.cache.put('test.a', (now_ts + i, float(i)))
+
+        # flushed after cached points are read, before the file is read
+        fetch_array = kenshin.fetch_array
+        def flushAndFetch(*args, **kwargs):
+            batch, _ = self.cache.pop(schema_name, file_idx)
+            self.cache.release(schema_name, file_idx, batch)
+            return fetch_array(*args, **kwargs)
+        kenshin.fetch_array = flushAndFetch
+        self.addCleanup(setattr, kenshin, 'fetch_array', fetch_array)
+
+        _, values = self.cache.fetch(['test.a'], now_ts, now_ts + 3)['test.a']
+        self.assertEqual(values.tolist(), [0.0, 1.0, 2.0])
+
+    def test_write_with_pending_create(self):
+        now_ts = int(time.time()) - 30
+        self.cache.put('test.a', (now_ts, 1.0))
+        schema_name, file_idx, _ = self.cache.metric_idxs['test.a']
+        file_cache = self.cache.schema_caches[schema_name][file_idx]
+        # the file doesn't exist yet
+        self.assertFalse(file_cache.canWrite(now_ts + 60))
+        self.cache.createPendingMetrics()
+
+        # cache is full while test.b is waiting for creation
+        for i in range(file_cache.cache_size):
+            self.cache.put('test.a', (now_ts + i, float(i)))
+            self.cache.put('test.b', (now_ts + i, float(i + 100)))
+        self.assertEqual(file_cache.pending_creates, 1)
+        self.assertTrue(file_cache.canWrite(int(time.time())))
+
+        # no write while a metric is being created
+        file_cache.beginCreate()
+        self.assertFalse(file_cache.canWrite(int(time.time())))
+        self.assertEqual(self.cache.pop(schema_name, file_idx), ([], []))
+        file_cache.creating = False
+
+        pos_idx = self.cache.metric_idxs['test.b'][2]
+        batch, datapoints = self.cache.pop(schema_name, file_idx)
+        file_path = os.path.join(settings.LOCAL_DATA_DIR, 'a', schema_name,
+                                 '%d.hs' % file_idx)
+        kenshin.update(file_path, datapoints, now_ts + 60)
+        self.cache.release(schema_name, file_idx, batch)
+        self.assertEqual(min(self._known(datapoints, pos_idx)),
+                         (now_ts, 100.0))
+
+        # written datapoints are read once the metric is created
+        self.cache.createPendingMetrics()
+        self.assertEqual(self.cache.get('test.b'),
+                         [(now_ts + i, float(i + 100)) for i in
+                          range(file_cache.points_num, file_cache.cache_size)])
+        _, values = self.cache.fetch(['test.b'], now_ts, now_ts + 3,
+                                     now_ts + 60)['test.b']
+        self.assertEqual(values.tolist(), [100.0, 101.0, 102.0])
+
+    def test_oldest_unflushed_ts(self):
+        now_ts = int(time.time()) - 30
+        self.assertIsNone(self.cache.oldestUnflushedTs())
+        schema_name, file_idx = self._popTestA(now_ts)
+        self.assertIsNone(self.cache.oldestUnflushedTs())
+
+        self.cache.put('test.a', (now_ts, 1.0))
+        self.assertEqual(self.cache.oldestUnflushedTs(), now_ts)
+        batch, datapoints = self.cache.pop(schema_name, file_idx)
+        self.assertEqual(self._known(datapoints), [(now_ts, 1.0)])
+        # popped but not written yet
+        self.cache.put('test.a', (now_ts + 5, 2.0))
+        self.assertEqual(self.cache.oldestUnflushedTs(), now_ts)
+        self.cache.release(schema_name, file_idx, batch, False)
+        self.assertEqual(self.cache.oldestUnflushedTs(), now_ts)
+
+        # failed batch is written again with the next pop
+        file_cache = self.cache.schema_caches[schema_name][file_idx]
+        file_cache.inflight[0][3] = 0
+        batch, datapoints = self.cache.pop(schema_name, file_idx)
+        self.assertEqual(self._known(datapoints),
+                         [(now_ts, 1.0), (now_ts + 5, 2.0)])
+        self.cache.release(schema_name, file_idx, batch)
+        self.assertIsNone(self.cache.oldestUnflushedTs())
+
+    def test_drop_after_retries(self):
+        now_ts = int(time.time()) - 30
+        schema_name, file_idx = self._popTestA(now_ts)
+        self.cache.put('test.a', (now_ts, 1.0))
+        file_cache = self.cache.schema_caches[schema_name][file_idx]
+        self.assertFalse(file_cache.canWrite(now_ts))
+
+        for i in range(settings.MAX_WRITE_RETRIES):
+            batch, datapoints = self.cache.pop(schema_name, file_idx)
+            self.assertEqual(self._known(datapoints), [(now_ts, 1.0)])
+            self.assertEqual(
+                self.cache.release(schema_name, file_idx, batch, False), 0)
+            # retried after DEFAULT_WAIT_TIME
+            now = int(time.time())
+            self.assertFalse(file_cache.canWrite(now))
+            self.assertTrue(file_cache.canWrite(
+                now + settings.DEFAULT_WAIT_TIME + 1))
+            file_cache.inflight[0][3] = 0
+
+        batch, datapoints = self.cache.pop(schema_name, file_idx)
+        self.assertEqual(self._known(datapoints), [(now_ts, 1.0)])
+        self.assertEqual(
+            self.cache.release(schema_name, file_idx, batch, False), 1)
+        self.assertIsNone(self.cache.oldestUnflushedTs())
+        self.assertEqual(self.cache.get('test.a'), [])
+
+
+class TestMergeCachedPoints(unittest.TestCase):
+
+    def setUp(self):
+        self.timestamps = np.arange(100, 110)
+        self.block = np.array([range(10), range(10, 20)], dtype=float).T
+        self.block[3, 0] = NULL_VALUE
+
+    def test_same_step(self):
+        values = np.full((6, 2), np.nan)
+        values[0] = [-1.0, -2.0]
+        mergeCachedPoints((98, 104, 1), values, self.timestamps, self.block,
+                          1, Agg.get_agg_id('average'))
+        # values out of range are ignored, null values don't override
+        self.assertEqual(values[0].tolist(), [-1.0, -2.0])
+        self.assertTrue(np.isnan(values[1]).all())
+        self.assertEqual(values[2:, 1].tolist(), [10.0, 11.0, 12.0, 13.0])
+        self.assertEqual(values[2:5, 0].tolist(), [0.0, 1.0, 2.0])
+        self.assertTrue(np.isnan(values[5, 0]))
+
+    def test_aggregate(self):
+        values = np.full((4, 2), np.nan)
+        values[1] = [-1.0, -2.0]
+        mergeCachedPoints((96, 112, 4), values, self.timestamps, self.block,
+                          1, Agg.get_agg_id('sum'))
+        # only null slots are filled, groups are aligned to the step
+        self.assertTrue(np.isnan(values[0]).all())
+        self.assertEqual(values[1:].tolist(), [[-1.0, -2.0],
+                                               [4.0 + 5 + 6 + 7,
+                                                14.0 + 15 + 16 + 17],
+                                               [8.0 + 9, 18.0 + 19]])
+        # a null value is skipped
+        values = np.full((4, 2), np.nan)
+        mergeCachedPoints((96, 112, 4), values, self.timestamps, self.block,
+                          1, Agg.get_agg_id('sum'))
+        self.assertEqual(values[1].tolist(), [0.0 + 1 + 2, 10.0 + 11 + 12 + 13])
+
+    def test_out_of_range(self):
+        values = np.full((4, 2), np.nan)
+        mergeCachedPoints((200, 204, 1), values, self.timestamps, self.block,
+                          1, Agg.get_agg_id('average'))
+        self.assertTrue(np.isnan(values).all())
+
+
+class TestCacheManagementHandler(TestMetricCacheBase):
+
+    def setUp(self):
+        TestMetricCacheBase.setUp(self)
+        self.old_cache = protocols.MetricCache
+        protocols.MetricCache = self.cache
+        self.now_ts = int(time.time()) - 5
+        for metric in ['test.a.x', 'test.b.x', 'test.c']:
+            self.cache.put(metric, (self.now_ts, 1.0))
+        self.cache.createPendingMetrics()
+
+    def tearDown(self):
+        protocols.MetricCache = self.old_cache
+        TestMetricCacheBase.tearDown(self)
+
+    def _request(self, request):
+        handler = protocols.CacheManagementHandler()
+        transport = StringTransport()
+        handler.makeConnection(transport)
+        data = pickle.dumps(request, protocol=2)
+        handler.dataReceived(struct.pack('!I', len(data)) + data)
+        response = transport.value()
+        size, = struct.unpack('!I', response[:4])
+        self.assertEqual(len(response), 4 + size)
+        return pickle.loads(response[4:])
+
+    def test_cache_query_bulk(self):
+        rs = self._request({'type': 'cache-query-bulk',
+                            'metrics': ['test.c'], 'pattern': 'test.*.x'})
+        point = [(self.now_ts, 1.0)]
+        self.assertEqual(rs['datapoints'], {'test.a.x': point,
+                                            'test.b.x': point,
+                                            'test.c': point})
+
+    def test_cache_query(self):
+        rs = self._request({'type': 'cache-query', 'metric': 'test.c'})
+        self.assertEqual(rs['datapoints'], [(self.now_ts, 1.0)])
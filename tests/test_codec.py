@@ -0,0 +1,59 @@
+# coding: utf-8
+import struct
+import unittest
+
+import numpy as np
+
+from rurouni.codec import (packFrame, packArrays, unpackFrame, InvalidFrame,
+                           HEADER_FORMAT, HEADER_SIZE)
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.datapoints = [
+            ('a.b.c', (1411628779, 1.5)),
+            ('x.y', (1411628780, -2.0)),
+            ('a.b.c', (1411628781, float('inf'))),
+            ('a.b.c', (1411628782, 1e300)),
+        ]
+
+    def _unpack(self, frame):
+        names, records = unpackFrame(frame)
+        return [(names[i], (int(ts), float(val)))
+                for i, ts, val in records.tolist()]
+
+    def test_round_trip(self):
+        frame = packFrame(self.datapoints)
+        self.assertEqual(self._unpack(frame), self.datapoints)
+
+    def test_pack_arrays(self):
+        metrics = ['a.b.c', 'x.y']
+        frame = packArrays(metrics, np.array([0, 1, 0, 0]),
+                           np.array([ts for _, (ts, _) in self.datapoints]),
+                           np.array([val for _, (_, val) in self.datapoints]))
+        self.assertEqual(frame, packFrame(self.datapoints))
+
+    def test_empty_frame(self):
+        names, records = unpackFrame(packFrame([]))
+        self.assertEqual(len(records), 0)
+
+    def test_truncated_frame(self):
+        frame = packFrame(self.datapoints)
+        for size in (0, HEADER_SIZE - 1, HEADER_SIZE + 3, len(frame) - 1):
+            self.assertRaises(InvalidFrame, unpackFrame, frame[:size])
+        self.assertRaises(InvalidFrame, unpackFrame, frame + '\x00')
+
+    def test_bad_header(self):
+        frame = packFrame(self.datapoints)
+        names_size, record_cnt = struct.unpack_from(HEADER_FORMAT, frame)
+        for header in [(names_size + 1, record_cnt),
+                       (names_size, record_cnt + 1),
+                       (2 ** 32 - 1, record_cnt)]:
+            bad_frame = struct.pack(HEADER_FORMAT, *header) + frame[HEADER_SIZE:]
+            self.assertRaises(InvalidFrame, unpackFrame, bad_frame)
+
+    def test_invalid_name_id(self):
+        frame = packArrays(['a.b.c'], np.array([1]), np.array([1411628779]),
+                           np.array([1.0]))
+        self.assertRaises(InvalidFrame, unpackFrame, frame)
@@ -0,0 +1,97 @@
+# coding: utf-8
+import os
+import shutil
+import unittest
+
+from rurouni.index import (BinaryIndex, MetricIndex, convertIndex,
+                           iterTextIndex, loadBinaryIndex,
+                           getBinaryIndexPath)
+
+
+class TestIndex(unittest.TestCase):
+    data_dir = '/tmp/rurouni-index'
+
+    def setUp(self):
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        os.makedirs(self.data_dir)
+        self.index_file = os.path.join(self.data_dir, 'a.idx')
+        self.lines = [
+            ('a.b.c', 'test', 0, 0),
+            ('a.b.d', 'test', 0, 1),
+            ('x.y', 'default', 0, 0),
+            ('a.b.e', 'test', 1, 3),
+        ]
+        self._write(self.index_file, self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    @staticmethod
+    def _write(path, lines, mode='w'):
+        with open(path, mode) as f:
+            for line in lines:
+                f.write('%s %s %s %s\n' % line)
+
+    def _load(self):
+        """
+        Load metrics as rurouni does at startup.
+        """
+        binary_index = loadBinaryIndex(self.index_file)
+        offset = 0 if binary_index is None else binary_index.text_size
+        index = MetricIndex(binary_index)
+        for metric, schema_name, file_idx, pos_idx in \
+                iterTextIndex(self.index_file, offset):
+            index[metric] = (schema_name, file_idx, pos_idx)
+        self.addCleanup(index.close)
+        return binary_index, index
+
+    def test_round_trip(self):
+        convertIndex(self.index_file)
+        binary_index = BinaryIndex(getBinaryIndexPath(self.index_file))
+        self.addCleanup(binary_index.close)
+
+        self.assertEqual(len(binary_index), len(self.lines))
+        expected = dict((m, (s, f, p)) for m, s, f, p in self.lines)
+        self.assertEqual(dict(binary_index.iteritems()), expected)
+        for metric, value in expected.iteritems():
+            self.assertEqual(binary_index.get(metric), value)
+        self.assertIsNone(binary_index.get('a.b'))
+        self.assertEqual(sorted(binary_index.iterFiles()),
+                         [('default', 0, 0b1), ('test', 0, 0b11),
+                          ('test', 1, 0b1000)])
+
+    def test_replay_appended_lines(self):
+        convertIndex(self.index_file)
+        new_lines = [('a.b.f', 'test', 1, 4), ('a.b.c', 'test', 2, 0)]
+        self._write(self.index_file, new_lines, 'a')
+
+        binary_index, index = self._load()
+        self.assertIsNotNone(binary_index)
+        self.assertEqual(index['a.b.f'], ('test', 1, 4))
+        self.assertEqual(index['a.b.c'], ('test', 2, 0))
+        self.assertEqual(index['x.y'], ('default', 0, 0))
+
+    def test_stale_after_replace(self):
+        convertIndex(self.index_file)
+        # a larger text index is moved in place of the old one
+        tmp_file = self.index_file + '.tmp'
+        self._write(tmp_file, [('m.%d' % i, 'test', 0, i) for i in range(10)])
+        os.rename(tmp_file, self.index_file)
+
+        binary_index, index = self._load()
+        self.assertIsNone(binary_index)
+        self.assertNotIn('a.b.c', index)
+        self.assertEqual(index['m.9'], ('test', 0, 9))
+
+    def test_stale_after_rewrite(self):
+        convertIndex(self.index_file)
+        st = os.stat(self.index_file)
+        # rewritten in place with a different content
+        self._write(self.index_file, [('m.%d' % i, 'test', 0, i)
+                                      for i in range(10)])
+        os.utime(self.index_file, (st.st_atime, st.st_mtime + 1))
+
+        binary_index, index = self._load()
+        self.assertIsNone(binary_index)
+        self.assertNotIn('a.b.c', index)
@@ -24,6 +24,8 @@ class TestStorageIO(unittest.TestCase):
         self.path = self.storage.gen_path(self.data_dir, metric_name)
 
     def tearDown(self):
+        # enable_debug shadows the builtin open in the module
+        vars(kenshin.storage).pop('open', None)
         shutil.rmtree(self.data_dir)
 
     def _basic_setup(self):
@@ -0,0 +1,81 @@
+# coding: utf-8
+import unittest
+
+from rurouni.storage import PatternSchema, DefaultSchema, SchemaMatcher
+
+
+def make_schemas(patterns):
+    schemas = [PatternSchema('s%d' % i, pattern, 1.0, 'average', [(1, 60)],
+                             60, 10, 1.2)
+               for i, pattern in enumerate(patterns)]
+    return schemas + [DefaultSchema('default', 1.0, 'average', [(1, 60)],
+                                    60, 10, 1.2)]
+
+
+def sequential_match(schemas, metric):
+    for schema in schemas:
+        if schema.match(metric):
+            return schema
+    return None
+
+
+class TestSchemaMatcher(unittest.TestCase):
+
+    def assertSameAsSequential(self, schemas, metrics, **kwargs):
+        matcher = SchemaMatcher(schemas, **kwargs)
+        # twice, the second time hits memo
+        for _ in range(2):
+            for metric in metrics:
+                self.assertIs(matcher.match(metric),
+                              sequential_match(schemas, metric), metric)
+        return matcher
+
+    def test_first_match(self):
+        schemas = make_schemas([
+            r'^sys\.cpu\.',
+            r'^sys\.',
+            r'^(app|web)\.(\w+)\.count$',
+            r'^web\.',
+            r'.*\.mem$',
+        ])
+        metrics = ['sys.cpu.user', 'sys.mem', 'app.x.count', 'web.x.count',
+                   'web.x.sum', 'db.mem', 'db.disk', '']
+        self.assertSameAsSequential(schemas, metrics)
+
+    def test_standalone_patterns(self):
+        schemas = make_schemas([
+            r'^(\w+)\.\1$',                 # backreference
+            r'^(?P<a>\w+)-(?P=a)\.',        # named backreference
+            r'(?i)^CPU\.',                  # inline flag
+            r'^(a)?(?(1)b|c)\.',            # conditional group
+            r'^cpu\.x',
+            r'^(?P<host>\w+)\.disk$',       # same group names can't be
+            r'^(?P<host>\w+)\.net$',        # combined
+            r'^.*\.net$',
+        ])
+        metrics = ['foo.foo', 'foo.bar', 'x-x.1', 'x-y.1', 'cpu.x',
+                   'CPU.x', 'Cpu.y', 'ab.1', 'c.1', 'b.1', 'h.disk',
+                   'h.net', 'h.i.net', 'other']
+        matcher = self.assertSameAsSequential(schemas, metrics)
+        # inline flag doesn't leak to other patterns
+        self.assertIs(matcher.match('CPU.x'), schemas[2])
+
+    def test_chunk_boundary(self):
+        # each pattern takes two groups, so they are split into chunks
+        patterns = [r'^m(%d)\.' % i for i in range(120)]
+        patterns[60] = r'^m(\d+)\.'
+        schemas = make_schemas(patterns)
+        matcher = SchemaMatcher(schemas)
+        self.assertGreater(len(matcher.matchers), 3)
+        metrics = ['m%d.x' % i for i in range(130)]
+        self.assertSameAsSequential(schemas, metrics)
+
+    def test_memo(self):
+        schemas = make_schemas([r'^a\.', r'^b\.'])
+        metrics = ['a.%d' % i for i in range(10)] + ['b.1', 'c.1']
+        matcher = self.assertSameAsSequential(schemas, metrics, cache_size=4)
+        self.assertEqual(len(matcher.cache), 4)
+        self.assertEqual(matcher.cache.keys(), metrics[-4:])
+        # a hit becomes the most recent entry
+        matcher.match(metrics[-4])
+        self.assertEqual(matcher.cache.keys()[-1], metrics[-4])
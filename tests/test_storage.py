@@ -1,10 +1,16 @@
 # coding: utf-8
 import os
+import random
 import shutil
 import struct
 import unittest
+import numpy as np
+from StringIO import StringIO
 
-from kenshin.storage import Storage
+from kenshin.storage import (Storage, MmapStorage, WriteBuffer, header_cache,
+                             FLAG_COMPRESSED, FLAG_IMPLICIT_TS,
+                             FLAG_COLUMN_MAJOR, FLAG_FLOAT32,
+                             FLAG_PAGE_ALIGNED, PAGE_SIZE)
 from kenshin.agg import Agg
 from kenshin.utils import mkdir_p, roundup
 from kenshin.consts import NULL_VALUE
@@ -12,15 +18,19 @@ from kenshin.consts import NULL_VALUE
 
 class TestStorageBase(unittest.TestCase):
     data_dir = '/tmp/kenshin'
+    storage_cls = Storage
+    flags = 0
+    allocation = 'zero'
 
     def setUp(self):
         if os.path.exists(self.data_dir):
             shutil.rmtree(self.data_dir)
 
         mkdir_p(self.data_dir)
-        self.storage = Storage(data_dir=self.data_dir)
+        self.storage = self.storage_cls(data_dir=self.data_dir)
         self.basic_setup = self._basic_setup()
-        self.storage.create(*self.basic_setup)
+        self.storage.create(*self.basic_setup, flags=self.flags,
+                            allocation=self.allocation)
 
         metric_name = self.basic_setup[0]
         self.path = self.storage.gen_path(self.data_dir, metric_name)
@@ -28,14 +38,11 @@ class TestStorageBase(unittest.TestCase):
         self.null_point = (None,) * len(tag_list)
 
     def tearDown(self):
+        header_cache.invalidate()
+        if isinstance(self.storage, MmapStorage):
+            self.storage.close()
         shutil.rmtree(self.data_dir)
 
-    @staticmethod
-    def _gen_val(i, num=2):
-        return [10 * j + i for j in range(num)]
-
-class TestStorage(TestStorageBase):
-
     def _basic_setup(self):
         metric_name = 'sys.cpu.user'
 
@@ -51,6 +58,13 @@ class TestStorage(TestStorageBase):
         agg_name = 'min'
         return [metric_name, tag_list, archive_list, x_files_factor, agg_name]
 
+    @staticmethod
+    def _gen_val(i, num=2):
+        return [10 * j + i for j in range(num)]
+
+
+class TestStorage(TestStorageBase):
+
     def test_gen_path(self):
         metric_name = 'a.b.c'
         data_dir = '/x/y'
@@ -70,6 +84,40 @@ class TestStorage(TestStorageBase):
                          for x in header['archive_list']]
         self.assertEqual(archive_list, _archive_list)
 
+    def test_create_error(self):
+        path = self.storage.gen_path(self.data_dir, 'sys.cpu.error')
+        self.assertRaises(ValueError, self.storage.create, 'sys.cpu.error',
+                          *self.basic_setup[1:4] + ['no_such_agg'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_read_tags(self):
+        self.assertEqual(self.storage.read_tags(self.path),
+                         self.basic_setup[1])
+
+    def test_header_cache(self):
+        now_ts = 1411628779
+        header = self.storage.fetch(self.path, now_ts - 5, now=now_ts)[0]
+        points = [(now_ts - 1, self._gen_val(1))]
+        self.storage.update(self.path, points, now_ts)
+        # updating data points doesn't invalidate header
+        self.assertIs(self.storage.fetch(self.path, now_ts - 5, now=now_ts)[0],
+                      header)
+
+        self.storage.add_tag('host=webserver01,cpu=2', self.path, 1)
+        new_header = self.storage.fetch(self.path, now_ts - 5, now=now_ts)[0]
+        self.assertIsNot(new_header, header)
+        self.assertEqual(new_header['tag_list'][1], 'host=webserver01,cpu=2')
+
+    def test_header_cache_external_change(self):
+        now_ts = 1411628779
+        header = self.storage.fetch(self.path, now_ts - 5, now=now_ts)[0]
+        # the file is modified by others without invalidating header cache
+        st = os.stat(self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime + 1))
+        self.assertIsNone(header_cache.get(self.path, os.stat(self.path)))
+        self.assertIsNot(self.storage.fetch(self.path, now_ts - 5, now=now_ts)[0],
+                         header)
+
     def test_basic_update_fetch(self):
         now_ts = 1411628779
         num_points = 5
@@ -112,6 +160,103 @@ class TestStorage(TestStorageBase):
         expected = time_info, [self.null_point, (2.0, 12.0), self.null_point]
         self.assertEqual(series[1:], expected)
 
+    def test_update_many(self):
+        metric_name = 'sys.cpu.sys'
+        self.storage.create(metric_name, *self.basic_setup[1:], flags=self.flags)
+        path = self.storage.gen_path(self.data_dir, metric_name)
+
+        now_ts = 1411628779
+        for i in range(3):
+            now_ts += 4
+            points = [(now_ts - j, self._gen_val(j)) for j in range(1, 8)]
+            self.storage.update(self.path, list(points), now_ts)
+            rs = self.storage.update_many([(path, list(points))], now_ts)
+            self.assertIsNone(rs[0][2])
+
+        with open(self.path, 'rb') as f1, open(path, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_fetch_array(self):
+        now_ts = 1411628779
+        points = [(now_ts - 1, self._gen_val(1)),
+                  (now_ts - 2, (NULL_VALUE, 12.0)),
+                  (now_ts - 4, self._gen_val(4))]
+        self.storage.update(self.path, points, now_ts)
+
+        from_ts = now_ts - 5
+        header, time_info, vals = self.storage.fetch_array(self.path, from_ts,
+                                                           now=now_ts)
+        self.assertEqual(time_info, (from_ts, now_ts, 1))
+        nan = np.nan
+        expected = np.array([[nan, nan], [4.0, 14.0], [nan, nan],
+                             [nan, 12.0], [1.0, 11.0]])
+        np.testing.assert_array_equal(vals, expected)
+
+    def test_fetch_columns(self):
+        now_ts = 1411628779
+        points = [(now_ts - 1, self._gen_val(1)),
+                  (now_ts - 2, (NULL_VALUE, 12.0)),
+                  (now_ts - 4, self._gen_val(4))]
+        self.storage.update(self.path, points, now_ts)
+
+        from_ts = now_ts - 5
+        tag_list = self.basic_setup[1]
+        _, _, vals = self.storage.fetch_array(self.path, from_ts, now=now_ts,
+                                              columns=[tag_list[1]])
+        nan = np.nan
+        expected = np.array([[nan], [14.0], [nan], [12.0], [11.0]])
+        np.testing.assert_array_equal(vals, expected)
+
+        _, _, points = self.storage.fetch(self.path, from_ts, now=now_ts,
+                                          columns=[1, 0])
+        self.assertEqual(points, [(None, None), (14.0, 4.0), (None, None),
+                                  (12.0, None), (11.0, 1.0)])
+
+    def test_fetch_many(self):
+        now_ts = 1411628779
+        points = [(now_ts - 1, self._gen_val(1)),
+                  (now_ts - 2, (NULL_VALUE, 12.0)),
+                  (now_ts - 4, self._gen_val(4))]
+        self.storage.update(self.path, points, now_ts)
+
+        link_dir = os.path.join(self.data_dir, 'link')
+        mkdir_p(link_dir)
+        tag_list = self.basic_setup[1]
+        for tag in tag_list:
+            os.symlink(self.path, os.path.join(link_dir, tag + '.hs'))
+
+        from_ts = now_ts - 5
+        rs = self.storage.fetch_many(tag_list + ['not.exists'], from_ts,
+                                     now=now_ts, link_dir=link_dir)
+        time_info = (from_ts, now_ts, 1)
+        self.assertEqual(rs[tag_list[0]],
+                         (time_info, [None, 4.0, None, None, 1.0]))
+        self.assertEqual(rs[tag_list[1]],
+                         (time_info, [None, 14.0, None, 12.0, 11.0]))
+        self.assertEqual(rs['not.exists'], None)
+
+        rs = self.storage.fetch_many([self.path], from_ts, now=now_ts)
+        self.assertEqual(rs[self.path],
+                         self.storage.fetch(self.path, from_ts, now=now_ts)[1:])
+
+        # a link outside rurouni's link dir is fetched as a data file
+        other_link = os.path.join(self.data_dir, 'other.hs')
+        os.symlink(self.path, other_link)
+        metric_link = os.path.join(link_dir, 'a', tag_list[1] + '.hs')
+        mkdir_p(os.path.dirname(metric_link))
+        os.symlink(self.path, metric_link)
+        expected = self.storage.fetch(self.path, from_ts, now=now_ts)[1:]
+        opened = []
+        _open = self.storage._open
+        self.storage._open = lambda *args: opened.append(args) or _open(*args)
+        rs = self.storage.fetch_many([other_link, metric_link], from_ts,
+                                     now=now_ts)
+        self.assertEqual(rs[other_link], expected)
+        self.assertEqual(rs[metric_link],
+                         (time_info, [None, 14.0, None, 12.0, 11.0]))
+        # the file is opened once
+        self.assertEqual(len(opened), 1)
+
     def test_update_old_points(self):
         now_ts = 1411628779
         num_points = 12
@@ -147,6 +292,40 @@ class TestStorage(TestStorageBase):
                 print unpacked_series
 
 
+class TestSparseStorage(TestStorage):
+    allocation = 'sparse'
+
+    def test_same_content(self):
+        for allocation in ('zero', 'fallocate'):
+            metric_name = 'sys.cpu.%s' % allocation
+            self.storage.create(metric_name, *self.basic_setup[1:],
+                                allocation=allocation)
+            path = self.storage.gen_path(self.data_dir, metric_name)
+            with open(path, 'rb') as f1, open(self.path, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+
+class TestMmapStorage(TestStorage):
+    storage_cls = MmapStorage
+
+    def test_remap_after_add_tag(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 3)]
+        self.storage.update(self.path, points, now_ts)
+        self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+
+        # a long tag can't fit in the reserved space,
+        # so the whole file is rewritten.
+        long_tag = 'host=webserver01,cpu=0,' + 'x' * 200
+        self.storage.add_tag(long_tag, self.path, 0)
+
+        series = self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+        header = series[0]
+        self.assertEqual(header['tag_list'][0], long_tag)
+        vals = [self.null_point] + [tuple(map(float, v)) for _, v in sorted(points)]
+        self.assertEqual(series[2], vals)
+
+
 class TestLostPoint(TestStorageBase):
 
     def _basic_setup(self):
@@ -218,6 +397,10 @@ class TestLostPoint(TestStorageBase):
         self.assertEqual(series[1:], expected)
 
 
+class TestMmapLostPoint(TestLostPoint):
+    storage_cls = MmapStorage
+
+
 class TestMultiArchive(TestStorageBase):
 
     def _basic_setup(self):
@@ -255,3 +438,412 @@ class TestMultiArchive(TestStorageBase):
         values = [(26.0, 36.0, 46.0), (20.0, 30.0, 40.0)]
         expected = (time_info, values)
         self.assertEqual(series[1:], expected)
+
+
+class TestPropagateEmptyRange(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        tag_list = ['host=webserver01,cpu=0']
+        archive_list = [
+            (10, 60),
+            (60, 60),
+        ]
+        x_files_factor = 0.5
+        agg_name = 'average'
+        return [metric_name, tag_list, archive_list, x_files_factor, agg_name]
+
+    def test_update_old_point(self):
+        now_ts = 1411628760 + 600
+        # a point on minute boundary older than mtime propagates an
+        # empty range
+        self.storage.update(self.path, [(1411628760, [1.0])], now_ts, now_ts)
+        series = self.storage.fetch(self.path, 1411628750, 1411628780,
+                                    now=1411628790)
+        self.assertEqual(series[1:], ((1411628750, 1411628780, 10),
+                                      [(None,), (1.0,), (None,)]))
+
+
+class TestCompressedLayout(TestStorageBase):
+    flags = FLAG_COMPRESSED
+
+    def test_header(self):
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['flags'], FLAG_COMPRESSED)
+        self.assertEqual([a['compressed'] for a in header['archive_list']],
+                         [False, True])
+
+    def _create_flat(self, flags):
+        metric_name = 'sys.cpu.flat%d' % flags
+        tag_list = ['host=webserver01,cpu=%d' % i for i in range(10)]
+        self.storage.create(metric_name, tag_list, [(1, 60), (60, 300)],
+                            0.5, 'average', flags=flags)
+        path = self.storage.gen_path(self.data_dir, metric_name)
+        now_ts = 1411628760
+        for _ in range(300):
+            now_ts += 60
+            points = [(now_ts - i, [1.0] * len(tag_list))
+                      for i in range(60)]
+            self.storage.update(path, points, now_ts)
+        return path, now_ts
+
+    def test_smaller_than_raw(self):
+        raw_path, _ = self._create_flat(0)
+        path, now_ts = self._create_flat(FLAG_COMPRESSED)
+        raw_size = os.path.getsize(raw_path)
+        self.assertLess(os.path.getsize(path), raw_size)
+
+        # add_tag copies the file, and packs the blocks
+        series = self.storage.fetch(path, now_ts - 18000, now=now_ts)
+        long_tag = 'host=webserver01,cpu=0,' + 'x' * 200
+        self.storage.add_tag(long_tag, path, 0)
+        self.assertLess(os.path.getsize(path), raw_size)
+        new_series = self.storage.fetch(path, now_ts - 18000, now=now_ts)
+        self.assertEqual(new_series[0]['tag_list'][0], long_tag)
+        self.assertEqual(new_series[1:], series[1:])
+        self.assertEqual(new_series[2][-1], (1.0,) * 10)
+
+
+class TestImplicitTsLayout(TestStorageBase):
+    flags = FLAG_IMPLICIT_TS
+
+    def test_drop_old_points(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.storage.update(self.path, points, now_ts)
+        # slots of these points are used by newer points
+        old_points = [(now_ts - i, self._gen_val(i)) for i in range(7, 10)]
+        self.storage.update(self.path, old_points, now_ts - 6)
+
+        series = self.storage.fetch(self.path, now_ts - 5, now=now_ts)
+        vals = [self.null_point] * 2 + [tuple(map(float, v))
+                                        for _, v in sorted(points)]
+        self.assertEqual(series[2], vals)
+
+
+class TestColumnMajorLayout(TestStorageBase):
+    flags = FLAG_COLUMN_MAJOR
+
+    def test_read_columns(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.storage.update(self.path, points, now_ts)
+
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+            archive = header['archive_list'][0]
+            f.seek(archive['offset'] + archive['values_offset'] +
+                   archive['count'] * 8)
+            # values of the second tag are contiguous
+            column = struct.unpack('!6d', f.read(6 * 8))
+        self.assertEqual(sorted(column)[-3:], [11.0, 12.0, 13.0])
+
+
+class TestFloat32Layout(TestStorageBase):
+    flags = FLAG_FLOAT32
+
+    def test_header(self):
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['point_size'], 4 + 4 * 2)
+        self.assertEqual(header['value_size'], 4)
+
+    def test_float32_value(self):
+        now_ts = 1411628779
+        self.storage.update(self.path, [(now_ts - 1, [0.1, 1e10])], now_ts)
+        series = self.storage.fetch(self.path, now_ts - 1, now=now_ts)
+        self.assertEqual(series[2], [(float(np.float32(0.1)), 1e10)])
+
+
+class TestPageAlignedLayout(TestStorageBase):
+    flags = FLAG_PAGE_ALIGNED
+
+    def test_header(self):
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual([a['offset'] % PAGE_SIZE
+                          for a in header['archive_list']], [0, 0])
+        self.assertEqual(os.path.getsize(self.path) % PAGE_SIZE, 0)
+
+    def test_add_long_tag_in_place(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 3)]
+        self.storage.update(self.path, points, now_ts)
+        inode = os.stat(self.path).st_ino
+
+        # the tag doesn't fit in the reserved space, but fits in the padding
+        long_tag = 'host=webserver01,cpu=0,' + 'x' * 200
+        self.storage.add_tag(long_tag, self.path, 0)
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+        series = self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+        self.assertEqual(series[0]['tag_list'][0], long_tag)
+        vals = [self.null_point] + [tuple(map(float, v)) for _, v in sorted(points)]
+        self.assertEqual(series[2], vals)
+
+    def test_add_tag_beyond_padding(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 3)]
+        self.storage.update(self.path, points, now_ts)
+
+        long_tag = 'host=webserver01,cpu=0,' + 'x' * PAGE_SIZE
+        self.storage.add_tag(long_tag, self.path, 0)
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['archive_list'][0]['offset'], 2 * PAGE_SIZE)
+
+        series = self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+        vals = [self.null_point] + [tuple(map(float, v)) for _, v in sorted(points)]
+        self.assertEqual(series[2], vals)
+
+
+class TestMmapPageAlignedLayout(TestPageAlignedLayout):
+    storage_cls = MmapStorage
+
+
+class TestPageAlignedCompressedLayout(TestStorageBase):
+    flags = FLAG_PAGE_ALIGNED | FLAG_COMPRESSED
+
+    def test_blocks_offset(self):
+        with open(self.path, 'rb') as f:
+            blocks_offset = self.storage.header(f)['blocks_offset']
+        self.assertEqual(blocks_offset % PAGE_SIZE, 0)
+        # blocks are allocated when written
+        self.assertEqual(os.path.getsize(self.path), blocks_offset)
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 6)]
+        self.storage.update(self.path, points, now_ts)
+        # blocks are not padded to pages
+        self.assertLess(os.path.getsize(self.path) - blocks_offset,
+                        PAGE_SIZE)
+
+
+# layouts checked against raw files, with all flags in the last one
+LAYOUTS = (
+    FLAG_COMPRESSED,
+    FLAG_IMPLICIT_TS,
+    FLAG_IMPLICIT_TS | FLAG_COMPRESSED,
+    FLAG_COLUMN_MAJOR,
+    FLAG_IMPLICIT_TS | FLAG_COLUMN_MAJOR,
+    FLAG_FLOAT32,
+    FLAG_FLOAT32 | FLAG_COMPRESSED,
+    FLAG_FLOAT32 | FLAG_COLUMN_MAJOR,
+    FLAG_FLOAT32 | FLAG_IMPLICIT_TS,
+    FLAG_PAGE_ALIGNED,
+    FLAG_PAGE_ALIGNED | FLAG_COMPRESSED,
+    FLAG_COMPRESSED | FLAG_IMPLICIT_TS | FLAG_COLUMN_MAJOR | FLAG_FLOAT32 |
+    FLAG_PAGE_ALIGNED,
+)
+
+
+class TestLayout(unittest.TestCase):
+    """
+    A file of each layout is written with the same points as a raw
+    file, and all of them must be fetched the same.
+    """
+    data_dir = '/tmp/kenshin'
+    storage_cls = Storage
+    start_ts = 1411628700
+    tag_list = ['host=webserver01,cpu=0', 'host=webserver01,cpu=1']
+
+    def setUp(self):
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        mkdir_p(self.data_dir)
+        self.storage = self.storage_cls(data_dir=self.data_dir)
+
+    def tearDown(self):
+        header_cache.invalidate()
+        if isinstance(self.storage, MmapStorage):
+            self.storage.close()
+        shutil.rmtree(self.data_dir)
+
+    def _create(self, archive_list, x_files_factor, agg_name):
+        self.paths = {}
+        for flags in (0,) + LAYOUTS:
+            metric_name = 'sys.cpu.layout%d' % flags
+            self.storage.create(metric_name, self.tag_list, archive_list,
+                                x_files_factor, agg_name, flags=flags)
+            path = self.storage.gen_path(self.data_dir, metric_name)
+            os.utime(path, (self.start_ts, self.start_ts))
+            self.paths[flags] = path
+
+    def _update(self, points, now_ts, mtime=None, many=False):
+        for path in self.paths.values():
+            if many:
+                rs = self.storage.update_many([(path, list(points))], now_ts)
+                self.assertIsNone(rs[0][2])
+            else:
+                self.storage.update(path, list(points), now_ts, mtime)
+            os.utime(path, (now_ts, now_ts))
+
+    def _fetch(self, path, from_ts, until_ts, now_ts):
+        time_info, points = self.storage.fetch(path, from_ts, until_ts,
+                                               now=now_ts)[1:]
+        column = self.storage.fetch(path, from_ts, until_ts, now=now_ts,
+                                    columns=[1])[2]
+        vals = self.storage.fetch_array(path, from_ts, until_ts,
+                                        now=now_ts)[2]
+        vals = [[None if np.isnan(v) else v for v in row]
+                for row in vals.tolist()]
+        return time_info, points, column, vals
+
+    def assertSameAsRaw(self, from_ts, until_ts=None, now_ts=None):
+        """
+        Check all layouts against the raw file, return the raw series.
+        """
+        expected = self._fetch(self.paths[0], from_ts, until_ts, now_ts)
+        for flags in LAYOUTS:
+            self.assertEqual(
+                self._fetch(self.paths[flags], from_ts, until_ts, now_ts),
+                expected, 'flags: %d' % flags)
+        return expected[:2]
+
+    def _non_null(self, series):
+        time_info, points = series
+        return [(time_info[0] + i * time_info[2] - self.start_ts, v)
+                for i, v in enumerate(points) if v[0] is not None]
+
+    def test_update(self):
+        self._create([(1, 6), (3, 6)], 1.0, 'min')
+        # archives wrap around several times
+        now_ts = 1411628779
+        for i in range(20):
+            now_ts += 5
+            points = [(now_ts - j, [10 * j + i, 20 * j + i])
+                      for j in range(1, 6)]
+            if i % 3 == 0:
+                points[i % 5] = (points[i % 5][0], [NULL_VALUE, 1.0])
+            self._update(points, now_ts, many=i % 2)
+            for from_ts in (now_ts - 5, now_ts - 17):
+                self.assertSameAsRaw(from_ts, now_ts=now_ts)
+
+    def test_old_points(self):
+        self._create([(1, 6), (3, 6)], 1.0, 'min')
+        now_ts = 1411628779
+        points = [(now_ts - i, [i, i + 10]) for i in range(7, 13)]
+        self._update(points, now_ts)
+        series = self.assertSameAsRaw(now_ts - 13, now_ts=now_ts)
+        self.assertEqual(series[1][:3], [(12.0, 22.0), (10.0, 20.0),
+                                         (7.0, 17.0)])
+
+    def test_lost_point(self):
+        self._create([(1, 60), (3, 60)], 5, 'min')
+        now_ts = 1411628779
+        for point_seeds, mtime in [(range(30, 45), None),
+                                   (range(15), now_ts - 44)]:
+            points = [(now_ts - i, [i, i + 10]) for i in point_seeds]
+            self._update(points, now_ts, mtime)
+        self.assertSameAsRaw(now_ts - 61, now_ts=now_ts)
+        self.assertSameAsRaw(now_ts - 5, now_ts=now_ts)
+
+    def test_multi_archive(self):
+        self._create([(1, 60), (3, 60), (6, 60)], 5, 'min')
+        now_ts = 1411628779
+        points = [(now_ts - i, [i, i + 10]) for i in range(19, 30)]
+        self._update(points, now_ts)
+        from_ts = 1411628760 - 2 * 6
+        series = self.assertSameAsRaw(from_ts, 1411628760, from_ts + 181)
+        self.assertEqual(series[1], [(26.0, 36.0), (20.0, 30.0)])
+
+    def test_empty_range(self):
+        self._create([(10, 60), (60, 60)], 0.5, 'average')
+        now_ts = 1411628760 + 600
+        # a point on minute boundary older than mtime propagates an
+        # empty range
+        self._update([(1411628760, [1.0, 2.0])], now_ts, now_ts)
+        series = self.assertSameAsRaw(1411628750, 1411628780, 1411628790)
+        self.assertEqual(series[1], [(None, None), (1.0, 2.0), (None, None)])
+
+    def test_idle_gap(self):
+        self._create([(1, 60), (3, 60), (30, 100)], 0.1, 'max')
+        # the gap between two writes is longer than retention of the
+        # first archive
+        for seeds in [(9, 10), (299, 300)]:
+            self._update([(self.start_ts + i, [i, i + 1000]) for i in seeds],
+                         self.start_ts + seeds[-1])
+        until_ts = self.start_ts + 301
+        series = self.assertSameAsRaw(until_ts - 3000 + 1, until_ts, until_ts)
+        # points propagated before the gap are kept in the last archive
+        self.assertEqual(self._non_null(series),
+                         [(0, (10.0, 1010.0)), (270, (299.0, 1299.0))])
+
+    def test_late_point(self):
+        self._create([(1, 60), (3, 60), (30, 100)], 0.1, 'max')
+        start_ts = self.start_ts
+        # a late point is written to the second archive, after slots of
+        # older points are overwritten by the new point
+        self._update([(start_ts + 421, [92.0, 68.0])], start_ts + 448)
+        self._update([(start_ts + 469, [1.0, 1.0]),
+                      (start_ts + 647, [2.0, 2.0])], start_ts + 648)
+        until_ts = start_ts + 649
+        series = self.assertSameAsRaw(until_ts - 3000 + 1, until_ts, until_ts)
+        self.assertEqual(self._non_null(series),
+                         [(420, (92.0, 68.0)), (450, (1.0, 1.0)),
+                          (630, (2.0, 2.0))])
+
+    def test_random_updates(self):
+        rand = random.Random(0)
+        self._create([(1, 60), (3, 60), (30, 100)], 0.5, 'max')
+        now_ts = self.start_ts
+        for i in range(40):
+            gap = rand.choice([1, 2, 5, 7, 30, 200])
+            now_ts += gap
+            # points are newer than the last update, values and null
+            # values are exact in all value sizes
+            points = []
+            for _ in range(rand.randint(1, 15)):
+                ts = now_ts - rand.randint(0, min(30, gap - 1))
+                points.append((ts, [rand.randint(0, 100)
+                                    if rand.random() > 0.2 else NULL_VALUE
+                                    for _ in self.tag_list]))
+            self._update(points, now_ts, many=rand.random() < 0.5)
+            for back in (5, 50, 170, 3000):
+                self.assertSameAsRaw(now_ts - back, now_ts=now_ts)
+
+
+class TestMmapLayout(TestLayout):
+    storage_cls = MmapStorage
+
+
+class CountingFile(StringIO):
+    write_cnt = 0
+
+    def write(self, data):
+        self.write_cnt += 1
+        StringIO.write(self, data)
+
+
+class TestWriteBuffer(unittest.TestCase):
+
+    def test_coalesce(self):
+        fh = CountingFile('0123456789')
+        buf = WriteBuffer(fh)
+        buf.seek(2)
+        buf.write('ab')
+        buf.write('cd')
+        buf.seek(3)
+        buf.write('X')
+        buf.seek(8)
+        buf.write('yz')
+
+        # reads see pending writes
+        buf.seek(0)
+        self.assertEqual(buf.read(10), '01aXcd67yz')
+        self.assertEqual(fh.getvalue(), '0123456789')
+
+        buf.flush()
+        self.assertEqual(fh.getvalue(), '01aXcd67yz')
+        self.assertEqual(fh.write_cnt, 2)
+
+    def test_write_beyond_end(self):
+        fh = StringIO('0123')
+        buf = WriteBuffer(fh)
+        buf.seek(6)
+        buf.write('ab')
+        buf.seek(0, 2)
+        self.assertEqual(buf.tell(), 8)
+        buf.seek(2)
+        self.assertEqual(buf.read(10), '23\x00\x00ab')
+        self.assertEqual(buf.tell(), 8)
@@ -0,0 +1,178 @@
+# coding: utf-8
+import os
+import glob
+import time
+import shutil
+import unittest
+
+import numpy as np
+
+from rurouni import writer
+from rurouni.wal import WriteAheadLog, WALService, SEGMENT_SUFFIX
+from tests.test_cache import TestMetricCacheBase
+
+
+def replayAll(wal_dir):
+    wal = WriteAheadLog(wal_dir, 1 << 20)
+    rs = []
+    for names, records in wal.replay():
+        for metric_id, ts, val in records.tolist():
+            rs.append((names[metric_id], (ts, val)))
+    return rs
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    wal_dir = '/tmp/rurouni-wal'
+
+    def setUp(self):
+        if os.path.exists(self.wal_dir):
+            shutil.rmtree(self.wal_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.wal_dir)
+
+    def _newWal(self, segment_size=1 << 20):
+        wal = WriteAheadLog(self.wal_dir, segment_size)
+        wal.open()
+        return wal
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.wal_dir,
+                                             '*' + SEGMENT_SUFFIX)))
+
+    def test_round_trip(self):
+        wal = self._newWal()
+        wal.append('a.b', (100, 1.0))
+        wal.appendMany([('a.c', (101, 2.0)), ('a.b', (102, 3.0))])
+        wal.commit()
+        wal.appendArray(['x', 'y'], np.array([1, 0]), np.array([103, 104]),
+                        np.array([4.0, 5.0]))
+        wal.close()
+
+        self.assertEqual(sorted(replayAll(self.wal_dir)),
+                         [('a.b', (100, 1.0)), ('a.b', (102, 3.0)),
+                          ('a.c', (101, 2.0)), ('x', (104, 5.0)),
+                          ('y', (103, 4.0))])
+
+    def test_torn_record(self):
+        wal = self._newWal()
+        wal.append('a.b', (100, 1.0))
+        wal.commit()
+        wal.append('a.b', (101, 2.0))
+        wal.close()
+        # crashed in the middle of the last record
+        path = self._segments()[-1]
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+
+        self.assertEqual(replayAll(self.wal_dir), [('a.b', (100, 1.0))])
+
+    def test_truncate(self):
+        # each commit rotates segment
+        wal = self._newWal(segment_size=1)
+        for ts in [100, 200, 300]:
+            wal.append('a.b', (ts, float(ts)))
+            wal.commit()
+        self.assertEqual(len(wal.segments), 3)
+
+        wal.truncate(201)
+        self.assertEqual(wal.checkpoint, (3, 0))
+        self.assertEqual(len(self._segments()), 2)
+        # checkpoint never moves back
+        wal.truncate(100)
+        self.assertEqual(wal.checkpoint, (3, 0))
+        wal.close()
+        self.assertEqual(replayAll(self.wal_dir), [('a.b', (300, 300.0))])
+
+        wal.truncate(None)
+        self.assertEqual(self._segments(), [])
+        self.assertEqual(replayAll(self.wal_dir), [])
+
+    def test_replay_after_checkpoint(self):
+        wal = self._newWal()
+        wal.append('a.b', (100, 1.0))
+        wal.commit()
+        offset = wal.offset
+        wal.append('a.b', (300, 3.0))
+        wal.close()
+        wal.truncate(200)
+        # segment has datapoints newer than watermark
+        self.assertEqual(len(self._segments()), 1)
+
+        wal = WriteAheadLog(self.wal_dir, 1 << 20)
+        self.assertEqual(wal.checkpoint, (1, offset))
+        self.assertEqual(replayAll(self.wal_dir), [('a.b', (300, 3.0))])
+
+    def test_replay_late_point(self):
+        wal = self._newWal()
+        wal.append('a.b', (300, 3.0))
+        wal.commit()
+        # cache is empty
+        wal.truncate(None)
+        # a late datapoint arrives after all datapoints are flushed
+        wal.append('a.b', (100, 1.0))
+        wal.commit()
+        wal.close()
+        self.assertEqual(replayAll(self.wal_dir), [('a.b', (100, 1.0))])
+
+        wal = WriteAheadLog(self.wal_dir, 1 << 20)
+        list(wal.replay())
+        wal.truncate(None)
+        self.assertEqual(self._segments(), [])
+        self.assertEqual(replayAll(self.wal_dir), [])
+
+
+class TestWALService(TestMetricCacheBase):
+
+    def setUp(self):
+        TestMetricCacheBase.setUp(self)
+        self.old_cache = writer.MetricCache
+        writer.MetricCache = self.cache
+        self.wal_dir = os.path.join(self.root_dir, 'wal')
+        self.wal = WriteAheadLog(self.wal_dir, 1 << 20)
+        self.wal.open()
+        self.now_ts = int(time.time()) - 30
+        for i, metric in enumerate(['test.a', 'test.b']):
+            datapoint = (self.now_ts + i, float(i))
+            self.cache.put(metric, datapoint)
+            self.wal.append(metric, datapoint)
+        self.cache.createPendingMetrics()
+
+    def tearDown(self):
+        writer.MetricCache = self.old_cache
+        TestMetricCacheBase.tearDown(self)
+
+    def _stop(self):
+        service = WALService(self.wal, self.cache, 1)
+        service.startService()
+        writer.writeCachedDataPointsWhenStop(self.cache.getAllFileCaches())
+        service.stopService()
+
+    def test_checkpoint_when_stop(self):
+        self._stop()
+        self.assertIsNone(self.cache.oldestUnflushedTs())
+        self.assertEqual(replayAll(self.wal_dir), [])
+
+    def test_keep_unflushed_when_stop(self):
+        schema_name, file_idx, _ = self.cache.metric_idxs['test.a']
+        # being written by writer
+        batch, _ = self.cache.pop(schema_name, file_idx)
+        self._stop()
+        self.assertEqual(self.cache.oldestUnflushedTs(), self.now_ts)
+        self.assertEqual(replayAll(self.wal_dir),
+                         [('test.a', (self.now_ts, 0.0)),
+                          ('test.b', (self.now_ts + 1, 1.0))])
+
+        # written at last
+        self.cache.release(schema_name, file_idx, batch)
+        self.wal.truncate(self.cache.oldestUnflushedTs())
+        self.assertEqual(replayAll(self.wal_dir), [])
+
+    def test_keep_failed_write(self):
+        schema_name, file_idx, _ = self.cache.metric_idxs['test.a']
+        batch, _ = self.cache.pop(schema_name, file_idx)
+        self.cache.release(schema_name, file_idx, batch, False)
+        self.wal.close()
+        self.wal.truncate(self.cache.oldestUnflushedTs())
+        self.assertEqual(self.wal.checkpoint, (1, 0))
+        self.assertEqual(len(replayAll(self.wal_dir)), 2)